@@ -84,6 +84,17 @@ from modules.setup import *
 #ds.load_standardized_parquet_file()
 
 
+# ### Alternatively, append new files to the standardized parquet as they arrive
+
+# In[ ]:
+
+
+# ds.start_streaming_ingest(once = True)
+# ds.streaming_query.awaitTermination()
+# ds.load_standardized_parquet_file()
+# hourly_transactions, hourly_unique_subscribers = ds.streaming_hourly_aggregates('admin2_tower_map')
+
+
 # ### Alternatively, specify and load hive table
 
 # In[9]:
@@ -127,6 +138,7 @@ ds.load_geo_csvs()
 # from modules.tower_clustering import *
 # clusterer = tower_clusterer(ds, 'admin2', 'ID_2')
 # ds.admin2_tower_map, ds.distances = clusterer.cluster_towers()
+# ds.tower_centroids = clusterer.towers_regions_clusters_all_vars
 # clusterer = tower_clusterer(ds, 'admin3', 'ADM3_PCODE')
 # ds.admin3_tower_map, ds.distances  = clusterer.cluster_towers()
 
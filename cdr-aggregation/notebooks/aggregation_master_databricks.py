@@ -205,6 +205,7 @@ ds.load_geo_csvs()
 # ds.create_gpds()
 # clusterer = tower_clusterer(ds, 'admin2', 'ID_2')
 # ds.admin2_tower_map, ds.distances = clusterer.cluster_towers()
+# ds.tower_centroids = clusterer.towers_regions_clusters_all_vars
 # clusterer = tower_clusterer(ds, 'admin3', 'ADM3_PCODE')
 
 # COMMAND ----------
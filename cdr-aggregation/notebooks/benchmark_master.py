@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmark of the aggregation on synthetic data
+#
+# In this notebook we time the flowminder, priority and scaled indicators on synthetic CDR data, so that changes to the aggregation can be measured without operator data.
+#
+# - **Generate data**: `synthetic_cdr` creates calls in the standardized schema (msisdn, call_datetime, location_id), a tower map for admin2 and admin3, a distance matrix and weights. Change the number of subscribers, towers and the dates to change the size of the data.
+# - **Run benchmark**: `benchmark` times each indicator for each frequency and admin level, and records rows per second, shuffle bytes and peak memory in `data/results/<country_code>/<telecom_alias>/benchmark/benchmark.csv`.
+
+# # Import code
+
+# In[1]:
+
+
+from modules.DataSource import *
+from modules.setup import *
+from modules.synthetic_data import *
+from modules.benchmark import *
+
+
+# In[2]:
+
+
+datasource_configs = {
+  "base_path": "/home/jovyan/work/data",
+  "country_code": "synthetic",
+  "telecom_alias": "benchmark",
+  "schema" : StructType([
+    StructField("msisdn", IntegerType(), True),
+    StructField("call_datetime", StringType(), True),
+    StructField("location_id", StringType(), True)]),
+  "filestub": "synthetic",
+  "shapefiles": [],
+  "dates": {'start_date' : dt.datetime(2020,2,1),
+            'end_date' : dt.datetime(2020,3,31)}
+}
+
+
+# In[3]:
+
+
+ds = DataSource(datasource_configs)
+setup_folder(ds)
+
+
+# # Generate data
+
+# In[4]:
+
+
+synthetic = synthetic_cdr(ds.spark,
+                          n_subscribers = 10000,
+                          n_towers = 500,
+                          start_date = ds.dates['start_date'],
+                          end_date = ds.dates['end_date'])
+synthetic.attach(ds)
+
+
+# ### Save the calls to parquet so that all runs read the same files
+
+# In[5]:
+
+
+ds.raw_df = ds.parquet_df
+ds.save_as_parquet()
+
+
+# # Run benchmark
+
+# In[6]:
+
+
+bench = benchmark(ds)
+bench.run()
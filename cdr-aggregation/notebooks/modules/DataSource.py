@@ -2,12 +2,14 @@
 import os
 if os.environ['HOME'] != '/root':
     from modules.import_packages import *
+    from modules.sketches import *
 
 from pyspark.sql.functions import to_timestamp
 from pyspark.sql.types import *
 from random import sample, seed
 
 import datetime as dt
+import re
 import pyspark.sql.functions as F
 
 class DataSource:
@@ -41,6 +43,16 @@ class DataSource:
     self.parquetfile_vars = self.filestub + "_vars_"
     self.parquetfile_path = self.standardize_path +"/"+ self.parquetfile
 
+    #table name for the partitioned layout, which needs a catalog table
+    self.parquet_table = re.sub('[^0-9a-zA-Z_]', '_', self.filestub)
+
+    #streaming ingest: checkpoint with the files already read, staging folder
+    #for batches, and hourly aggregates refreshed with every batch
+    self.streaming_checkpoint_path = self.standardize_path + "/_streaming/checkpoint"
+    self.streaming_staging_path = self.tempfldr_path + "/streaming"
+    self.hourly_transactions_path = self.standardize_path + "/" + self.filestub + "_hourly_transactions.parquet"
+    self.hourly_sketches_path = self.standardize_path + "/" + self.filestub + "_hourly_sketches.parquet"
+
   ######################################
   # Setup Methods
 
@@ -53,6 +65,7 @@ class DataSource:
           self.spark = SparkSession.builder\
               .appName("CDR Aggregation") \
               .config("spark.sql.warehouse.dir", self.hive_warehouse_location) \
+              .config("spark.scheduler.mode", "FAIR")\
               .enableHiveSupport() \
               .getOrCreate()
 
@@ -62,11 +75,13 @@ class DataSource:
               .config("spark.sql.shuffle.partitions", "16") \
               .config("spark.driver.memory", "8g") \
               .config("spark.sql.execution.arrow.enabled", "true")\
+              .config("spark.scheduler.mode", "FAIR")\
               .getOrCreate()
 
       elif self.spark_mode == 'cluster':
           self.spark = SparkSession.builder.master(self.spark_master) \
               .config("spark.sql.execution.arrow.enabled", "true")\
+              .config("spark.scheduler.mode", "FAIR")\
               .getOrCreate()
 
       else:
@@ -97,7 +112,10 @@ class DataSource:
       "load_seperator":[str,","],
       "load_header":[str,"false"],
       "load_mode":[str,"PERMISSIVE"],
-      "load_datemask":[str,"dd/MM/yyyy HH:mm:ss"]
+      "load_datemask":[str,"dd/MM/yyyy HH:mm:ss"],
+      "parquet_layout":[str,"flat"],
+      "msisdn_buckets":[int,64],
+      "sketch_precision":[int,12]
     }
 
     #Loop over input_confif dict to test specified values
@@ -127,6 +145,10 @@ class DataSource:
         else:
           setattr(self, config_key, keys_types_defaults[config_key][1])
 
+    #Test that the parquet layout is one we know how to write and load
+    if self.parquet_layout not in ["flat","partitioned"]:
+      raise Exception('Input input_config["parquet_layout"] should be "flat" or "partitioned"')
+
   def add_week_dates(self):
       idx = self.dates['start_date'].weekday() % 7
       idx2 = self.dates['end_date'].weekday() + 1 % 7
@@ -147,6 +169,7 @@ class DataSource:
     print("Load options:", {"seperator":self.load_seperator,"header":self.load_header,"mode":self.load_mode,"datemask":self.load_datemask})
     print("Load schema:", self.schema)
     print("Filenames:",{"parquetfile":self.parquetfile})
+    print("Parquet layout:", {"layout":self.parquet_layout,"msisdn_buckets":self.msisdn_buckets})
     print()
 
  ######################################
@@ -195,8 +218,18 @@ class DataSource:
     #Create the full name
     full_filename = self.standardize_path+"/"+self.parquetfile
 
-    #Write to parquet
-    self.raw_df.write.mode(mode).format("parquet").save(full_filename)
+    #Write to parquet, partitioned by date and bucketed by msisdn if asked for.
+    #Bucketing needs a catalog table, the files still go to full_filename
+    if self.parquet_layout == "partitioned":
+      self.raw_df.repartition(self.msisdn_buckets, "msisdn")\
+        .write.mode(mode).format("parquet")\
+        .partitionBy("call_date")\
+        .bucketBy(self.msisdn_buckets, "msisdn")\
+        .sortBy("msisdn", "call_datetime")\
+        .option("path", full_filename)\
+        .saveAsTable(self.parquet_table)
+    else:
+      self.raw_df.write.mode(mode).format("parquet").save(full_filename)
 
     #Load the parquet infor parquet_df
     self.load_standardized_parquet_file()
@@ -206,7 +239,161 @@ class DataSource:
 
   #read the parquet file
   def load_standardized_parquet_file(self):
-    self.parquet_df = self.spark.read.format("parquet").load(self.standardize_path+"/"+self.parquetfile)
+    if self.parquet_layout == "partitioned":
+      self.register_parquet_table()
+      self.parquet_df = self.spark.table(self.parquet_table)
+    else:
+      self.parquet_df = self.spark.read.format("parquet").load(self.standardize_path+"/"+self.parquetfile)
+
+  #Register the partitioned parquet file as a table, so that spark knows about
+  #the buckets. Date filters then prune partitions, and msisdn windows and joins
+  #can use the buckets instead of a shuffle
+  def register_parquet_table(self):
+    self.spark.sql("""
+      CREATE TABLE IF NOT EXISTS `{}`
+      USING parquet
+      PARTITIONED BY (call_date)
+      CLUSTERED BY (msisdn) SORTED BY (msisdn, call_datetime) INTO {} BUCKETS
+      LOCATION '{}'
+      """.format(self.parquet_table, self.msisdn_buckets, self.parquetfile_path))
+    #pick up partitions written since the table was registered
+    self.spark.sql("ALTER TABLE `{}` RECOVER PARTITIONS".format(self.parquet_table))
+
+######################################
+ # Streaming ingest
+
+  #Read the files in newdata_path as a stream, with the same schema, load
+  #options and datemask as standardize_csv_files. The checkpoint keeps track
+  #of the files already read, so every file is read once
+  def read_new_files_stream(self):
+
+    streams = []
+    for data_path in self.data_paths:
+      streams.append(self.spark.readStream\
+        .option("sep", self.load_seperator)\
+        .option("header", self.load_header)\
+        .option("mode", self.load_mode)\
+        .schema(self.schema)\
+        .csv(self.newdata_path+"/"+data_path))
+
+    raw_stream = streams[0]
+    for stream in streams[1:]:
+      raw_stream = raw_stream.unionByName(stream)
+
+    raw_stream = raw_stream.withColumn("call_datetime", to_timestamp("call_datetime",self.load_datemask))
+    raw_stream = raw_stream.withColumn('call_date', raw_stream.call_datetime.cast('date'))
+    return raw_stream
+
+  #Start appending new files to the standardized parquet as they arrive. With
+  #once=True, process the files that arrived since the last run and stop
+  def start_streaming_ingest(self, processing_time = "1 minute", once = False):
+
+    writer = self.read_new_files_stream().writeStream\
+      .foreachBatch(self.ingest_batch)\
+      .option("checkpointLocation", self.streaming_checkpoint_path)
+
+    if once:
+      writer = writer.trigger(once = True)
+    else:
+      writer = writer.trigger(processingTime = processing_time)
+
+    self.streaming_query = writer.start()
+    return self.streaming_query
+
+  #Append one batch of new calls to the standardized parquet, and add its
+  #hourly transactions and subscriber sketches per tower to the hourly
+  #aggregates
+  def ingest_batch(self, batch_df, batch_id):
+
+    if batch_df.limit(1).count() == 0:
+      return
+    print('Ingesting batch', batch_id)
+    batch_df.persist()
+
+    if self.parquet_layout == "partitioned":
+      self.commit_batch(batch_df, self.parquetfile_path, batch_id, partitioned = True, bucketed = True)
+      self.register_parquet_table()
+    else:
+      self.commit_batch(batch_df, self.parquetfile_path, batch_id, partitioned = False)
+
+    hourly = batch_df.withColumn('hour', F.date_trunc('hour', F.col('call_datetime')))
+    self.commit_batch(hourly.groupby('call_date', 'hour', 'location_id').count(),
+      self.hourly_transactions_path, batch_id)
+    self.commit_batch(hll_sketch(hourly, ['call_date', 'hour', 'location_id'], self.sketch_precision),
+      self.hourly_sketches_path, batch_id)
+
+    batch_df.unpersist()
+
+  #Write a batch to a staging folder, then move its files into target with the
+  #batch id as prefix. Files of an earlier attempt at the same batch are
+  #deleted first, so a batch that is re-run after a failure is not duplicated
+  def commit_batch(self, df, target, batch_id, partitioned = True, bucketed = False):
+
+    staging = self.streaming_staging_path + "/" + os.path.basename(target) + "/" + str(batch_id)
+
+    if bucketed:
+      #bucketing needs a catalog table, keep the bucket ids in the file names
+      table = self.parquet_table + "_staging"
+      df.repartition(self.msisdn_buckets, "msisdn")\
+        .write.mode("overwrite").format("parquet")\
+        .partitionBy("call_date")\
+        .bucketBy(self.msisdn_buckets, "msisdn")\
+        .sortBy("msisdn", "call_datetime")\
+        .option("path", staging)\
+        .saveAsTable(table)
+      self.spark.sql("DROP TABLE IF EXISTS `{}`".format(table))
+    elif partitioned:
+      df.write.mode("overwrite").format("parquet").partitionBy("call_date").save(staging)
+    else:
+      df.write.mode("overwrite").format("parquet").save(staging)
+
+    #use the hadoop file system, which works both locally and on dbfs
+    Path = self.spark._jvm.org.apache.hadoop.fs.Path
+    fs = Path(target).getFileSystem(self.spark._jsc.hadoopConfiguration())
+    prefix = "batch-" + str(batch_id) + "-"
+    pattern = "/*/" if partitioned else "/"
+
+    for status in fs.globStatus(Path(target + pattern + prefix + "*")) or []:
+      fs.delete(status.getPath(), False)
+
+    for status in fs.globStatus(Path(staging + pattern + "part-*")) or []:
+      source = status.getPath()
+      folder = Path(target + "/" + source.getParent().getName()) if partitioned else Path(target)
+      fs.mkdirs(folder)
+      fs.rename(source, Path(folder, prefix + source.getName()))
+
+    fs.delete(Path(staging), True)
+
+    #files moved into the location of a catalog table are only read once the
+    #table is refreshed
+    if bucketed:
+      self.spark.sql("REFRESH TABLE `{}`".format(self.parquet_table))
+
+  #Unpersist the hourly transactions per region that priority aggregators in
+  #rollup mode share, once no aggregator of this datasource needs them
+  def release_hourly_transactions(self):
+    for partial in getattr(self, 'hourly_transactions', {}).values():
+      partial.unpersist()
+    self.hourly_transactions = {}
+
+  #Hourly transactions and unique subscribers per region of a tower map, from
+  #the hourly aggregates kept up to date by the streaming ingest. Regions are
+  #joined as in the flowminder queries, unique subscribers are estimated by
+  #merging the subscriber sketches of the towers in a region
+  def streaming_hourly_aggregates(self, regions):
+
+    cells = getattr(self, regions).select('cell_id', 'region')
+
+    transactions = self.spark.read.format("parquet").load(self.hourly_transactions_path)\
+      .join(cells, F.col('location_id') == F.col('cell_id'))\
+      .groupby('hour', 'region')\
+      .agg(F.sum('count').alias('count'))
+
+    sketches = self.spark.read.format("parquet").load(self.hourly_sketches_path)\
+      .join(cells, F.col('location_id') == F.col('cell_id'))
+    unique_subscribers = hll_estimate(sketches, ['hour', 'region'], self.sketch_precision)
+
+    return transactions, unique_subscribers
 
   #read the parquet file with vars
   def load_parquet_file_with_vars(self, region):
@@ -216,10 +403,10 @@ class DataSource:
  # Create sample
 
   #Create a sample and save to parquet
-  def sample_and_save(self, filestub = 'sample' , number_of_ids = 10000, seed_to_use = 510):
+  def sample_and_save(self, filestub = 'sample' , number_of_ids = 10000, seed_to_use = 510, **kwargs):
 
     #sample a df and save to self.sample_df
-    self.sample(number_of_ids,seed_to_use)
+    self.sample(number_of_ids,seed_to_use, ids_filestub = filestub + '_ids', **kwargs)
 
     #write sample file to parquet file and then load that sample into self.sample_df
     self.sample_df.write.mode('overwrite').parquet(self.standardize_path +"/"+ filestub)
@@ -227,17 +414,96 @@ class DataSource:
     return self.sample_df
 
   #Sample dataframe based on all records for sample of unique ids
-  def sample(self,number_of_ids = 10000, seed_to_use = 510, since_date = dt.datetime(2020,2,2) ):
-    #Get a list of all unique ids since since_date
-    self.unique_ids = [i.msisdn for i in self.parquet_df.where(F.col('call_datetime') < since_date).select('msisdn').distinct().collect()]
-
-    #Set seed and sample some ids from list of unique ids
-    seed(seed_to_use)
-    self.sample_ids = sample(self.unique_ids, number_of_ids)
+  #Ids are ranked by a hash of the id and the seed, so the same seed gives the
+  #same sample without collecting ids to the driver. Either keep the ids whose
+  #rank falls below fraction, or the number_of_ids lowest ranked ids. With
+  #stratify_by (a tower map, such as 'admin2_tower_map') each home region gets
+  #the same fraction, or a share of number_of_ids proportional to its ids.
+  #The ids are saved with the parameters of the sample, and a sample with the
+  #same parameters re-uses them. Pass resample = True after adding calls
+  #before since_date
+  def sample(self,number_of_ids = 10000, seed_to_use = 510, since_date = dt.datetime(2020,2,2),
+             fraction = None, stratify_by = None, ids_filestub = 'sample_ids',
+             resample = False):
+    ids_path = self.standardize_path + "/" + ids_filestub
+    #the key names a partition folder, so it has no colons
+    sample_key = '{}_{}_{}_{}'.format(seed_to_use, since_date.strftime('%Y%m%d%H%M%S'),
+      'fraction_' + str(fraction) if fraction is not None else 'ids_' + str(number_of_ids),
+      stratify_by)
+
+    self.sample_ids = None
+    if not resample:
+      try:
+        self.sample_ids = self.spark.read.format("parquet").load(ids_path)\
+          .where(F.col('sample_key') == sample_key).select('msisdn')
+        if self.sample_ids.limit(1).count() == 0:
+          self.sample_ids = None
+      except Exception as e:
+        self.sample_ids = None
+
+    if self.sample_ids is None:
+      self.create_sample_ids(ids_path, sample_key, number_of_ids, seed_to_use,
+                             since_date, fraction, stratify_by)
+    else:
+      print('Re-using sampled IDs in ' + ids_path)
 
     #Filter the full dataframe to only include the sampled IDs
-    self.sample_df = self.parquet_df.filter(self.parquet_df.msisdn.isin(self.sample_ids))
-    print('Successfully sampled all transactions for {} IDs'.format(number_of_ids))
+    self.sample_df = self.parquet_df.join(F.broadcast(self.sample_ids), 'msisdn', 'left_semi')\
+      .select(self.parquet_df.columns)
+    print('Successfully sampled all transactions for {} IDs'.format(self.sample_ids.count()))
+
+  def create_sample_ids(self, ids_path, sample_key, number_of_ids, seed_to_use,
+                        since_date, fraction, stratify_by):
+    #Get all unique ids before since_date, with a uniform rank in [0, 1)
+    #the call_date predicate skips the date partitions after since_date
+    ids = self.parquet_df.where((F.col('call_datetime') < since_date) & \
+      (F.col('call_date') <= F.to_date(F.lit(since_date))))
+    if stratify_by is not None:
+      ids = self.home_regions(ids, stratify_by)
+    else:
+      ids = ids.select('msisdn').distinct()
+    ids = ids.withColumn('sample_rank', F.pmod(F.xxhash64('msisdn', F.lit(seed_to_use)),
+                                               F.lit(2 ** 53)) / float(2 ** 53))
+
+    if fraction is not None:
+      self.sample_ids = ids.where(F.col('sample_rank') < fraction)
+    elif stratify_by is None:
+      #top k over partitions, only number_of_ids rows reach the driver
+      self.sample_ids = ids.orderBy('sample_rank', 'msisdn').limit(number_of_ids)
+    else:
+      #ids per home region are few rows, allocate the sample on the driver
+      sizes = ids.groupby('home_region').count().toPandas()
+      sizes['quota'] = (sizes['count'] * number_of_ids / sizes['count'].sum()).round().astype(int)
+      quotas = self.spark.createDataFrame(sizes[['home_region', 'quota']],
+                                          'home_region string, quota long')
+      region_window = Window.partitionBy('home_region').orderBy('sample_rank', 'msisdn')
+      self.sample_ids = ids\
+        .withColumn('rank_in_region', F.row_number().over(region_window))\
+        .join(F.broadcast(quotas), ids.home_region.eqNullSafe(quotas.home_region))\
+        .where(F.col('rank_in_region') <= F.col('quota'))\
+        .select('msisdn')
+
+    #Persist the sampled ids with their parameters, so the sample can be
+    #re-created and shared. They replace the ids of other parameters
+    self.sample_ids.select('msisdn', F.lit(sample_key).alias('sample_key'))\
+      .write.mode('overwrite').option('partitionOverwriteMode', 'static')\
+      .partitionBy('sample_key').parquet(ids_path)
+    self.sample_ids = self.spark.read.format("parquet").load(ids_path)\
+      .where(F.col('sample_key') == sample_key).select('msisdn')
+
+  #Home region of each id: the region of the tower map with most of its calls,
+  #the most recent one on ties. Ids only seen at unmapped towers have none
+  def home_regions(self, calls, regions):
+    tower_map = getattr(self, regions).select(F.col('cell_id').alias('location_id'), 'region')
+    region_window = Window.partitionBy('msisdn')\
+      .orderBy(F.desc('calls'), F.desc('latest_call'))
+    return calls\
+      .join(F.broadcast(tower_map), 'location_id', 'left')\
+      .groupby('msisdn', 'region')\
+      .agg(F.count('*').alias('calls'), F.max('call_datetime').alias('latest_call'))\
+      .withColumn('rank', F.row_number().over(region_window))\
+      .where(F.col('rank') == 1)\
+      .select('msisdn', F.col('region').cast('string').alias('home_region'))
 
   #Load a parquet sample
   def load_sample(self,  filestub = 'sample'):
@@ -1,7 +1,14 @@
 import os
+import hashlib
+import inspect
+import json
+import re
+import sys
+import threading
 if os.environ['HOME'] != '/root':
     from modules.DataSource import *
     from modules.sql_code_aggregates import *
+    from modules.utilities import *
     databricks = False
 else:
     databricks = True
@@ -20,7 +27,20 @@ class aggregator:
     cells : a pyspark dataframe. admin region to tower mapping
     spark : an initialised spark connection. spark connection this aggregator should use
     dates : a dictionary. dates the aggregator should run over
+    sql_inputs : a dictionary. Tables and views each sql query reads
     intermediate_tables : tables that we don't want written to csv
+    use_result_cache : a boolean. Whether to re-compute saved tables whose
+        fingerprint has changed, rather than skipping all saved tables
+    cache_manifest_path : a string. Path of the json file holding the
+        fingerprint of each saved table
+    max_workers : an integer. Number of indicators produced at once, more
+        than one runs them from an indicator_scheduler
+    manifest_lock : a lock. Serialises updates of the cache manifest by
+        indicators running at once
+    dimension_tables : a list. Names of the datasource tables, other than
+        the tower map, that results depend on (weights, incidence, distances)
+    code_modules : a list. Helper modules whose source is part of the
+        fingerprint, next to the modules defining the aggregator
 
 
     Methods
@@ -31,15 +51,41 @@ class aggregator:
     create_view(df, table_name)
         Creates a view of a dataframe
 
+    sql_table(table_name)
+        Runs a sql query, after creating views of the queries it reads
+
     save(table_name)
-      Repartitions a dataframe into a single partition and writes it to a csv file
+      Writes a dataframe to a folder of csv parts, one per partition, in parallel
+
+    save_and_report(df, table_name, indicator = None)
+        Checks whether csv file exists and is up to date before saving
+        table_name to csv
+
+    fingerprint(table_name, indicator = None)
+        hashes everything a table depends on: indicator and code, dates,
+        tower map, dimension tables, input files within the dates and
+        parameters
+
+    code_hash()
+        hashes the source of the aggregator modules and the helper modules
+        indicators call
+
+    table_hash(table)
+        hashes the content of a small table, independent of row order
 
-    save_and_report(table_name)
-        Checks whether csv file exists before saving table_name to csv
+    is_stale(table_name, indicator = None)
+        checks whether a saved table was produced with a different fingerprint
+
+    record_fingerprint(table_name, indicator = None)
+        stores the fingerprint of a saved table in the cache manifest
+
+    remove_result(table_name)
+        deletes the saved csv and folder of a table
 
     rename_csv(table_name)
         - rename a specific csv
-        - move a csv to parent folder, rename it, then delete its remaining folder
+        - merge the csv parts into one csv in the parent folder, then delete
+          the folder of parts
 
     rename_all_csvs(table_name)
         renames all csvs at once
@@ -58,7 +104,8 @@ class aggregator:
                  result_stub,
                  datasource,
                  regions,
-                 intermediate_tables = ['home_locations']):
+                 intermediate_tables = ['home_locations',
+                                        'subscriber_locations']):
         """
         Parameters
         ----------
@@ -81,8 +128,18 @@ class aggregator:
                                        end_date = self.dates_sql['end_date'],
                                        start_date_weeks = self.dates_sql['start_date_weeks'],
                                        end_date_weeks = self.dates_sql['end_date_weeks'])
+        self.sql_inputs = write_sql_inputs()
         self.table_names = self.sql_code.keys()
         self.intermediate_tables = intermediate_tables
+        self.use_result_cache = True
+        self.cache_manifest_path = os.path.join(self.result_path,
+            '_fingerprints.json')
+        self.max_workers = 1
+        self.manifest_lock = threading.Lock()
+        self.dimension_tables = []
+        self.code_modules = ['modules.utilities', 'modules.kernels',
+                             'modules.sketches', 'modules.distances',
+                             'modules.sql_code_aggregates']
 
     def create_sql_dates(self):
         self.dates_sql = {'start_date' : "\'" + self.dates['start_date'].isoformat('-')[:10] +  "\'",
@@ -93,38 +150,47 @@ class aggregator:
     def create_view(self, df, table_name):
       df.createOrReplaceTempView(table_name)
 
+    def sql_table(self, table_name):
+      for input_table in self.sql_inputs.get(table_name, []):
+        if input_table in self.sql_code:
+          self.create_view(self.sql_table(input_table), input_table)
+      return self.spark.sql(self.sql_code[table_name])
+
     def save(self, df, table_name):
-      df.repartition(1).write.mode('overwrite').format('com.databricks.spark.csv') \
+      df.write.mode('overwrite').format('com.databricks.spark.csv') \
         .save(os.path.join(self.result_path, table_name), header = 'true')
 
-    def save_and_report(self, df, table_name):
+    def save_and_report(self, df, table_name, indicator = None):
       if table_name not in self.intermediate_tables:
-        if self.check_if_file_exists(table_name):
-            print('Skipped: ' + table_name)
-        else:
+        if not self.check_if_file_exists(table_name):
             print('--> File does not exist. Saving: ' + table_name)
             self.save(df, table_name)
-      else:
-        print('Caching: home_locations')
-        df.createOrReplaceTempView("home_locations")
-        self.spark.sql('CACHE TABLE home_locations').collect()
+            self.record_fingerprint(table_name, indicator)
+        elif self.is_stale(table_name, indicator):
+            print('--> Inputs changed. Re-saving: ' + table_name)
+            self.remove_result(table_name)
+            self.save(df, table_name)
+            self.record_fingerprint(table_name, indicator)
+        else:
+            print('Skipped: ' + table_name)
+      elif not df.is_cached:
+        print('Caching: ' + table_name)
+        df = df.persist()
       self.create_view(df, table_name)
       return table_name
 
     def rename_csv(self, table_name):
-      # move one folder up and rename to human-legible .csv name
+      # merge parts into a human-legible .csv one folder up
+      merge_csv_parts(self.result_path + '/' + table_name,
+                      self.result_path + '/' + table_name + '.csv')
+      # remove the old folder
       if databricks:
-          dbutils.fs.mv(dbutils.fs.ls(self.result_path + '/' + table_name)[-1].path,
-                  self.result_path + '/' + table_name + '.csv')
-          # remove the old folder
           dbutils.fs.rm(self.result_path + '/' + table_name + '/', recurse = True)
       else:
-          os.rename(glob.glob(os.path.join(self.result_path, table_name + '/*.csv'))[0],
-                            os.path.join(self.result_path, table_name + '.csv'))
           shutil.rmtree(os.path.join(self.result_path, table_name))
 
-    def save_and_rename_one(self, df, table_name):
-      self.rename_if_not_existing(self.save_and_report(df, table_name))
+    def save_and_rename_one(self, df, table_name, indicator = None):
+      self.rename_if_not_existing(self.save_and_report(df, table_name, indicator))
 
     def rename_all_csvs(self):
       for table_name in self.table_names:
@@ -176,3 +242,153 @@ class aggregator:
         else:
             return os.path.exists(self.result_path + '/' + table_name) | \
                    os.path.exists(self.result_path + '/' + table_name + '.csv')
+
+    ######################################
+    # Result cache
+
+    # Hash of everything a table depends on. Flowminder tables depend on their
+    # sql code, all tables on the source of the modules defining the
+    # aggregator and its helpers, so any code change re-computes all tables.
+    # Code that isn't in a module file (e.g. defined in a notebook) can't be
+    # hashed: after changing it, remove the saved tables (remove_result) to
+    # re-compute them
+    def fingerprint(self, table_name, indicator = None):
+      key = {
+        'table_name' : table_name,
+        'indicator' : indicator,
+        'code' : self.sql_code.get(table_name),
+        'dates' : {k : str(v) for k, v in sorted(self.dates.items())},
+        'modules' : self.code_hash(),
+        'tower_map' : self.tower_map_hash(),
+        'dimension_tables' : {name : self.table_hash(name) for name in
+          self.dimension_tables if getattr(self.datasource, name, None) \
+          is not None},
+        'input_files' : self.input_snapshot(),
+        'parameters' : {k : getattr(self, k, None) for k in
+          ['privacy_filter', 'missing_value_code', 'cutoff_days', 'max_duration',
+           'approx_distinct', 'approx_distinct_error', 'window_engine',
+           'rollup', 'fused']}}
+      return hashlib.sha1(json.dumps(key, sort_keys = True, default = str)\
+        .encode('utf-8')).hexdigest()
+
+    # the tower map is small, so we hash its content once
+    def tower_map_hash(self):
+      if not hasattr(self, '_tower_map_hash'):
+        cells = self.cells.toPandas()
+        cells = cells.sort_values(list(cells.columns)).to_csv(index = False)
+        self._tower_map_hash = hashlib.sha1(cells.encode('utf-8')).hexdigest()
+      return self._tower_map_hash
+
+    # the source of every module the aggregator class and its parents are
+    # defined in, and of the helper modules, hashed once
+    def code_hash(self):
+      if not hasattr(self, '_code_hash'):
+        names = [c.__module__ for c in type(self).__mro__ if c is not object]
+        sources = []
+        for name in sorted(set(names + self.code_modules)):
+          try:
+            sources.append(name + '\n' + inspect.getsource(sys.modules[name]))
+          except Exception:
+            # no source available, e.g. for code defined in a notebook
+            sources.append(name)
+        self._code_hash = hashlib.sha1('\n'.join(sources).encode('utf-8'))\
+          .hexdigest()
+      return self._code_hash
+
+    # dimension tables are hashed once each. Spark tables are hashed in spark,
+    # as the sum of a hash per row, since the distance matrix can be large
+    def table_hash(self, name):
+      if not hasattr(self, '_table_hashes'):
+        self._table_hashes = {}
+      if name not in self._table_hashes:
+        table = getattr(self.datasource, name)
+        if isinstance(table, pd.DataFrame):
+          content = table.sort_values(list(table.columns))\
+            .to_csv(index = False)
+        else:
+          content = str(table.select(F.count(F.lit(1)),
+            F.sum(F.xxhash64(*table.columns).cast('decimal(38,0)')))\
+            .collect()[0])
+        self._table_hashes[name] = hashlib.sha1(content.encode('utf-8'))\
+          .hexdigest()
+      return self._table_hashes[name]
+
+    # spark names every file it writes uniquely, so the list of input files
+    # identifies a snapshot of the cdr data (and of the vars parquet, if any).
+    # Indicators only read the dates of the aggregator, so files of call_date
+    # partitions outside them are left out: appending later dates doesn't
+    # re-compute anything until the dates are extended. Since every indicator
+    # covers all dates, extending them, or rewriting a partition within them,
+    # re-computes all tables
+    def input_snapshot(self):
+      if not hasattr(self, '_input_snapshot'):
+        files = set(self.calls.inputFiles())
+        if hasattr(self, 'df'):
+          files = files | set(self.df.inputFiles())
+        files = [f for f in files if self.in_dates(f)]
+        self._input_snapshot = hashlib.sha1(
+          '\n'.join(sorted(files)).encode('utf-8')).hexdigest()
+      return self._input_snapshot
+
+    # whether a file is in a call_date partition within the dates (or not in
+    # a partition at all). The filters include the day after the end date
+    def in_dates(self, path):
+      partition = re.search(r'call_date=(\d{4}-\d{2}-\d{2})', path)
+      if partition is None:
+        return True
+      first = min(pd.Timestamp(self.dates['start_date']),
+                  pd.Timestamp(self.dates['start_date_weeks'])).date()
+      last = (max(pd.Timestamp(self.dates['end_date']),
+                  pd.Timestamp(self.dates['end_date_weeks'])) + \
+              dt.timedelta(1)).date()
+      return first <= dt.date.fromisoformat(partition.group(1)) <= last
+
+    def read_cache_manifest(self):
+      if databricks:
+        try:
+          return json.loads(dbutils.fs.head(self.cache_manifest_path, 10 ** 8))
+        except Exception as e:
+          if 'java.io.FileNotFoundException' in str(e):
+            return {}
+          else:
+            raise
+      else:
+        if not os.path.exists(self.cache_manifest_path):
+          return {}
+        with open(self.cache_manifest_path) as manifest:
+          return json.load(manifest)
+
+    def write_cache_manifest(self, manifest):
+      if databricks:
+        dbutils.fs.put(self.cache_manifest_path, json.dumps(manifest,
+          indent = 2, sort_keys = True), overwrite = True)
+      else:
+        os.makedirs(self.result_path, exist_ok = True)
+        with open(self.cache_manifest_path, 'w') as f:
+          json.dump(manifest, f, indent = 2, sort_keys = True)
+
+    # tables saved before fingerprints were recorded are never stale
+    def is_stale(self, table_name, indicator = None):
+      if not self.use_result_cache:
+        return False
+      stored = self.read_cache_manifest().get(table_name)
+      return (stored is not None) and \
+        (stored != self.fingerprint(table_name, indicator))
+
+    def record_fingerprint(self, table_name, indicator = None):
+      if self.use_result_cache:
+        fingerprint = self.fingerprint(table_name, indicator)
+        with self.manifest_lock:
+          manifest = self.read_cache_manifest()
+          manifest[table_name] = fingerprint
+          self.write_cache_manifest(manifest)
+
+    def remove_result(self, table_name):
+      if databricks:
+        dbutils.fs.rm(self.result_path + '/' + table_name, recurse = True)
+        dbutils.fs.rm(self.result_path + '/' + table_name + '.csv')
+      else:
+        if os.path.exists(os.path.join(self.result_path, table_name)):
+          shutil.rmtree(os.path.join(self.result_path, table_name))
+        if os.path.exists(os.path.join(self.result_path, table_name + '.csv')):
+          os.remove(os.path.join(self.result_path, table_name + '.csv'))
@@ -0,0 +1,213 @@
+# Load modules depending whether we are on docker or on databricks
+import os
+import json
+import resource
+import urllib.request
+if os.environ['HOME'] != '/root':
+    from modules.import_packages import *
+    from modules.utilities import *
+    from modules.flowminder_aggregator import *
+    from modules.priority_aggregator import *
+    from modules.scaled_aggregator import *
+    databricks = False
+else:
+    databricks = True
+
+class benchmark:
+    """Class to time the indicators of the aggregators, for instance on data
+    from synthetic_cdr.
+
+    Every indicator runs in its own spark job group and is fully computed
+    without writing results, using the noop data source. Shuffle bytes and
+    peak executor memory of the jobs in the group are read from the spark
+    monitoring REST API.
+
+
+    Attributes
+    ----------
+    datasource : an instance of DataSource class. Holds the (synthetic) calls,
+        tower maps, distances and weights
+    spark : an initialised spark connection
+    result_path : a string. Where to save the benchmark results
+    levels : a list. Admin levels to run the aggregators for
+    frequencies : a list. Frequencies to run priority indicators for
+    window_engine : a string. Window engine of the priority aggregators,
+        recorded with every measurement so that engines can be compared
+    results : a list. One dictionary of measurements per timed step
+
+    Methods
+    -------
+    run(aggregators = ['flowminder', 'priority', 'scaled'])
+        time all indicators of the aggregators for all levels and frequencies
+
+    run_flowminder(level)
+        time the flowminder sql queries
+
+    run_priority(aggregator_class, name, level)
+        time the indicators in the plan of a priority aggregator
+
+    time_indicator(df, name, **labels)
+        computes a dataframe and records time, rows/sec, shuffle bytes,
+            stages and peak memory
+
+    job_metrics(job_group)
+        sums shuffle bytes, counts stages and stages writing shuffle files,
+            and takes peak memory over the stages of a job group
+
+    rest(endpoint)
+        reads an endpoint of the spark monitoring REST API
+
+    save_results(filename = 'benchmark')
+        saves the measurements to a csv file
+
+    """
+
+    def __init__(self,
+                 datasource,
+                 result_stub = '/benchmark',
+                 levels = ['admin2', 'admin3'],
+                 frequencies = ['hour', 'day', 'week', 'month'],
+                 window_engine = 'spark'):
+        """
+        Parameters
+        ----------
+        datasource : holds all dataframes and paths required
+        result_stub : where to save benchmark results and indicators
+        levels : admin levels to benchmark
+        frequencies : frequencies to benchmark priority indicators for
+        window_engine : 'spark', 'stays' or 'pandas', see priority_aggregator
+        """
+        self.datasource = datasource
+        self.spark = datasource.spark
+        self.result_stub = result_stub
+        self.result_path = datasource.results_path + result_stub
+        self.levels = levels
+        self.frequencies = frequencies
+        self.window_engine = window_engine
+        self.results = []
+
+    def run(self, aggregators = ['flowminder', 'priority', 'scaled']):
+      for level in self.levels:
+        if 'flowminder' in aggregators:
+          self.run_flowminder(level)
+        if 'priority' in aggregators:
+          self.run_priority(priority_aggregator, 'priority', level)
+        if 'scaled' in aggregators:
+          self.run_priority(scaled_aggregator, 'scaled', level)
+      return self.save_results()
+
+    def run_flowminder(self, level):
+      agg = flowminder_aggregator(
+        result_stub = self.result_stub + '/' + level + '/flowminder',
+        datasource = self.datasource,
+        regions = level + '_tower_map')
+      input_rows = agg.calls.count()
+      # queries read the results of other queries from a cached view, which
+      # is released once the last query reading it has been timed, so that
+      # it doesn't take memory from the queries timed after that
+      agg.pending_consumers = {table_name : set(agg.consumers(table_name))
+                               for table_name in agg.table_names}
+      try:
+        for table_name in agg.dependency_order():
+          frequency = table_name.split('_')[-1]
+          frequency = frequency if frequency in ['day', 'week'] else None
+          df = self.spark.sql(agg.sql_code[table_name])
+          if agg.pending_consumers[table_name]:
+            df = df.persist()
+            agg.cached_tables[table_name] = df
+          self.time_indicator(df, table_name, aggregator = 'flowminder',
+            level = level, frequency = frequency, indicator = table_name,
+            input_rows = input_rows)
+          df.createOrReplaceTempView(table_name)
+          agg.consumed(table_name)
+      finally:
+        for table_name in list(agg.cached_tables):
+          agg.release_table(table_name)
+
+    def run_priority(self, aggregator_class, name, level):
+      # creating the vars parquet is part of the cost of priority indicators
+      start = time.time()
+      agg = aggregator_class(
+        result_stub = self.result_stub + '/' + level + '/' + name,
+        datasource = self.datasource,
+        regions = level + '_tower_map',
+        re_create_vars = True)
+      agg.window_engine = self.window_engine
+      self.results.append({'aggregator' : name, 'level' : level,
+        'table_name' : 'vars', 'seconds' : time.time() - start})
+      for frequency in self.frequencies:
+        time_filter = agg.period_filter if frequency in ['hour', 'day'] \
+          else agg.weeks_filter
+        input_rows = agg.filter_df(time_filter).count()
+        for table_name, indicator, kwargs in agg.indicator_plan(frequency):
+          df = getattr(agg, indicator)(time_filter, frequency, **kwargs)
+          self.time_indicator(df, table_name, aggregator = name,
+            level = level, frequency = frequency, indicator = indicator,
+            input_rows = input_rows, window_engine = self.window_engine)
+
+    def time_indicator(self, df, name, **labels):
+      job_group = name + '_' + str(len(self.results))
+      self.spark.sparkContext.setJobGroup(job_group, name)
+      print('Timing: ' + name)
+      start = time.time()
+      df.write.format('noop').mode('overwrite').save()
+      seconds = time.time() - start
+      result = dict(labels, table_name = name, seconds = seconds)
+      if labels.get('input_rows'):
+        result['rows_per_second'] = labels['input_rows'] / seconds
+      result.update(self.job_metrics(job_group))
+      # ru_maxrss is in kilobytes on linux
+      result['peak_driver_rss_bytes'] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+      self.results.append(result)
+      return result
+
+    def job_metrics(self, job_group):
+      metrics = {'shuffle_read_bytes' : 0, 'shuffle_write_bytes' : 0,
+                 'stages' : 0, 'shuffle_stages' : 0,
+                 'peak_jvm_heap_bytes' : None}
+      # the REST API is updated asynchronously by the listener bus
+      time.sleep(1)
+      try:
+        stage_ids = set()
+        for job in self.rest('jobs'):
+          if job.get('jobGroup') == job_group:
+            stage_ids.update(job['stageIds'])
+        for stage in self.rest('stages'):
+          if stage['stageId'] not in stage_ids:
+            continue
+          metrics['shuffle_read_bytes'] += stage.get('shuffleReadBytes', 0)
+          metrics['shuffle_write_bytes'] += stage.get('shuffleWriteBytes', 0)
+          # stages skipped because their shuffle files already exist are
+          # listed as well, only count the ones that ran
+          if stage.get('status') != 'SKIPPED':
+            metrics['stages'] += 1
+            if stage.get('shuffleWriteBytes', 0) > 0:
+              metrics['shuffle_stages'] += 1
+          # peak executor metrics per stage are reported from spark 3.1
+          heap = stage.get('peakExecutorMetrics', {}).get('JVMHeapMemory')
+          if heap is not None:
+            metrics['peak_jvm_heap_bytes'] = max(
+              metrics['peak_jvm_heap_bytes'] or 0, heap)
+        # otherwise fall back on the peak of the executors so far
+        if metrics['peak_jvm_heap_bytes'] is None:
+          metrics['peak_jvm_heap_bytes'] = max(
+            [e.get('peakMemoryMetrics', {}).get('JVMHeapMemory', 0)
+             for e in self.rest('executors')] or [None])
+      except Exception as e:
+        print('Could not read spark metrics:', e)
+      return metrics
+
+    def rest(self, endpoint):
+      sc = self.spark.sparkContext
+      url = '{}/api/v1/applications/{}/{}'.format(
+        sc.uiWebUrl, sc.applicationId, endpoint)
+      with urllib.request.urlopen(url) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+    def save_results(self, filename = 'benchmark'):
+      results = pd.DataFrame(self.results)
+      os.makedirs(local_path(self.result_path), exist_ok = True)
+      results.to_csv(local_path(os.path.join(self.result_path,
+        filename + '.csv')), index = False)
+      return results
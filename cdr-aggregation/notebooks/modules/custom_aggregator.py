@@ -26,10 +26,16 @@ class custom_aggregator(priority_aggregator):
                  result_stub,
                  datasource,
                  regions,
-                 re_create_vars = False):
+                 re_create_vars = False,
+                 append_vars = False):
 
         # initiate with parent init
-        super().__init__(result_stub,datasource,regions)
+        super().__init__(result_stub,datasource,regions,re_create_vars,
+            append_vars)
+
+        self.dimension_tables += ['admin2_incidence',
+          'admin3_cholera_incidence_total', 'admin3_cholera_incidence_monthly',
+          'admin3_cholera_incidence_weekly']
 
         # for admin 2, we also have an incidence file
         if self.level == 'admin2':
@@ -45,14 +51,14 @@ class custom_aggregator(priority_aggregator):
 # not yet very detailed.
 
     def origin_destination_matrix(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .where(F.col('region_lag') != F.col('region'))\
         .groupby(frequency, 'region', 'region_lag')\
         .agg(F.count(F.col('msisdn')).alias('count'))
       return result
 
     def origin_destination_unique_users_matrix(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .where(F.col('region_lag') != F.col('region'))\
         .groupby(frequency, 'region', 'region_lag')\
         .agg(F.countDistinct(F.col('msisdn')).alias('count'))
@@ -62,7 +68,7 @@ class custom_aggregator(priority_aggregator):
       user_day_window = Window.partitionBy('msisdn', 'call_date')
       user_day_night_window = Window.partitionBy('msisdn',
         'home_region', 'call_date', frequency).orderBy('day_night')
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .withColumn('day_night',
             F.when((F.col('hour_of_day') < 9) | (F.col('hour_of_day') > 17),
             1).otherwise(0))\
@@ -95,13 +101,10 @@ class custom_aggregator(priority_aggregator):
       return result
 
     def median_distance(self, time_filter, frequency):
-      prep = self.df.where(time_filter)
+      prep = self.filter_df(time_filter)
       prep = prep.withColumn('location_id_lag',
         F.lag('location_id').over(user_window))
-      prep = prep.join(self.distances_df,
-             (prep.location_id==self.distances_df.destination) &\
-             (prep.location_id_lag==self.distances_df.origin),
-             'left')\
+      prep = self.join_distances(prep)\
         .groupby('msisdn', 'home_region', frequency)\
         .agg(F.sum('distance').alias('distance'))
       prep.createOrReplaceTempView("df")
@@ -111,7 +114,7 @@ class custom_aggregator(priority_aggregator):
       return result
 
     def different_areas_visited(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .groupby('msisdn', 'home_region', frequency)\
         .agg(F.countDistinct(F.col('region')).alias('distinct_regions_visited'))\
         .groupby('home_region', frequency)\
@@ -119,7 +122,7 @@ class custom_aggregator(priority_aggregator):
       return result
 
     def only_in_one_region(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .groupby('msisdn', 'home_region', frequency)\
         .agg(F.countDistinct('region').alias('region_count'))\
         .where(F.col('region_count') == 1)\
@@ -135,7 +138,7 @@ class custom_aggregator(priority_aggregator):
       window_into_the_past = Window.orderBy(F.col('frequency_sec'))\
         .partitionBy('msisdn')\
         .rangeBetween(Window.unboundedPreceding, Window.currentRow)
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .orderBy(F.col(frequency))\
         .withColumn('frequency_sec', F.col(frequency).cast("long"))\
         .withColumn('new_sim',
@@ -155,7 +158,7 @@ class custom_aggregator(priority_aggregator):
         .partitionBy('msisdn').orderBy('stop_number')
       user_window_incidence_rev = Window\
         .partitionBy('msisdn').orderBy(F.desc_nulls_last('stop_number'))
-      result = self.df\
+      stops = self.df\
         .withColumn('call_datetime_lag',
             F.when(F.col('call_datetime_lag').isNull(),
             self.dates['start']).otherwise(F.col('call_datetime_lag')))\
@@ -171,8 +174,9 @@ class custom_aggregator(priority_aggregator):
             (F.col('day') > incubation_period_start))\
         .groupby('msisdn', 'day', 'region')\
         .agg(F.sum('duration').alias('total_duration'),
-             F.max('stop_number').alias('stop_number'))\
-        .join(self.incidence, 'region', 'left')\
+             F.max('stop_number').alias('stop_number'))
+      result = join_dimension(stops, self.incidence, 'region',
+          name = 'incidence')\
         .withColumn('accumulated_incidence',
             F.col('incidence') * F.col('total_duration') / (21 * 24 * 60 * 60))\
         .withColumn('last_stop',
@@ -194,13 +198,17 @@ class custom_aggregator(priority_aggregator):
                                             incubation_period_start =\
                                             dt.datetime(2020,3,8),
                                             **kwargs):
+      if self.window_engine == 'pandas':
+        return self.accumulated_incidence_imported_only_pandas(time_filter,
+          incubation_period_end, incubation_period_start)
+
       user_window_prep = Window\
         .partitionBy('msisdn').orderBy('call_datetime')
       user_window_incidence = Window\
         .partitionBy('msisdn').orderBy('stop_number')
       user_window_incidence_rev = Window\
         .partitionBy('msisdn').orderBy(F.desc_nulls_last('stop_number'))
-      result = self.df.orderBy('call_datetime')\
+      stops = self.df.orderBy('call_datetime')\
         .withColumn('call_datetime_lead',
             F.when(F.col('call_datetime_lead').isNull(),
             self.dates['end_date']).otherwise(F.col('call_datetime_lead')))\
@@ -212,8 +220,9 @@ class custom_aggregator(priority_aggregator):
             (F.col('day') > incubation_period_start))\
         .groupby('msisdn', 'day', 'region')\
         .agg(F.sum('duration').alias('total_duration'),
-             F.max('stop_number').alias('stop_number'))\
-        .join(self.incidence, 'region', 'left')\
+             F.max('stop_number').alias('stop_number'))
+      result = join_dimension(stops, self.incidence, 'region',
+          name = 'incidence')\
         .withColumn('accumulated_incidence',
             F.col('incidence') * F.col('total_duration') / (21 * 24 * 60 * 60))\
         .withColumn('last_stop',
@@ -256,13 +265,48 @@ class custom_aggregator(priority_aggregator):
         .agg(F.sum('imported_incidence').alias('imported_incidence'))
       return result
 
+    # The same in one pass per subscriber, see imported_incidence_kernel. The
+    # incidence table is small, so it is collected and joined in the kernel
+    def accumulated_incidence_imported_only_pandas(self,
+                                                   time_filter,
+                                                   incubation_period_end = \
+                                                   dt.datetime(2020,3,30),
+                                                   incubation_period_start =\
+                                                   dt.datetime(2020,3,8)):
+      prep = self.df\
+        .select('msisdn', 'region',
+            F.col('call_datetime').cast('long').alias('call_datetime_long'),
+            F.coalesce(F.col('call_datetime_lead'),
+              F.lit(self.dates['end_date'])).cast('long')\
+              .alias('call_datetime_lead_long'),
+            F.col('day').cast('long').alias('day_long'),
+            ((F.col('day') < incubation_period_end) & \
+             (F.col('day') > incubation_period_start)).alias('in_period'))
+
+      incidence = self.incidence\
+        .select(F.col('region').cast(prep.schema['region'].dataType),
+                F.col('incidence').cast('double'))\
+        .toPandas()
+      schema = StructType([prep.schema['region'],
+        StructField('imported_incidence', DoubleType())])
+
+      def kernel(pdf):
+        return imported_incidence_kernel(pdf, incidence)
+
+      result = prep\
+        .groupby('msisdn')\
+        .applyInPandas(kernel, schema)\
+        .groupby('region')\
+        .agg(F.sum('imported_incidence').alias('imported_incidence'))
+      return result
+
     def origin_destination_matrix_time_longest_only(self,
                                                     time_filter,
                                                     frequency):
       user_frequency_window = Window\
                                 .partitionBy('msisdn', frequency)\
                                 .orderBy('call_datetime')
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .where((F.col('region_lag') != F.col('region')) | \
         (F.col('region_lead') != F.col('region')))\
         .withColumn('duration_lead',
@@ -302,7 +346,7 @@ class custom_aggregator(priority_aggregator):
           .groupby('home_region')\
           .agg(F.countDistinct('msisdn2').alias('home_location_count'))\
           .withColumnRenamed('home_region', 'home_region2')
-        prep = self.df.where(time_filter)\
+        prep = self.filter_df(time_filter)\
           .withColumn('first_observation', F.first('call_datetime').over(user_window))\
           .where(F.col('first_observation') < exlusion_start)\
           .drop('home_region')
@@ -343,15 +387,11 @@ class custom_aggregator(priority_aggregator):
     # - multiply imported incidence by duration in region
     # - group by day and region and sum
     #
-    # If we want incidence spread out:
-    # - calculate the number of days a person stays in region / number of new rows needed
-    # - calculate the remainder time for the last day
-    # - make an array to fill the duration column
-    # - explode the array into number of rows needed
-    # - add a number of day to the date for each row that was exploded
-    # - for the last of the exloded rows per user, replace duration with remainder
-    # - calculate total incidence imported for the day by duration * incidence
-    # - for the above, use the variable depending on how far into our stay we are
+    # If we want incidence spread out (see spread_over_days):
+    # - for each day a stay can span, get the time the stay overlaps with that
+    #   calendar day
+    # - calculate incidence imported on that day by overlap * incidence, using
+    #   the variable depending on how far into our stay we are
     # - group by day and region and sum
 
     def accumulated_cholera_incidence_imported_only(self,
@@ -366,59 +406,75 @@ class custom_aggregator(priority_aggregator):
       user_window = Window\
         .partitionBy('msisdn').orderBy('call_datetime')
 
-      prep = self.df.where(time_filter)\
-        .withColumn('call_datetime_long', F.col('call_datetime').cast('long'))\
-        .where((F.col('region_lag') != F.col('region')) | \
-            (F.col('region_lead') != F.col('region')) | \
-            (F.col('call_datetime_lead').isNull()))\
-        .withColumn('call_datetime_lead',
-            F.when(F.col('call_datetime_lead').isNull(),
-            self.dates['end_date'] + dt.timedelta(1)).otherwise(F.col('call_datetime_lead')))\
-        .withColumn('duration', (F.col('call_datetime_lead').cast('long') - \
-            F.col('call_datetime').cast('long')))\
-        .withColumn('duration', F.when(F.col('duration') <= \
-            (self.cutoff_days * 24 * 60 * 60), F.col('duration')).otherwise(self.cutoff_days))\
-        .withColumn('duration_next', F.lead('duration').over(user_window))\
-        .withColumn('duration_change_only', F.when(F.col('region') == \
-            F.col('region_lead'), F.col('duration_next') + \
-            F.col('duration')).otherwise(F.col('duration')))\
-        .where(F.col('region_lag') != F.col('region'))
+      if self.window_engine == 'stays':
+        prep = self.stay_change_durations(time_filter,
+            long_gap_duration = self.cutoff_days)\
+          .withColumn('call_datetime_long', F.col('call_datetime').cast('long'))\
+          .where(F.col('region_lag') != F.col('region'))
+      else:
+        prep = self.filter_df(time_filter)\
+          .withColumn('call_datetime_long', F.col('call_datetime').cast('long'))\
+          .where((F.col('region_lag') != F.col('region')) | \
+              (F.col('region_lead') != F.col('region')) | \
+              (F.col('call_datetime_lead').isNull()))\
+          .withColumn('call_datetime_lead',
+              F.when(F.col('call_datetime_lead').isNull(),
+              self.dates['end_date'] + dt.timedelta(1)).otherwise(F.col('call_datetime_lead')))\
+          .withColumn('duration', (F.col('call_datetime_lead').cast('long') - \
+              F.col('call_datetime').cast('long')))\
+          .withColumn('duration', F.when(F.col('duration') <= \
+              (self.cutoff_days * 24 * 60 * 60), F.col('duration')).otherwise(self.cutoff_days))\
+          .withColumn('duration_next', F.lead('duration').over(user_window))\
+          .withColumn('duration_change_only', F.when(F.col('region') == \
+              F.col('region_lead'), F.col('duration_next') + \
+              F.col('duration')).otherwise(F.col('duration')))\
+          .where(F.col('region_lag') != F.col('region'))
 
       if incidence_frequency == 'total':
         self.incidence = getattr(self.datasource, 'admin3_cholera_incidence_total')
-        join_condition = (prep.region == self.incidence.ward)
+        keys = (['region'], ['ward'])
       elif incidence_frequency == 'monthly':
         self.incidence = getattr(self.datasource, 'admin3_cholera_incidence_monthly')
-        join_condition = ((prep.region == self.incidence.ward) &\
-                          (prep.month == self.incidence.case_month))
+        keys = (['region', 'month'], ['ward', 'case_month'])
       elif incidence_frequency == 'weekly':
         self.incidence = getattr(self.datasource, 'admin3_cholera_incidence_weekly')
-        join_condition = ((prep.region == self.incidence.ward) &\
-                          (prep.week == self.incidence.case_week))
+        keys = (['region', 'week'], ['ward', 'case_week'])
 
 
-      result = prep\
-        .join(self.incidence, join_condition, 'left')\
+      result = join_dimension(prep, self.incidence, *keys, name = 'incidence')\
         .na.fill({'incidence' : 0})\
         .withColumn('incidence_duration',
             F.col('incidence') * F.col('duration_change_only'))\
         .na.fill({'incidence_duration' : 0})
 
-      for days in range(10):
+      # all ten shifted windows in one pass per subscriber, with prefix sums
+      if self.window_engine == 'pandas':
+        schema = StructType(result.schema.fields + \
+          [StructField('imported_incidence_' + str(days), DoubleType())
+           for days in range(10)])
 
-          user_infection_pickup_window = Window\
-              .partitionBy('msisdn').orderBy('call_datetime_long')\
-              .rangeBetween(start_infectious_window + (days * 24 * 60 * 60),end_infectious_window)
+        def kernel(pdf):
+          return infectious_window_kernel(pdf, start_infectious_window,
+            end_infectious_window)
 
-          result = result\
-            .withColumn('incidence_list',
-                F.collect_list('incidence_duration').over(user_infection_pickup_window))\
-            .withColumn('region_list',
-                F.collect_list('region').over(user_infection_pickup_window))\
-            .withColumn('zip', F.arrays_zip(F.col('region_list'), F.col('incidence_list')))\
-            .withColumn('filtered_zip', F.expr("filter(zip, x -> x['region_list'] != region)"))\
-            .withColumn('filtered_incidence', F.col("filtered_zip").getField('incidence_list'))\
-            .withColumn('imported_incidence_' + str(days), F.expr('AGGREGATE(filtered_incidence, DOUBLE(0), (acc, x) -> acc + x)'))
+        result = result.groupby('msisdn').applyInPandas(kernel, schema)
+
+      else:
+        for days in range(10):
+
+            user_infection_pickup_window = Window\
+                .partitionBy('msisdn').orderBy('call_datetime_long')\
+                .rangeBetween(start_infectious_window + (days * 24 * 60 * 60),end_infectious_window)
+
+            result = result\
+              .withColumn('incidence_list',
+                  F.collect_list('incidence_duration').over(user_infection_pickup_window))\
+              .withColumn('region_list',
+                  F.collect_list('region').over(user_infection_pickup_window))\
+              .withColumn('zip', F.arrays_zip(F.col('region_list'), F.col('incidence_list')))\
+              .withColumn('filtered_zip', F.expr("filter(zip, x -> x['region_list'] != region)"))\
+              .withColumn('filtered_incidence', F.col("filtered_zip").getField('incidence_list'))\
+              .withColumn('imported_incidence_' + str(days), F.expr('AGGREGATE(filtered_incidence, DOUBLE(0), (acc, x) -> acc + x)'))
 
       if import_in_one_day:
         result = result\
@@ -428,55 +484,41 @@ class custom_aggregator(priority_aggregator):
           .agg(F.sum('imported_incidence_time').alias('imported_incidence'))
 
       else:
-        result = result\
-          .withColumn('number_of_new_rows',
-              F.ceil(F.col('duration_change_only') / (24 * 60 * 60)).astype('int'))\
-          .withColumn('remainder',
-              F.col('number_of_new_rows') * (24 * 60 * 60) - F.col('duration_change_only'))\
-          .withColumn('new_row_array',
-              F.when(F.col('number_of_new_rows')>1,
-              F.expr('array_repeat(24 * 60 * 60,number_of_new_rows)'))\
-              .otherwise(F.array('duration_change_only')))\
-          .selectExpr('*',
-              "posexplode(new_row_array) as (pos, duration_exploded)",
-              "date_add(day, pos) as day_filled")\
-          .withColumn('pos_lead', F.lead('pos').over(user_window))\
-          .withColumn('duration_change_only_exact',
-              F.when(F.col('pos') > F.col('pos_lead'), F.col('remainder'))\
-              .otherwise(F.col('duration_exploded')))\
-          .withColumn('imported_incidence_time',
-               F.when(F.col('pos') == 0,
-               F.col('imported_incidence_0') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 1,
-               F.col('imported_incidence_1') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 2,
-               F.col('imported_incidence_2') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 3,
-               F.col('imported_incidence_3') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 4,
-               F.col('imported_incidence_4') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 5,
-               F.col('imported_incidence_5') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 6,
-               F.col('imported_incidence_6') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 7,
-               F.col('imported_incidence_7') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 8,
-               F.col('imported_incidence_8') * \
-               F.col('duration_change_only_exact')).otherwise(
-               F.when(F.col('pos') == 9,
-               F.col('imported_incidence_9') * \
-               F.col('duration_change_only_exact')).otherwise(0)))))))))))\
-          .groupby('day_filled', 'region')\
-          .agg(F.sum('imported_incidence_time').alias('imported_incidence'))\
-          .withColumnRenamed('day_filled', 'day')
+        result = self.spread_over_days(result, 2 * self.cutoff_days + 1)
+
+      return result
+
+    # Spreads the incidence imported during a stay over the calendar days the
+    # stay overlaps, without a row per day and stay. Day k of a stay (counting
+    # from the day it starts) gets the overlap of the stay with that day times
+    # imported_incidence_k, and nothing after day 9. Contributions are summed
+    # per start day and region for each k, and only the small sums are
+    # stacked into one row per day. max_days is the most calendar days a stay
+    # can overlap: stays are at most two gaps of cutoff_days long
+    def spread_over_days(self, result, max_days):
+
+      start = F.col('call_datetime_long')
+      end = start + F.col('duration_change_only')
+      contributions = []
+      for k in range(max_days):
+        day_start = F.date_add(F.to_date('day'), k).cast('timestamp').cast('long')
+        day_end = F.date_add(F.to_date('day'), k + 1).cast('timestamp').cast('long')
+        overlap = F.least(end, day_end) - F.greatest(start, day_start)
+        incidence = F.col('imported_incidence_' + str(k)) if k < 10 else F.lit(0.0)
+        contributions.append(F.when(overlap > 0, incidence * overlap)\
+          .alias('imported_incidence_time_' + str(k)))
+
+      days = ', '.join('date_add(day, {0}), imported_incidence_time_{0}'\
+        .format(k) for k in range(max_days))
+      result = result\
+        .select('day', 'region', *contributions)\
+        .groupby('day', 'region')\
+        .agg(*[F.sum('imported_incidence_time_' + str(k))\
+          .alias('imported_incidence_time_' + str(k)) for k in range(max_days)])\
+        .selectExpr('region',
+          'stack({}, {}) as (day, imported_incidence)'.format(max_days, days))\
+        .where(F.col('imported_incidence').isNotNull())\
+        .groupby('day', 'region')\
+        .agg(F.sum('imported_incidence').alias('imported_incidence'))
 
       return result
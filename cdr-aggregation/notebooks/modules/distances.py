@@ -0,0 +1,109 @@
+# Load modules depending whether we are on docker or on databricks
+import os
+if os.environ['HOME'] != '/root':
+    from modules.import_packages import *
+else:
+    databricks = True
+
+class distance_service:
+    """Class to look up distances between towers from their centroids.
+
+    Instead of joining every observation with the long distance matrix on
+    origin and destination, location ids are mapped to an integer index into
+    arrays of tower centroid coordinates. These arrays are broadcast once to
+    the executors and distances are computed per batch of rows in a
+    vectorised pandas udf.
+
+    Attributes
+    ----------
+    spark : an initialised spark connection
+    ids : a numpy array. Location ids, the position of an id is its index
+    coordinates : a numpy array. Centroid latitude and longitude in radians,
+        one row per index
+    broadcast : a spark broadcast variable. Holds ids and coordinates
+    radius : a float. Earth radius in km, the same as for the distance matrix
+    distance : a pandas udf. Distance between two location id columns
+
+    Methods
+    -------
+    tower_index(location_ids)
+        maps location ids to their integer index, -1 if unknown
+
+    haversine(origin, destination)
+        distances in km between two pandas series of location ids
+
+    add_distance(df, origin = 'location_id_lag', destination = 'location_id')
+        adds a column with the distance between origin and destination
+
+    """
+
+    def __init__(self,
+                 spark,
+                 centroids,
+                 id_var = 'cell_id',
+                 lat_var = 'centroid_LAT',
+                 lng_var = 'centroid_LNG',
+                 radius = 6373):
+        """
+        Parameters
+        ----------
+        spark : spark connection to broadcast with
+        centroids : a pandas or pyspark dataframe with one row per tower, such
+            as the tower_map_all_vars file saved by tower_clusterer
+        id_var : column with the location id
+        lat_var : column with the latitude of the cluster centroid, in degrees
+        lng_var : column with the longitude of the cluster centroid, in degrees
+        radius : earth radius in km
+        """
+        if not isinstance(centroids, pd.DataFrame):
+            centroids = centroids.select(id_var, lat_var, lng_var).toPandas()
+        centroids = centroids.drop_duplicates(id_var)
+        self.spark = spark
+        self.radius = radius
+        self.ids = centroids[id_var].astype(str).to_numpy()
+        self.coordinates = np.radians(
+            centroids[[lat_var, lng_var]].to_numpy(dtype = float))
+        self.broadcast = spark.sparkContext.broadcast(
+            (self.ids, self.coordinates))
+
+        # the udf only references the broadcast variable, so the arrays are
+        # shipped to each executor once rather than with every task
+        broadcast = self.broadcast
+        radius = self.radius
+
+        @pandas_udf(DoubleType(), PandasUDFType.SCALAR)
+        def distance(origin, destination):
+            ids, coordinates = broadcast.value
+            return haversine(pd.Index(ids), coordinates, origin, destination,
+                             radius)
+
+        self.distance = distance
+
+    def tower_index(self, location_ids):
+      return pd.Index(self.ids).get_indexer(location_ids.astype(str))
+
+    def haversine(self, origin, destination):
+      return haversine(pd.Index(self.ids), self.coordinates, origin,
+                       destination, self.radius)
+
+    def add_distance(self, df, origin = 'location_id_lag',
+                     destination = 'location_id'):
+      return df.withColumn('distance',
+        self.distance(F.col(origin).cast('string'),
+                      F.col(destination).cast('string')))
+
+
+def haversine(index, coordinates, origin, destination, radius = 6373):
+    """Haversine distance between two pandas series of location ids, looked up
+    in coordinates through index. Unknown or missing ids give a missing
+    distance, as the left join with the distance matrix does."""
+    origin = index.get_indexer(origin.astype(str))
+    destination = index.get_indexer(destination.astype(str))
+    known = (origin >= 0) & (destination >= 0)
+    lat1, lng1 = coordinates[origin[known]].T
+    lat2, lng2 = coordinates[destination[known]].T
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    distance = np.full(len(origin), np.nan)
+    distance[known] = 2 * radius * np.arcsin(np.sqrt(a))
+    return pd.Series(distance)
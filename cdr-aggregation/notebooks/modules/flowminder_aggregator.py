@@ -1,8 +1,10 @@
 import os
+import threading
 if os.environ['HOME'] != '/root':
     from modules.DataSource import *
     from modules.sql_code_aggregates import *
     from modules.aggregator import *
+    from modules.scheduler import *
     databricks = False
 else:
     databricks = True
@@ -23,19 +25,47 @@ class flowminder_aggregator(aggregator):
     spark : an initialised spark connection. spark connection this aggregator should use
     dates : a dictionary. dates the aggregator should run over
     sql_code : a string. the flowminder sql code to be used
+    max_workers : an integer. Number of queries that may run at once
+    sql_inputs : a dictionary. Tables and views each query reads
+    cached_tables : a dictionary. Query results cached while queries that
+        read them have not run yet
+    pending_consumers : a dictionary. Queries still to run per query result
+    cache_lock : a lock. Guards cached_tables and pending_consumers
 
 
     Methods
     -------
-    run_and_save_all(table_name)
-        runs run_and_save on the list of all flowminder queries at once
+    run_and_save_all(rename = False, tables = None)
+        runs all flowminder queries (or the tables given and the queries they
+        read) as a graph of their inputs, concurrently if max_workers is more
+        than one
+
+    with_inputs(tables)
+        the tables given and all queries they read
+
+    scheduled_query(table_name, rename = False)
+        function that runs, saves and (optionally) renames one query
+
+    consumers(table_name, tables = None)
+        the queries (of tables, if given) reading a table
+
+    consumed(table_name)
+        releases the inputs of a query that no other query still reads
+
+    dependency_order(tables = None)
+        the queries (or tables given) ordered after the queries they read
+
+    release_table(table_name)
+        unpersists a cached query result
 
     run_save_and_rename_all()
         runs run_and_save_all and then renames the csv files created and
         moves them to their parent folder
 
-    attempt_aggregation(indicators_to_produce = 'all', no_of_attempts = 4)
-        - attempts aggregation of all flowminder indicators
+    attempt_aggregation(indicators_to_produce = 'all', max_workers = 1)
+        - attempts aggregation of all flowminder indicators, or of the
+            queries named by the keys of a dictionary
+        - raises if any query failed
         - tries mutiple times (this is relevant for databricks env,
             but should be dropped going forward and replaced by a more
             solid handling of databricks timeouts)
@@ -47,7 +77,8 @@ class flowminder_aggregator(aggregator):
                  result_stub,
                  datasource,
                  regions,
-                 intermediate_tables = ['home_locations']):
+                 intermediate_tables = ['home_locations',
+                                        'subscriber_locations']):
         """
         Parameters
         ----------
@@ -57,31 +88,117 @@ class flowminder_aggregator(aggregator):
         intermediate_tables : tables that we don't want written to csv
         """
         # initiate with parent init
-        super().__init__(result_stub,datasource,regions)
+        super().__init__(result_stub,datasource,regions,intermediate_tables)
+        self.cached_tables = {}
+        self.pending_consumers = {}
+        self.cache_lock = threading.RLock()
 
-    def run_and_save_all(self):
-      for table_name in self.table_names:
-          df = self.spark.sql(self.sql_code[table_name])
+    # a query waits for the queries it reads, such as home_locations. Inputs
+    # that are not queries (calls and cells) are always there
+    def run_and_save_all(self, rename = False, tables = None):
+      tables = self.table_names if tables is None else self.with_inputs(tables)
+      scheduler = indicator_scheduler(self.spark, self.max_workers)
+      self.pending_consumers = {table_name : set(self.consumers(table_name,
+                                  tables)) for table_name in tables}
+      for table_name in tables:
+        scheduler.add(table_name, self.scheduled_query(table_name, rename),
+          depends_on = self.sql_inputs.get(table_name, []))
+      try:
+        scheduler.run()
+      finally:
+        # queries skipped after a failure never release their inputs
+        for table_name in list(self.cached_tables):
+          self.release_table(table_name)
+
+    def scheduled_query(self, table_name, rename = False):
+      def produce():
+        df = self.spark.sql(self.sql_code[table_name])
+        # cache a result read by other queries, so they don't recompute it
+        if self.pending_consumers.get(table_name):
+          print('Caching: ' + table_name)
+          df = df.persist()
+          with self.cache_lock:
+            self.cached_tables[table_name] = df
+        try:
           self.save_and_report(df, table_name)
+          if rename and table_name not in self.intermediate_tables:
+            self.rename_if_not_existing(table_name)
+        finally:
+          self.consumed(table_name)
+      return produce
+
+    def consumers(self, table_name, tables = None):
+      return [t for t in (self.table_names if tables is None else tables)
+              if table_name in self.sql_inputs.get(t, [])]
+
+    # the queries given and all queries they read, directly or not, in the
+    # order of the sql code
+    def with_inputs(self, tables):
+      needed = set()
+      pending = list(tables)
+      while pending:
+        table_name = pending.pop()
+        if table_name in needed or table_name not in self.sql_code:
+          continue
+        needed.add(table_name)
+        pending.extend(self.sql_inputs.get(table_name, []))
+      return [t for t in self.table_names if t in needed]
+
+    def consumed(self, table_name):
+      with self.cache_lock:
+        for input_table in self.sql_inputs.get(table_name, []):
+          if input_table not in self.pending_consumers:
+            continue
+          self.pending_consumers[input_table].discard(table_name)
+          if not self.pending_consumers[input_table]:
+            self.release_table(input_table)
+
+    # queries ordered so that every query comes after the queries it reads
+    def dependency_order(self, tables = None):
+      tables = list(self.table_names if tables is None else tables)
+      ordered = []
+      def visit(table_name, path):
+        if table_name in ordered or table_name not in tables:
+          return
+        if table_name in path:
+          raise ValueError('Circular dependency: ' + table_name)
+        for input_table in self.sql_inputs.get(table_name, []):
+          visit(input_table, path + [table_name])
+        ordered.append(table_name)
+      for table_name in tables:
+        visit(table_name, [])
+      return ordered
+
+    def release_table(self, table_name):
+      with self.cache_lock:
+        if table_name in self.cached_tables:
+          print('Releasing: ' + table_name)
+          self.cached_tables.pop(table_name).unpersist()
 
     def run_save_and_rename_all(self):
-      self.run_and_save_all()
-      self.rename_all_csvs()
+      self.run_and_save_all(rename = True)
 
 
-    def attempt_aggregation(self, indicators_to_produce = 'all'):
+    def attempt_aggregation(self, indicators_to_produce = 'all',
+                            max_workers = 1):
+      self.max_workers = max_workers
       try:
           # all indicators
           if indicators_to_produce == 'all':
             self.run_save_and_rename_all()
 
-          # single indicator
+          # some indicators, named by the queries producing them, with the
+          # queries they read
           else:
-            for table in indicators_to_produce.keys():
-              table_name = indicators_to_produce[table]
+            unknown = [t for t in indicators_to_produce if t not in self.sql_code]
+            if unknown:
+              raise ValueError('Unknown flowminder indicators: ' + ', '.join(unknown))
+            for table_name in indicators_to_produce:
               print('--> Producing: ' + table_name)
-              self.run_save_and_rename(table_name + '_per_' + indicators_to_produce[table_name])
+            self.run_and_save_all(rename = True,
+              tables = list(indicators_to_produce))
           print('Indicators saved.')
 
       except Exception as e:
         print(e)
+        raise
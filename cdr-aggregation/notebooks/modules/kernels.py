@@ -0,0 +1,170 @@
+# Load modules depending whether we are on docker or on databricks
+import os
+if os.environ['HOME'] != '/root':
+    from modules.import_packages import *
+else:
+    databricks = True
+
+import numpy as np
+import pandas as pd
+
+############# Per subscriber kernels for window_engine 'pandas'
+
+# Indicators chaining many windows over msisdn sort the observations again for
+# each window. These kernels get all rows of one subscriber at once, from
+# groupby('msisdn').applyInPandas, and compute the same lags, leads, durations
+# and cumulative sums in one pass over the sorted rows. Comparisons follow sql,
+# where a comparison with a missing region is neither equal nor different.
+# Timestamps are passed as seconds (cast to long in spark), so durations are
+# exactly those of the window functions.
+
+def sql_equal(a, b):
+    return pd.notna(a) & pd.notna(b) & (a == b)
+
+def sql_different(a, b):
+    return pd.notna(a) & pd.notna(b) & (a != b)
+
+def shift(values, periods):
+    """Lag (positive periods) or lead (negative periods) of a float array."""
+    result = np.full(len(values), np.nan)
+    if periods > 0:
+      result[periods:] = values[:-periods]
+    else:
+      result[:periods] = values[-periods:]
+    return result
+
+def origin_destination_time_kernel(pdf, frequency, cutoff_seconds,
+                                   max_duration_seconds):
+    """Durations at region changes of one subscriber, as in indicator 10.
+    Expects call_datetime_long, call_datetime_lead_long (with the end of the
+    sample period for the last observation), last_observation, region,
+    region_lag, region_lead and the frequency column."""
+    pdf = pdf.sort_values('call_datetime_long', kind = 'mergesort')
+    region = pdf['region'].to_numpy()
+    region_lag = pdf['region_lag'].to_numpy()
+    region_lead = pdf['region_lead'].to_numpy()
+
+    # observations at region changes only
+    keep = sql_different(region_lag, region) | \
+      sql_different(region_lead, region) | \
+      pdf['last_observation'].to_numpy()
+    pdf = pdf[keep]
+    region = region[keep]
+    region_lag = region_lag[keep]
+    region_lead = region_lead[keep]
+
+    duration = (pdf['call_datetime_lead_long'].to_numpy() - \
+      pdf['call_datetime_long'].to_numpy()).astype(float)
+    duration = np.where(duration <= cutoff_seconds, duration, 0)
+    duration_change_only = np.where(sql_equal(region, region_lead),
+      shift(duration, -1) + duration, duration)
+    duration_change_only = np.where(
+      duration_change_only > max_duration_seconds, max_duration_seconds,
+      duration_change_only)
+    duration_change_only_lag = shift(duration_change_only, 1)
+
+    change = sql_different(region_lag, region)
+    return pd.DataFrame({
+      frequency : pdf[frequency].to_numpy()[change],
+      'region' : region[change],
+      'region_lag' : region_lag[change],
+      'duration_change_only' : pd.array(duration_change_only[change],
+                                        dtype = 'Int64'),
+      'duration_change_only_lag' : pd.array(duration_change_only_lag[change],
+                                            dtype = 'Int64')})
+
+def imported_incidence_kernel(pdf, incidence):
+    """Incidence a subscriber imports into the region of their last stop, as
+    in accumulated_incidence_imported_only. Expects call_datetime_long,
+    call_datetime_lead_long (with the end date for the last observation),
+    in_period, day_long and region, and a pandas dataframe with region and
+    incidence (as in a sql join, missing regions have no incidence). Returns
+    the imported incidence per region of the subscriber's stops, with 0 for
+    the stops other than the last one."""
+    pdf = pdf.sort_values('call_datetime_long', kind = 'mergesort')
+    pdf = pdf.assign(
+      duration = pdf['call_datetime_lead_long'] - pdf['call_datetime_long'],
+      stop_number = np.arange(1, len(pdf) + 1))
+
+    # a stop is a region visited on a day, numbered by its last observation
+    stops = pdf[pdf['in_period'].fillna(False).astype(bool)]\
+      .groupby(['day_long', 'region'], dropna = False, sort = False)\
+      .agg(total_duration = ('duration', 'sum'),
+           stop_number = ('stop_number', 'max'))\
+      .reset_index()\
+      .astype({'region' : object})\
+      .merge(incidence.dropna(subset = ['region']).astype({'region' : object}),
+             on = 'region', how = 'left')\
+      .sort_values('stop_number', kind = 'mergesort')
+    if len(stops) == 0:
+      return pd.DataFrame({'region' : pdf['region'].iloc[:0],
+                           'imported_incidence' : pd.Series([], dtype = float)})
+
+    region = stops['region'].to_numpy()
+    accumulated_incidence = (stops['incidence'].to_numpy(dtype = float) * \
+      stops['total_duration'].to_numpy(dtype = float) / (21 * 24 * 60 * 60))
+    n = len(stops)
+    position = np.arange(n)
+    last_stop = position == n - 1
+
+    # stops in the region of the last stop, and whether all stops from there
+    # to the last one are in that region too (the last stop always is)
+    same_region_as_last_stop = ~last_stop & sql_equal(region, region[-1])
+    same_from_here = np.cumsum(same_region_as_last_stop[::-1])[::-1]
+    without_break = same_from_here == n - position - 1
+    with_break = same_region_as_last_stop & ~without_break
+
+    # only stops after the last break count, and not those running on into
+    # the last stop
+    cutoff = np.cumsum(with_break[::-1])[::-1]
+    cutoff_indicator = (cutoff == 0) & \
+      (np.cumsum(without_break) < position + 1)
+    accumulated_incidence_cutoff = np.where(
+      cutoff_indicator & ~without_break, accumulated_incidence, 0)
+
+    # the sum of nothing but missing incidence is missing, as in spark
+    imported = np.zeros(n)
+    if np.isnan(accumulated_incidence_cutoff).all():
+      imported[-1] = np.nan
+    else:
+      imported[-1] = np.nansum(accumulated_incidence_cutoff)
+
+    return pd.DataFrame({'region' : region, 'imported_incidence' : imported})\
+      .groupby('region', dropna = False, sort = False)['imported_incidence']\
+      .sum(min_count = 1)\
+      .reset_index()
+
+def infectious_window_kernel(pdf, start_infectious_window,
+                             end_infectious_window, days = 10):
+    """Incidence picked up in other regions over shifted infectious windows,
+    as in accumulated_cholera_incidence_imported_only. For each row and
+    shift d, sums incidence_duration over the rows of the subscriber in
+    another region, with call_datetime_long between the row's plus
+    start_infectious_window + d days and plus end_infectious_window, and adds
+    it as imported_incidence_<d>. Window bounds are found by binary search on
+    the sorted times and sums are differences of prefix sums, instead of
+    collecting the rows of every window."""
+    pdf = pdf.sort_values('call_datetime_long', kind = 'mergesort')
+    times = pdf['call_datetime_long'].to_numpy(dtype = 'int64')
+    region = pdf['region'].to_numpy()
+    values = pdf['incidence_duration'].to_numpy(dtype = float)
+    known = pd.notna(region)
+
+    def window_sums(times, values, row_times, start, end):
+      prefix = np.concatenate([[0.0], np.cumsum(values)])
+      lower = np.searchsorted(times, row_times + start, side = 'left')
+      upper = np.searchsorted(times, row_times + end, side = 'right')
+      return np.where(upper > lower, prefix[upper] - prefix[lower], 0.0)
+
+    # rows with a missing region are never in another region, nor is anything
+    # in another region than theirs
+    for d in range(days):
+      start = start_infectious_window + d * 24 * 60 * 60
+      imported = window_sums(times, np.where(known, values, 0.0), times,
+                             start, end_infectious_window)
+      for r in pd.unique(region[known]):
+        in_region = known & (region == r)
+        imported[in_region] -= window_sums(times[in_region],
+          values[in_region], times[in_region], start, end_infectious_window)
+      pdf['imported_incidence_' + str(d)] = np.where(known, imported, 0.0)
+    return pdf
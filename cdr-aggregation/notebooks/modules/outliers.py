@@ -8,11 +8,15 @@ class outlier_counter:
     calls : a dataframe. which data to process
     spark : an initialised spark connection.
     thresholds : a dictionary with outlier thresholds to be used.
+    outlier_types : a list. Names of the outlier checks
+    broadcast_limit : an integer. Most outlier ids to broadcast when
+        filtering them out of the calls
 
     Methods
     -------
     count()
-        count outliers and print results
+        profile each id in one pass over the calls, count outliers and
+        print results
 
     print_results(df)
         print results of outlier counts
@@ -34,75 +38,73 @@ class outlier_counter:
         self.counts = {}
         self.dfs = {}
         self.thresholds = thresholds
+        self.outlier_types = ['too_few_transactions',
+                              'too_many_avg_transactions',
+                              'too_many_transactions_in_single_day']
+        self.broadcast_limit = 1000000
 
 
     def count(self):
-      # count all records
-      self.counts['all_records'] = self.calls.count()
+      # Get # of records per user per day, the only pass over the calls
+      self.dfs['records_per_user_per_day'] = self.calls\
+        .groupby('msisdn', 'call_date').count()\
+        .persist()
 
       # count of days in dataframe
-      self.counts['number_of_days'] = self.calls.select('call_date').distinct().count()
-
-      # Count number of distinct users
-      self.counts['distinct_ids'] = self.calls.select('msisdn').distinct().count()
-
-      # Get # of records per user
-      self.dfs['records_per_user'] = self.calls.groupby('msisdn').count()
-
-      # Get # of records per user per day
-      self.dfs['records_per_user_per_day'] = self.calls.groupby('msisdn', 'call_date').count()
+      self.counts['number_of_days'] = \
+        self.dfs['records_per_user_per_day'].select('call_date').distinct().count()
+
+      # Profile each user: total records and most records on a single day
+      self.dfs['records_per_user'] = self.dfs['records_per_user_per_day']\
+        .groupby('msisdn')\
+        .agg(F.sum('count').alias('count'),
+             F.max('count').alias('max_daily_count'))\
+        .withColumn('too_few_transactions',
+          F.col('count') < self.thresholds['min_transactions'])\
+        .withColumn('too_many_avg_transactions', # more than __ calls and texts per day on average
+          F.col('count') > (self.counts['number_of_days'] * \
+          self.thresholds['max_avg_transactions']))\
+        .withColumn('too_many_transactions_in_single_day', # more than __ calls and texts in a single day
+          F.col('max_daily_count') > \
+          self.thresholds['max_transactions_in_single_day'])\
+        .withColumn('outlier', F.col('too_few_transactions') | \
+          F.col('too_many_avg_transactions') | \
+          F.col('too_many_transactions_in_single_day'))\
+        .persist()
 
       # Identify daily usage outlier msidsdn
-      self.dfs['too_few_transactions'] = self.dfs['records_per_user']\
-        .where(F.col('count') < self.thresholds['min_transactions'])\
-        .select('msisdn').distinct()
-      self.dfs['too_many_avg_transactions'] = self.dfs['records_per_user']\
-        .where(F.col('count') > (self.counts['number_of_days'] * \
-        self.thresholds['max_avg_transactions']))\
-        .select('msisdn').distinct() # more than __ calls and texts per day on average
-      self.dfs['too_many_transactions_in_single_day'] = \
-        self.dfs['records_per_user_per_day']\
-        .where(F.col('count') > self.thresholds['max_transactions_in_single_day'])\
-        .select('msisdn').distinct() # more than __ calls and texts in a single day
-
-      # Count the outlier accounts
-      self.counts['too_few_transactions'] = \
-        self.dfs['too_few_transactions'].count()
-      self.counts['too_many_avg_transactions'] = \
-        self.dfs['too_many_avg_transactions'].count()
-      self.counts['too_many_transactions_in_single_day'] = \
-        self.dfs['too_many_transactions_in_single_day'].count()
+      for outlier in self.outlier_types:
+        self.dfs[outlier] = self.dfs['records_per_user']\
+          .where(F.col(outlier)).select('msisdn')
+
+      # Count records, users and the outlier accounts at once
+      counts = self.dfs['records_per_user'].agg(
+        F.sum('count').alias('all_records'),
+        F.count(F.lit(1)).alias('distinct_ids'),
+        F.count(F.when(F.col('outlier'), True)).alias('outliers'),
+        F.sum(F.when(F.col('outlier'), F.col('count')).otherwise(0))\
+          .alias('dropped_calls'),
+        *[F.count(F.when(F.col(outlier), True)).alias(outlier)
+          for outlier in self.outlier_types]).collect()[0].asDict()
+      self.counts.update(counts)
+      self.dfs['records_per_user_per_day'].unpersist()
 
       # Caclulate the outlier account fraction
-      self.counts['too_few_transactions_fraction'] = \
-        self.counts['too_few_transactions'] / self.counts['distinct_ids']
-      self.counts['too_many_avg_transactions_fraction'] = \
-        self.counts['too_many_avg_transactions'] / self.counts['distinct_ids']
-      self.counts['too_many_transactions_in_single_day_fraction'] = \
-        self.counts['too_many_transactions_in_single_day'] / self.counts['distinct_ids']
-
-      # Keep only ids that aren't among the outlier accounts
-      self.filtered_transactions = self.calls.join(self.dfs['too_few_transactions'],
-                                   self.calls['msisdn'] == \
-                                   self.dfs['too_few_transactions']['msisdn'],
-                                   how ='leftanti').select(self.calls.columns[0:])
-      self.filtered_transactions = self.filtered_transactions\
-                                    .join(self.dfs['too_many_avg_transactions'],
-                                    self.filtered_transactions['msisdn'] == \
-                                    self.dfs['too_many_avg_transactions']['msisdn'],
-                                    how ='leftanti')\
-                                    .select(self.filtered_transactions.columns[0:])
-      self.filtered_transactions = self.filtered_transactions\
-                                    .join(self.dfs['too_many_transactions_in_single_day'],
-                                   self.filtered_transactions['msisdn'] == \
-                                   self.dfs['too_many_transactions_in_single_day']['msisdn'],
-                                   how ='leftanti')\
-                                   .select(self.filtered_transactions.columns[0:])
+      for outlier in self.outlier_types:
+        self.counts[outlier + '_fraction'] = \
+          self.counts[outlier] / self.counts['distinct_ids']
+
+      # Keep only ids that aren't among the outlier accounts, usually few
+      # enough to be broadcast to every task
+      outliers = self.dfs['records_per_user'].where(F.col('outlier')).select('msisdn')
+      if self.counts['outliers'] <= self.broadcast_limit:
+        outliers = F.broadcast(outliers)
+      self.filtered_transactions = self.calls.join(outliers, 'msisdn', how ='leftanti')\
+        .select(self.calls.columns)
 
       # count how many we kept and dropped
-      self.counts['filtered_transactions'] = self.filtered_transactions.count()
-      self.counts['dropped_calls'] = \
-        self.counts['all_records'] - self.counts['filtered_transactions']
+      self.counts['filtered_transactions'] = \
+        self.counts['all_records'] - self.counts['dropped_calls']
       self.print_results()
 
 
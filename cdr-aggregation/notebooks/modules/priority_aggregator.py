@@ -1,9 +1,14 @@
 # Load modules depending whether we are on docker or on databricks
 import os
+import threading
 if os.environ['HOME'] != '/root':
     from modules.aggregator import *
     from modules.import_packages import *
     from modules.utilities import *
+    from modules.distances import *
+    from modules.sketches import *
+    from modules.scheduler import *
+    from modules.kernels import *
 else:
     databricks = True
 
@@ -18,10 +23,16 @@ class priority_aggregator(aggregator):
     re_create_vars : a boolean. Whether to re-create/create a parquet file with
         intermediary steps to save computation. Do this whenever you've changed
         code.
+    append_vars : a boolean. Whether to add only the dates that are new since
+        the vars parquet was last written, instead of re-creating it.
+    vars_path : a string. Path of the vars parquet, partitioned by call_date
     level : a string. Level this aggregator is supposed to run on, to hande
         level-specific queries such as weighting
     distances_df : a pyspark dataframe. Matrix of distances to be used for
         distance calculation
+    distance_service : an instance of distance_service class. Looks up
+        distances from broadcast tower centroids, if the datasource has
+        tower_centroids, instead of joining distances_df
     table_names : a list. Keep a list of all tables we creat for re-naming
     period_filter : a pyspark filter. Time filter for hourly, daily and monthly
         indicators
@@ -30,11 +41,56 @@ class priority_aggregator(aggregator):
     missing_value_code : an integer. Code for missing regions
     cutoff_days : an integer. Max number of days for leads and lags.
     max_duration : an integer. Max number of days to consider for duration.
+    fused : a boolean. Whether indicators sharing a time filter should share
+        one cached, msisdn-partitioned scan of the vars parquet
+    fused_scans : a list. Pairs of time filter and cached scan in fused mode
+    approx_distinct : a boolean. Whether to estimate unique subscriber counts
+        by merging stored hourly HyperLogLog sketches instead of counting
+        distinct msisdns
+    approx_distinct_error : a float. Relative standard error of the
+        approximate distinct counts, which sets the sketch precision
+    sketches : a pyspark dataframe. Hourly sketches per region, once loaded
+    rebuild_sketches : a boolean. Whether stored sketches are out of date
+        because the vars parquet was re-created
+    regions : a string. Name of the tower map this aggregator runs on
+    rollup : a boolean. Whether additive indicators should be derived from
+        partial aggregates at the finest frequency, instead of from the
+        observations for each frequency
+    partials : a dictionary. Cached partial aggregates in rollup mode
+    window_engine : a string. 'spark' for indicator 10 and the incidence
+        indicators to use window functions over all observations, 'stays' for
+        indicator 10 and the cholera incidence to read stored stay segments,
+        'pandas' for indicator 10 and the imported incidence to run a kernel
+        per subscriber
+    stay_segments : a list. Pairs of time filter and loaded stay segments
+    cache_lock : a lock. Makes sure that indicators running at once create
+        fused scans, partial aggregates, stay segments and sketches only once
 
     Methods to manage aggregation:
     -----------------------------
     [check inherited methods described in aggregator class]
 
+    create_vars()
+        creates the vars parquet from the full calls history
+
+    append_vars()
+        adds the dates after the last date in the vars parquet, patching
+            lags and leads at the boundary
+
+    vars_state(df)
+        last record and home region of each subscriber, kept next to the
+            vars parquet so that appending doesn't scan the history
+
+    add_vars(df)
+        adds lags, leads and time variables to cdr records
+
+    home_regions(df)
+        assigns home regions to subscribers, as in the flowminder query
+
+    indicator_plan(frequency)
+        list of tables, indicator methods and arguments to produce for a
+            frequency
+
     run_and_save_all(time_filter, frequency)
         - in this method we run all indicators defines as priority
         - for this we need to supply filter and frequency
@@ -46,9 +102,105 @@ class priority_aggregator(aggregator):
     run_save_and_rename_all()
         run all frequencies, then rename the resulting table
 
-    attempt_aggregation(indicators_to_produce = 'all')
+    schedule_all_frequencies()
+        run, save and rename all indicators of all frequencies at once, up
+            to max_workers at a time
+
+    scheduled_indicator(table_name, indicator, time_filter, frequency, kwargs)
+        function that produces, saves and renames one indicator
+
+    attempt_aggregation(indicators_to_produce = 'all', fused = False,
+                        rollup = False, max_workers = 1)
         - run all priority indicators
         - or specify a dicionary of indicators to produce
+        - in fused mode indicators share one scan per time filter
+        - in rollup mode additive indicators are derived from partial
+          aggregates
+        - with more than one worker, all indicators run concurrently
+
+    indicator_method(indicator)
+        the method producing an indicator, its rollup variant in rollup mode
+
+    filter_df(time_filter)
+        returns the observations for a time filter, reusing the fused scan
+            in fused mode
+
+    release_fused_scans()
+        unpersists the scans cached in fused mode
+
+    join_distances(prep)
+        adds the distance from location_id_lag to location_id, with the
+            distance service or by joining the distance matrix
+
+    sketches_path()
+        path of the stored sketches for the chosen error bound
+
+    hourly_sketches()
+        loads the hourly sketches per region, sketching dates that have
+            no sketches yet
+
+    approx_distinct_subscribers(time_filter, groups)
+        estimates unique subscribers per group from the hourly sketches
+
+    Methods to derive indicators from partial aggregates (rollup mode):
+    -------------------------------------------------------------------
+
+    partial(name)
+        computes and caches a partial aggregate, with the partial_ method
+            of that name
+
+    release_partials()
+        unpersists the cached partial aggregates, except those shared
+            through the datasource
+
+    weeks_range(col)
+        filter on a truncated time column for the days in full weeks
+
+    partial_transactions()
+        observations per hour and region, derived from the partial of a
+            nested tower map when there is one
+
+    partial_distances()
+        distance travelled per user, home region and day
+
+    partial_day_locations()
+        region with the longest stay per user and day
+
+    rollup_transactions(time_filter, frequency)
+        - indicator 1 from hourly partials
+
+    rollup_mean_distance(time_filter, frequency)
+        - indicators 7 + 8 from daily partials
+
+    rollup_home_vs_day_location(time_filter, frequency,
+                                home_location_frequency)
+        - indicator 9 from daily partials, shared by all home location
+          frequencies
+
+    Methods for stay segments (window_engine 'stays'):
+    --------------------------------------------------
+
+    stays(time_filter)
+        loads the stay segments of a time filter, saving them to parquet next
+            to the vars parquet the first time
+
+    stay_segments_of(time_filter)
+        consecutive observations of a user in one region, collapsed into one
+            row per stay
+
+    stays_path(name)
+        path of the stored stay segments of a time filter
+
+    stays_snapshot()
+        identifies the vars partitions and dates the stored stays were
+            computed from
+
+    release_stays()
+        unpersists the stay segments of time filters other than period and
+            weeks, which are only cached
+
+    stay_change_durations(time_filter, long_gap_duration = 0)
+        stays with the durations indicator 10 attributes to region changes
 
     Methods to produce priority indicators:
     --------------------------------------
@@ -71,22 +223,35 @@ class priority_aggregator(aggregator):
     unique_subscriber_home_locations(time_filter, frequency)
         - indicator 6 + 11
 
+    distance_prep(time_filter)
+        - observations with the location lags used for indicators 7 + 8
+
     mean_distance(time_filter, frequency)
         - indicators 7 + 8
 
+    stay_durations(time_filter)
+        - observations with the stay durations used for indicator 9
+
     home_vs_day_location(time_filter, frequency, home_location_frequency)
         - indicator 9
 
     origin_destination_matrix_time(time_filter, frequency)
         - indicator 10
 
+    origin_destination_matrix_time_stays(time_filter, frequency)
+        - indicator 10 from stay segments
+
+    origin_destination_matrix_time_pandas(time_filter, frequency)
+        - indicator 10 from a pandas kernel per subscriber
+
     """
 
     def __init__(self,
                  result_stub,
                  datasource,
                  regions,
-                 re_create_vars = False):
+                 re_create_vars = False,
+                 append_vars = False):
         """
         Parameters
         ----------
@@ -95,12 +260,15 @@ class priority_aggregator(aggregator):
         regions : admin level this aggregator will be used for
         intermediate_tables : tables that we don't want written to csv
         re_create_vars : whether to re-create/create a parquet file with
+        append_vars : whether to only add dates after the last date in the
+            parquet file with vars
         """
 
         # initiate with parent init
         super().__init__(result_stub,datasource,regions)
 
         # set the admin level
+        self.regions = regions
         if regions == 'admin2_tower_map':
             self.level = 'admin2'
         elif regions == 'admin3_tower_map':
@@ -108,179 +276,492 @@ class priority_aggregator(aggregator):
         else:
             self.level = 'voronoi'
 
-        # set the distance matrix for distance-based queries
-        self.distances_df = datasource.distances
+        # set the distance matrix for distance-based queries, or the tower
+        # centroids to compute distances from when they are given
+        self.distances_df = getattr(datasource, 'distances', None)
+        self.dimension_tables += ['distances', 'tower_centroids']
+        if hasattr(datasource, 'tower_centroids'):
+            self.distance_service = distance_service(self.spark,
+                datasource.tower_centroids)
+        else:
+            self.distance_service = None
 
         # initiate a list for names of tables we produce
         self.table_names = []
 
         # set time filter based on date range given in config file, add one day
-        #to end date to make it inclusive
+        #to end date to make it inclusive. The same range on call_date lets
+        #spark skip the date partitions outside it
         self.period_filter = (F.col('call_datetime') >= \
                              self.dates['start_date']) &\
                              (F.col('call_datetime') <= \
-                             self.dates['end_date'] + dt.timedelta(1))
+                             self.dates['end_date'] + dt.timedelta(1)) &\
+                             self.call_date_range(self.dates['start_date'],
+                               self.dates['end_date'] + dt.timedelta(1))
 
         # we only include full weeks, these have been inherited
         self.weeks_filter = (F.col('call_datetime') >= \
                             self.dates['start_date_weeks']) &\
-                            (F.col('call_datetime') <= \
-                            self.dates['end_date_weeks'] + dt.timedelta(1))
+                            (F.col('call_datetime') < \
+                            self.dates['end_date_weeks'] + dt.timedelta(1)) &\
+                            self.call_date_range(self.dates['start_date_weeks'],
+                              self.dates['end_date_weeks'] + dt.timedelta(1))
 
         self.privacy_filter = 15
         self.missing_value_code = 99999
         self.cutoff_days = 7
         self.max_duration = 21
 
+        # fused execution is switched on in attempt_aggregation
+        self.fused = False
+        self.fused_scans = []
+
+        # approximate distinct counts are opt-in, set approx_distinct to True
+        # and choose the error bound before producing indicators
+        self.approx_distinct = False
+        self.approx_distinct_error = 0.02
+        self.sketches = None
+        self.rebuild_sketches = False
+
+        # rollup mode is switched on in attempt_aggregation
+        self.rollup = False
+        self.partials = {}
+        self.cache_lock = threading.RLock()
+
+        # indicators reading stays instead of all observations are opt-in,
+        # set window_engine to 'stays' before producing indicators
+        self.window_engine = 'spark'
+        self.stay_segments = []
+
+        # the vars parquet is partitioned by call_date so that new dates can
+        # be appended without rewriting the full history
+        self.vars_path = os.path.join(self.datasource.standardize_path,
+            self.datasource.parquetfile_vars + self.level + '.parquet')
+
         # Check whether a parquet file with variable has already been created,
         # this differs from databricks to docker
         if databricks:
           try:
             # does the file exist?
-            dbutils.fs.ls(os.path.join(self.datasource.standardize_path,
-                self.datasource.parquetfile_vars + self.level + '.parquet'))
+            dbutils.fs.ls(self.vars_path)
             create_vars = False
           except Exception as e:
             create_vars = True
 
         else:
-            create_vars = (os.path.exists(os.path.join(
-                self.datasource.standardize_path,
-                self.datasource.parquetfile_vars + self.level + '.parquet')
-                ) == False)
+            create_vars = (os.path.exists(self.vars_path) == False)
 
         # If the variable file doesn't exist yet, and we don't want to recreate
         # it, create it. These vars are used in most queries so we save them to
         # disk to save on query execution time
         if (re_create_vars | create_vars):
-            print('Creating vars parquet-file...')
-            self.df = self.calls.join(self.cells, self.calls.location_id == \
-                self.cells.cell_id, how = 'left').drop('cell_id')\
-              .join(self.spark.sql(self.sql_code['home_locations'])\
-              .withColumnRenamed('region', 'home_region'), 'msisdn', 'left')\
-              .orderBy('msisdn', 'call_datetime')\
-              .withColumn('region_lag', F.lag('region').over(user_window))\
-              .withColumn('region_lead', F.lead('region').over(user_window))\
-              .withColumn('call_datetime_lag',
-                F.lag('call_datetime').over(user_window))\
-              .withColumn('call_datetime_lead',
-                F.lead('call_datetime').over(user_window))\
-              .withColumn('hour_of_day', F.hour('call_datetime').cast('byte'))\
-              .withColumn('hour', F.date_trunc('hour', F.col('call_datetime')))\
-              .withColumn('week', F.date_trunc('week', F.col('call_datetime')))\
-              .withColumn('month', F.date_trunc('month', F.col('call_datetime')))\
-              .withColumn('constant', F.lit(1).cast('byte'))\
-              .withColumn('day', F.date_trunc('day', F.col('call_datetime')))\
-              .na.fill({'region' : self.missing_value_code ,
-                        'region_lag' : self.missing_value_code ,
-                        'region_lead' : self.missing_value_code })
-
-            self.df = save_and_load_parquet(self.df,
-                os.path.join(self.datasource.standardize_path,
-                    self.datasource.parquetfile_vars + self.level + '.parquet'),
-                    self.datasource)
+            self.create_vars()
+
+        ## When we only want to add new dates, we append them to the parquet
+        elif append_vars:
+            self.append_vars()
 
         ## When we don't want to re-create the variables parquet, we just load it
         else:
-            self.df = self.spark.read.format("parquet").load(
-                os.path.join(self.datasource.standardize_path,
-                    self.datasource.parquetfile_vars + self.level + '.parquet'))
-
-    # Run and save all priority indicators (list keeps on changing so there's
-    # some commented lines)
-    def run_and_save_all(self, time_filter, frequency):
-
-      # hourly indicators
-      if frequency == 'hour':
-
-        # indicator 1
-        self.table_names.append(self.save_and_report(
-            self.transactions(time_filter, frequency),
-            'transactions_per_' + frequency))
-
-        # indicator 2
-        self.table_names.append(self.save_and_report(
-            self.unique_subscribers(time_filter, frequency),
-            'unique_subscribers_per_' + frequency))
-
-      # daily indicators
-      elif frequency == 'day':
-
-        # indicator 3
-        self.table_names.append(self.save_and_report(
-            self.unique_subscribers(time_filter, frequency),
-            'unique_subscribers_per_' + frequency))
+            self.df = self.spark.read.format("parquet").load(self.vars_path)
+
+    # Create the vars parquet from the full calls history
+    def create_vars(self):
+      print('Creating vars parquet-file...')
+      prep = join_dimension(self.calls, self.cells, 'location_id', 'cell_id',
+          name = 'cells').drop('cell_id')\
+        .join(self.sql_table('home_locations')\
+        .withColumnRenamed('region', 'home_region'), 'msisdn', 'left')
+      self.add_vars(prep).write.mode('overwrite')\
+        .partitionBy('call_date').parquet(self.vars_path)
+      self.df = self.spark.read.format("parquet").load(self.vars_path)
+      self.rebuild_sketches = True
+      self.save_vars_state(self.vars_state(self.df))
+
+    #### Incremental update of the vars parquet
+
+    # The vars state holds one row per subscriber, with the time and date of
+    # their last record and their home region, so that appending new dates
+    # doesn't scan the history
 
-        # indicator 4
-        self.table_names.append(self.save_and_report(
-            self.percent_of_all_subscribers_active(time_filter, frequency),
-            'percent_of_all_subscribers_active_per_' + frequency))
-
-        # indicator 5
-        self.table_names.append(self.save_and_report(
-            self.origin_destination_connection_matrix(time_filter, frequency),
-            'origin_destination_connection_matrix_per_' + frequency))
-
-        # indicator 7
-        self.table_names.append(self.save_and_report(
-            self.mean_distance(time_filter, frequency),
-            'mean_distance_per_' + frequency))
-
-        # indicator 9
-        self.table_names.append(self.save_and_report(
-            self.home_vs_day_location(time_filter, frequency,
-            home_location_frequency = 'week'),
-            'week_home_vs_day_location_per_' + frequency))
-
-        self.table_names.append(self.save_and_report(
-            self.home_vs_day_location(time_filter, frequency,
-            home_location_frequency = 'month'),
-            'month_home_vs_day_location_per_' + frequency))
-
-        # indicator 10
-        self.table_names.append(self.save_and_report(
-            self.origin_destination_matrix_time(time_filter, frequency),
-            'origin_destination_matrix_time_per_' + frequency))
+    # prep:
+    # - find the last date in the vars state, and the calls after that date
+    # - the boundary is the last stored record of each subscriber with new
+    #   calls, whatever its date. Keep all records of the dates holding a
+    #   boundary record, since we rewrite their partitions
+    # - keep the stored home region of every subscriber in the state, assign
+    #   home regions from the new dates to new subscribers only
+    # - stack these records and new records and create lags, leads and time
+    #   vars
+    # - stored records keep their lags, new records keep the lags we just
+    #   created, so the first new record of a user lags the boundary
+    # - stored records keep their leads, except the last record of a user
+    #   (the only one without a lead), which leads into the new records
 
-      # weekly indicators
-      elif frequency == 'week':
+    # result:
+    # - overwrite the partitions of the boundary and write the new partitions
+    # - replace the state of subscribers with new calls
+
+    def append_vars(self):
+
+      existing = self.spark.read.format("parquet").load(self.vars_path)
+
+      # vars parquets created before partitioning was introduced are rebuilt
+      if not any('call_date=' in f for f in existing.inputFiles()[:1]):
+        print('Vars parquet-file is not partitioned by date.')
+        return self.create_vars()
+
+      state = self.load_vars_state(existing)
+      last_date = state.agg(F.max('call_date')).collect()[0][0]
+      new_calls = self.calls.where(F.col('call_date') > last_date)
+      if new_calls.limit(1).count() == 0:
+        print('No new dates after {} to append.'.format(last_date))
+        self.df = existing
+        return
+      print('Appending dates after {} to vars parquet-file...'.format(last_date))
+
+      boundary_dates = [row[0] for row in state\
+        .join(new_calls.select('msisdn').distinct(), 'msisdn', 'left_semi')\
+        .select('call_date').distinct().collect()]
+
+      # materialise the records of the partitions we are overwriting
+      rewritten = existing.where(F.col('call_date').isin(boundary_dates))\
+        .localCheckpoint()
+      known_homes = state.select('msisdn', 'home_region')
+
+      new_calls = join_dimension(new_calls, self.cells, 'location_id',
+          'cell_id', name = 'cells').drop('cell_id')
+      homes = known_homes.unionByName(self.home_regions(new_calls)\
+        .join(known_homes, 'msisdn', 'leftanti'))
+      new_calls = new_calls.join(homes, 'msisdn', 'left')
+
+      previous = ['region_lag', 'call_datetime_lag', 'region_lead',
+                  'call_datetime_lead']
+      prep = rewritten.select(*new_calls.columns,
+            *[F.col(c).alias(c + '_previous') for c in previous])\
+        .unionByName(new_calls.select('*',
+            *[F.lit(None).cast(rewritten.schema[c].dataType)\
+              .alias(c + '_previous') for c in previous]))
+
+      has_lead = F.col('call_datetime_lead_previous').isNotNull()
+      result = self.add_vars(prep)\
+        .withColumn('region_lag',
+          F.coalesce(F.col('region_lag_previous'), F.col('region_lag')))\
+        .withColumn('call_datetime_lag',
+          F.coalesce(F.col('call_datetime_lag_previous'),
+          F.col('call_datetime_lag')))\
+        .withColumn('region_lead', F.when(has_lead,
+          F.col('region_lead_previous')).otherwise(F.col('region_lead')))\
+        .withColumn('call_datetime_lead', F.when(has_lead,
+          F.col('call_datetime_lead_previous'))\
+          .otherwise(F.col('call_datetime_lead')))\
+        .drop(*[c + '_previous' for c in previous])
+
+      # only replace the partitions we are writing (needs spark 3)
+      result.write.mode('overwrite')\
+        .option('partitionOverwriteMode', 'dynamic')\
+        .partitionBy('call_date').parquet(self.vars_path)
+      self.df = self.spark.read.format("parquet").load(self.vars_path)
+
+      new_state = self.vars_state(new_calls)
+      self.save_vars_state(state.join(new_state, 'msisdn', 'leftanti')\
+        .unionByName(new_state))
+
+    # Path of the vars state, next to the vars parquet
+    def vars_state_path(self):
+      return self.vars_path.replace('.parquet', '_state.parquet')
+
+    # Last record and home region per subscriber of vars or calls
+    def vars_state(self, df):
+      return df\
+        .groupby('msisdn')\
+        .agg(F.max(F.struct('call_datetime', 'call_date')).alias('last'),
+             F.first('home_region', ignorenulls = True).alias('home_region'))\
+        .select('msisdn', 'last.call_datetime', 'last.call_date',
+                'home_region')
+
+    # Vars parquets written before the state was introduced get their state
+    # from a scan of the history, once
+    def load_vars_state(self, existing):
+      try:
+        return self.spark.read.format('parquet').load(self.vars_state_path())
+      except Exception as e:
+        print('Creating vars state from vars parquet-file...')
+        self.save_vars_state(self.vars_state(existing))
+        return self.spark.read.format('parquet').load(self.vars_state_path())
+
+    # the new state may read the old one, so we materialise it before
+    # overwriting
+    def save_vars_state(self, state):
+      state.localCheckpoint().write.mode('overwrite')\
+        .parquet(self.vars_state_path())
+
+    # Lags, leads, time variables and missing region codes used in most queries
+    def add_vars(self, df):
+      return df\
+        .withColumn('region_lag', F.lag('region').over(user_window))\
+        .withColumn('region_lead', F.lead('region').over(user_window))\
+        .withColumn('call_datetime_lag',
+          F.lag('call_datetime').over(user_window))\
+        .withColumn('call_datetime_lead',
+          F.lead('call_datetime').over(user_window))\
+        .withColumn('hour_of_day', F.hour('call_datetime').cast('byte'))\
+        .withColumn('hour', F.date_trunc('hour', F.col('call_datetime')))\
+        .withColumn('week', F.date_trunc('week', F.col('call_datetime')))\
+        .withColumn('month', F.date_trunc('month', F.col('call_datetime')))\
+        .withColumn('constant', F.lit(1).cast('byte'))\
+        .withColumn('day', F.date_trunc('day', F.col('call_datetime')))\
+        .na.fill({'region' : self.missing_value_code ,
+                  'region_lag' : self.missing_value_code ,
+                  'region_lead' : self.missing_value_code })
+
+    # Home regions as in the flowminder home_locations query: the region a
+    # subscriber was last seen in on most days, latest date breaking ties
+    def home_regions(self, df):
 
-        # indicator 6
-        self.table_names.append(self.save_and_report(
-            self.unique_subscriber_home_locations(time_filter, frequency),
-            'unique_subscriber_home_locations_per_' + frequency))
+      user_day = Window\
+        .partitionBy('msisdn', 'call_date')\
+        .orderBy(F.desc('call_datetime'))
+
+      user_rank = Window\
+        .partitionBy('msisdn')\
+        .orderBy(F.desc('total'), F.desc('latest_date'))
+
+      result = df.where(F.col('region').isNotNull())\
+        .withColumn('event_rank', F.row_number().over(user_day))\
+        .where(F.col('event_rank') == 1)\
+        .groupby('msisdn', 'region')\
+        .agg(F.count('*').alias('total'),
+             F.max('call_date').alias('latest_date'))\
+        .withColumn('daily_location_rank', F.row_number().over(user_rank))\
+        .where(F.col('daily_location_rank') == 1)\
+        .select('msisdn', F.col('region').alias('home_region'))
 
-        # indicator 8
-        self.table_names.append(self.save_and_report(
-            self.mean_distance(time_filter, frequency),
-            'mean_distance_per_' + frequency))
+      return result
 
-      # monthly indicators
-      elif frequency == 'month':
+    # Indicators produced by run_and_save_all for each frequency, as a list of
+    # (table name, indicator method, additional arguments). The list keeps on
+    # changing, so we keep it in one place
+    def indicator_plan(self, frequency):
+
+      plan = {
+
+        # hourly indicators
+        'hour' : [
+          # indicator 1
+          ('transactions_per_hour', 'transactions', {}),
+          # indicator 2
+          ('unique_subscribers_per_hour', 'unique_subscribers', {})],
+
+        # daily indicators
+        'day' : [
+          # indicator 3
+          ('unique_subscribers_per_day', 'unique_subscribers', {}),
+          # indicator 4
+          ('percent_of_all_subscribers_active_per_day',
+            'percent_of_all_subscribers_active', {}),
+          # indicator 5
+          ('origin_destination_connection_matrix_per_day',
+            'origin_destination_connection_matrix', {}),
+          # indicator 7
+          ('mean_distance_per_day', 'mean_distance', {}),
+          # indicator 9
+          ('week_home_vs_day_location_per_day', 'home_vs_day_location',
+            {'home_location_frequency' : 'week'}),
+          ('month_home_vs_day_location_per_day', 'home_vs_day_location',
+            {'home_location_frequency' : 'month'}),
+          # indicator 10
+          ('origin_destination_matrix_time_per_day',
+            'origin_destination_matrix_time', {})],
+
+        # weekly indicators
+        'week' : [
+          # indicator 6
+          ('unique_subscriber_home_locations_per_week',
+            'unique_subscriber_home_locations', {}),
+          # indicator 8
+          ('mean_distance_per_week', 'mean_distance', {})],
+
+        # monthly indicators
+        'month' : [
+          # indicator 11
+          ('unique_subscriber_home_locations_per_month',
+            'unique_subscriber_home_locations', {})]}
+
+      return plan.get(frequency)
+
+    # Run and save all priority indicators for one frequency, we need to supply
+    # filter and frequency
+    def run_and_save_all(self, time_filter, frequency):
 
-        # indicator 11
-        self.table_names.append(self.save_and_report(
-            self.unique_subscriber_home_locations(time_filter, frequency),
-            'unique_subscriber_home_locations_per_' + frequency))
+      plan = self.indicator_plan(frequency)
 
       # unkown frequency
-      else:
+      if plan is None:
         print('What is the frequency?!')
+        return
 
-    # run all priority indicators for all frequencies
+      for table_name, indicator, kwargs in plan:
+        self.table_names.append(self.save_and_report(
+            self.indicator_method(indicator)(time_filter, frequency, **kwargs),
+            table_name, indicator))
+
+    # run all priority indicators for all frequencies. In fused mode hourly and
+    # daily indicators share one scan, and so do weekly and monthly indicators
     def run_and_save_all_frequencies(self):
       self.run_and_save_all(self.period_filter, 'hour')
       self.run_and_save_all(self.period_filter, 'day')
+      self.release_fused_scans()
       self.run_and_save_all(self.weeks_filter, 'week')
       self.run_and_save_all(self.weeks_filter, 'month')
+      self.release_fused_scans()
 
     # run all priority indicators for all frequencies, rename them afterwards
     def run_save_and_rename_all(self):
-      self.run_and_save_all_frequencies()
-      self.rename_all_csvs()
+      if self.max_workers > 1:
+        self.schedule_all_frequencies()
+      else:
+        self.run_and_save_all_frequencies()
+        self.rename_all_csvs()
+
+    # run all priority indicators for all frequencies at once. Priority
+    # indicators don't depend on each other, each one is renamed as soon as
+    # it is saved
+    def schedule_all_frequencies(self):
+      scheduler = indicator_scheduler(self.spark, self.max_workers)
+      for time_filter, frequencies in [(self.period_filter, ['hour', 'day']),
+                                       (self.weeks_filter, ['week', 'month'])]:
+        for frequency in frequencies:
+          for table_name, indicator, kwargs in self.indicator_plan(frequency):
+            scheduler.add(table_name, self.scheduled_indicator(table_name,
+              indicator, time_filter, frequency, kwargs))
+      try:
+        scheduler.run()
+      finally:
+        self.release_fused_scans()
+
+    def scheduled_indicator(self, table_name, indicator, time_filter,
+                            frequency, kwargs):
+      def produce():
+        self.table_names.append(self.save_and_report(
+          self.indicator_method(indicator)(time_filter, frequency, **kwargs),
+          table_name, indicator))
+        self.rename_if_not_existing(table_name)
+      return produce
+
+    # Dates of the calls from start to end, both included, as a filter on the
+    # call_date partition column
+    def call_date_range(self, start, end):
+      return (F.col('call_date') >= F.to_date(F.lit(start))) & \
+             (F.col('call_date') <= F.to_date(F.lit(end)))
+
+    # Return the observations for a time filter. In fused mode, all indicators
+    # using the same filter share one filtered scan, partitioned by msisdn and
+    # sorted by time so that the user windows don't need another shuffle
+    def filter_df(self, time_filter):
+
+      if not self.fused:
+        return self.df.where(time_filter)
+
+      with self.cache_lock:
+        # compare by identity, filters are pyspark columns
+        for scan_filter, scan in self.fused_scans:
+          if scan_filter is time_filter:
+            return scan
+
+        print('Caching fused scan')
+        scan = self.df.where(time_filter)\
+          .repartition('msisdn')\
+          .sortWithinPartitions('msisdn', 'call_datetime')\
+          .persist()
+        self.fused_scans.append((time_filter, scan))
+        return scan
+
+    # free the executor memory held by fused scans
+    def release_fused_scans(self):
+      for scan_filter, scan in self.fused_scans:
+        scan.unpersist()
+      self.fused_scans = []
+
+    def join_distances(self, prep):
+      # the distance service computes distances row by row from broadcast
+      # centroids, which avoids shuffling prep for a join on two keys
+      if self.distance_service is not None:
+        return self.distance_service.add_distance(prep)
+      return prep.join(self.distances_df,
+             (prep.location_id==self.distances_df.destination) &\
+             (prep.location_id_lag==self.distances_df.origin),
+             'left')
+
+    # Sketches are stored next to the vars parquet, one file per precision
+    def sketches_path(self):
+      return os.path.join(self.datasource.standardize_path,
+        self.datasource.parquetfile_vars + self.level + '_hll_' + \
+        str(hll_precision(self.approx_distinct_error)) + '.parquet')
+
+    # Sketch subscribers per hour and region for the dates in the vars parquet
+    # that have not been sketched yet, so new days only add sketches. The
+    # hour is also called call_datetime, so that time filters apply to it
+    def hourly_sketches(self):
+
+      with self.cache_lock:
+        return self.load_hourly_sketches()
+
+    def load_hourly_sketches(self):
+
+      if self.sketches is not None:
+        return self.sketches
+
+      precision = hll_precision(self.approx_distinct_error)
+      path = self.sketches_path()
+      try:
+        stored = None if self.rebuild_sketches else \
+          self.spark.read.format('parquet').load(path)
+      except Exception as e:
+        stored = None
+
+      if stored is None:
+        print('Sketching subscribers per hour and region...')
+        hll_sketch(self.df, ['call_date', 'hour', 'region'], precision)\
+          .write.mode('overwrite').partitionBy('call_date').parquet(path)
+      else:
+        new = self.df.join(stored.select('call_date').distinct(),
+                           'call_date', 'leftanti')
+        if new.limit(1).count() > 0:
+          print('Sketching new dates...')
+          hll_sketch(new, ['call_date', 'hour', 'region'], precision)\
+            .write.mode('append').partitionBy('call_date').parquet(path)
+      self.rebuild_sketches = False
+
+      self.sketches = self.spark.read.format('parquet').load(path)\
+        .withColumn('call_datetime', F.col('hour'))
+      return self.sketches
+
+    # Merge the hourly sketches within the time filter into the groups, days,
+    # weeks and months are truncated hours
+    def approx_distinct_subscribers(self, time_filter, groups):
+      sketches = self.hourly_sketches().where(time_filter)
+      for frequency in ['day', 'week', 'month']:
+        if frequency in groups:
+          sketches = sketches.withColumn(frequency,
+            F.date_trunc(frequency, F.col('hour')))
+      return hll_estimate(sketches, groups,
+                          hll_precision(self.approx_distinct_error))
+
+    # In rollup mode, use the rollup variant of an indicator if there is one,
+    # unless a subclass changed the indicator
+    def indicator_method(self, indicator):
+      rollup = 'rollup_' + indicator
+      if self.rollup and hasattr(self, rollup) and \
+        getattr(type(self), indicator) is getattr(priority_aggregator, indicator):
+        return getattr(self, rollup)
+      return getattr(self, indicator)
 
     def attempt_aggregation(self,
-        indicators_to_produce = 'all'):
+        indicators_to_produce = 'all',
+        fused = False,
+        rollup = False,
+        max_workers = 1):
         """This method handles multiple aggregations in a row.
         It calls the indicator methods to produce indicators with frequencies
         specified in Parameters to the method call.
@@ -301,7 +782,23 @@ class priority_aggregator(aggregator):
          'table_name' : ['indicator_name',['frequency','home_location_frequency']]
 
          as value.
+
+        fused : a boolean. If True, all indicators using the same time filter
+        share one filtered scan of the vars parquet, partitioned by msisdn and
+        cached, instead of each indicator scanning the parquet again.
+
+        max_workers : an integer. If more than one, all indicators run at once
+        from a thread pool, up to max_workers at a time, each in its own FAIR
+        scheduler pool. Only used when producing all indicators. The run then
+        raises if any indicator failed.
+
+        rollup : a boolean. If True, transactions, mean distance and home vs
+        day location are derived from partial aggregates computed once at the
+        finest frequency, and the privacy filter is applied to the result.
         """
+        self.fused = fused
+        self.rollup = rollup
+        self.max_workers = max_workers
         try:
             # if we want to produce all indicators
             if indicators_to_produce == 'all':
@@ -337,7 +834,7 @@ class priority_aggregator(aggregator):
                         filter_var = self.period_filter
 
                       # compute the indicator
-                      result = getattr(self, table_name)(filter_var,
+                      result = self.indicator_method(table_name)(filter_var,
                         frequency, **other_args)
                       # try to prefix the resulting table name
                       try:
@@ -353,10 +850,11 @@ class priority_aggregator(aggregator):
                         filter_var = self.weeks_filter
                       else:
                         filter_var = self.period_filter
-                      result = getattr(self,
+                      result = self.indicator_method(
                         table_name)(filter_var, frequency)
                     # save and rename
-                    table_name = self.save_and_rename_one(result, table)
+                    self.save_and_rename_one(result, table,
+                      indicators_to_produce[table][0])
             else:
                 print("""Wrong arguments for aggregation attempt. Specify either
                  'all' or a dictionary in the format
@@ -371,8 +869,327 @@ class priority_aggregator(aggregator):
             print('Priority indicators saved.')
         except Exception as e:
             print(e)
+            # a failed scheduled run fails, after releasing caches below
+            if indicators_to_produce == 'all' and self.max_workers > 1:
+              raise
+        finally:
+            self.release_fused_scans()
+            self.release_partials()
+            self.release_stays()
+
+
+
+    ######## Rollup ########
+
+    # Partial aggregates are computed once, over the sample period, at the
+    # finest frequency any indicator needs. Coarser frequencies are derived
+    # by summing partials, weekly and monthly ones only over full weeks as
+    # the weeks filter does. The privacy filter is only applied to results
+
+    def partial(self, name):
+      with self.cache_lock:
+        if name not in self.partials:
+          print('Computing partial aggregates: ' + name)
+          self.partials[name] = getattr(self, 'partial_' + name)().persist()
+        return self.partials[name]
+
+    # partials shared through the datasource are kept until it releases them
+    def release_partials(self):
+      shared = getattr(self.datasource, 'hourly_transactions', {}).values()
+      for partial in self.partials.values():
+        if not any(partial is s for s in shared):
+          partial.unpersist()
+      self.partials = {}
+
+    # the same days as the weeks filter
+    def weeks_range(self, col):
+      return (F.col(col) >= self.dates['start_date_weeks']) & \
+             (F.col(col) < self.dates['end_date_weeks'] + dt.timedelta(1))
+
+    # Hourly transactions per region. These are shared through the datasource,
+    # so that if this tower map groups the regions of another tower map we
+    # already have partials for (admin2 of admin3, say), we sum those instead
+    # of scanning the observations. Shared partials stay cached until
+    # datasource.release_hourly_transactions() is called
+    def partial_transactions(self):
+
+      shared = getattr(self.datasource, 'hourly_transactions', {})
+      if self.regions in shared:
+        return shared[self.regions]
+
+      for regions, partial in shared.items():
+        mapping = nested_regions(getattr(self.datasource, regions), self.cells)
+        if mapping is not None:
+          print('Deriving hourly transactions from ' + regions)
+          result = partial.withColumnRenamed('region', 'fine_region')\
+            .join(mapping, 'fine_region', 'left')\
+            .na.fill({'region' : self.missing_value_code})\
+            .groupby('hour', 'region')\
+            .agg(F.sum('count').alias('count'))
+          break
+      else:
+        result = self.filter_df(self.period_filter)\
+          .groupby('hour', 'region')\
+          .count()
+
+      shared[self.regions] = result.persist()
+      self.datasource.hourly_transactions = shared
+      return shared[self.regions]
+
+    # Lags are taken over the sample period. Over the weeks filter, the first
+    # observation in the full weeks has no lag, so distance_weeks leaves out
+    # the move into the first full week
+    def partial_distances(self):
+
+      result = self.join_distances(self.distance_prep(self.period_filter))\
+        .withColumn('distance_weeks', F.when(F.col('call_datetime_lag') >= \
+          self.dates['start_date_weeks'], F.col('distance')))\
+        .groupby('msisdn', 'home_region', 'day')\
+        .agg(F.sum('distance').alias('distance'),
+             F.sum('distance_weeks').alias('distance_weeks'))
+
+      return result
+
+    # week and month depend on the day, so one partial serves the week and
+    # month home location frequencies
+    def partial_day_locations(self):
+
+      result = self.stay_durations(self.period_filter)\
+        .groupby('msisdn', 'region', 'day', 'week', 'month')\
+        .agg(F.sum('duration').alias('total_duration'))\
+        .orderBy('msisdn', 'day', 'total_duration')\
+        .groupby('msisdn', 'day', 'week', 'month')\
+        .agg(F.last('region').alias('region'),
+             F.last('total_duration').alias('duration'))
+
+      return result
+
+    #### Indicator 1 from partials
+
+    # result:
+    # - sum hourly partials by frequency and region
+    # - apply privacy filter
+
+    def rollup_transactions(self, time_filter, frequency):
+
+      result = self.partial('transactions')
+
+      if frequency != 'hour':
+        if frequency in ['week', 'month']:
+          result = result.where(self.weeks_range('hour'))
+        result = result\
+          .withColumn(frequency, F.date_trunc(frequency, F.col('hour')))\
+          .groupby(frequency, 'region')\
+          .agg(F.sum('count').alias('count'))
+
+      result = result.where(F.col('count') > self.privacy_filter)
+
+      return result
+
+    #### Indicator 7 + 8 from partials
+
+    # result:
+    # - sum daily partials by user, home region and frequency, without the
+    #   move into the first full week for weeks and months
+    # - group by frequency and home region
+    # - get mean and standard deviation of distance from count, sum and sum of
+    #   squares
+
+    def rollup_mean_distance(self, time_filter, frequency):
+
+      prep = self.partial('distances')
+
+      if frequency != 'day':
+        prep = prep.where(self.weeks_range('day'))\
+          .withColumn(frequency, F.date_trunc(frequency, F.col('day')))\
+          .groupby('msisdn', 'home_region', frequency)\
+          .agg(F.sum('distance_weeks').alias('distance'))
+
+      result = prep\
+        .groupby('home_region', frequency)\
+        .agg(F.count('distance').alias('n'),
+             F.sum('distance').alias('total'),
+             F.sum(F.col('distance') * F.col('distance')).alias('total_squares'))\
+        .withColumn('mean_distance', F.col('total') / F.col('n'))\
+        .withColumn('stdev_distance', F.sqrt(F.greatest(
+            F.col('total_squares') / F.col('n') - \
+            F.col('mean_distance') * F.col('mean_distance'), F.lit(0.0))))\
+        .select('home_region', frequency, 'mean_distance', 'stdev_distance')
 
+      return result
+
+    #### Indicator 9 from partials
+
+    # result:
+    # - merge home with daily partials per user and home_location_frequency
+    # - continue as in home_vs_day_location
+
+    def rollup_home_vs_day_location(self, time_filter, frequency, home_location_frequency = 'week', **kwargs):
+
+      # day locations are only kept per day
+      if frequency != 'day':
+        return self.home_vs_day_location(time_filter, frequency,
+          home_location_frequency)
+
+      home_locations = self.assign_home_locations(time_filter, home_location_frequency)
+
+      prep = self.partial('day_locations')\
+        .select(F.col('msisdn').alias('msisdn2'), frequency,
+                F.col(home_location_frequency).alias(home_location_frequency + '2'),
+                'region', 'duration')
+
+      result = prep.join(home_locations,
+            (prep.msisdn2 == home_locations.msisdn) & \
+            (prep[home_location_frequency + '2'] == \
+            home_locations[home_location_frequency]), 'left')\
+        .na.fill({'home_region' : self.missing_value_code})\
+        .groupby(frequency, 'region', 'home_region')\
+        .agg(F.mean('duration').alias('mean_duration'),
+            F.stddev_pop('duration').alias('stdev_duration'),
+            F.count('msisdn').alias('count'))\
+        .where(F.col('count') > self.privacy_filter)
+
+      return result
+
+
+
+    ######## Stay segments ########
+
+    # Consecutive observations of a user in the same region form a stay. The
+    # stays of the period and weeks filters are saved to parquet next to the
+    # vars parquet, and re-computed only when the vars partitions within the
+    # dates or the dates change. Indicators reading them look at one row per
+    # stay instead of every observation. Stays of other time filters are
+    # cached while indicators run
+
+    def stays(self, time_filter):
+      with self.cache_lock:
+        # compare by identity, filters are pyspark columns
+        for stay_filter, stays in self.stay_segments:
+          if stay_filter is time_filter:
+            return stays
+
+        if time_filter is self.period_filter:
+          name = 'period'
+        elif time_filter is self.weeks_filter:
+          name = 'weeks'
+        else:
+          print('Caching stay segments')
+          stays = self.stay_segments_of(time_filter).persist()
+          self.stay_segments.append((time_filter, stays))
+          return stays
+
+        path = self.stays_path(name)
+        snapshot = self.stays_snapshot()
+        try:
+          stays = self.spark.read.format('parquet').load(path)\
+            .where(F.col('snapshot') == snapshot)
+          if stays.limit(1).count() == 0:
+            stays = None
+        except Exception as e:
+          stays = None
+
+        # stays of one snapshot replace those of the previous one
+        if stays is None:
+          print('Saving {} stay segments...'.format(name))
+          self.stay_segments_of(time_filter)\
+            .withColumn('snapshot', F.lit(snapshot))\
+            .write.mode('overwrite')\
+            .option('partitionOverwriteMode', 'static')\
+            .partitionBy('snapshot').parquet(path)
+          stays = self.spark.read.format('parquet').load(path)\
+            .where(F.col('snapshot') == snapshot)
+
+        stays = stays.drop('snapshot')
+        self.stay_segments.append((time_filter, stays))
+        return stays
+
+    def stays_path(self, name):
+      return self.vars_path.replace('.parquet', '_stays_' + name + '.parquet')
+
+    # The stays read the vars partitions within the dates. The weeks dates are
+    # derived from the start and end date, which also set the lead of the last
+    # observation
+    def stays_snapshot(self):
+      return '{}_{}_{}'.format(self.input_snapshot(),
+        self.dates['start_date'].isoformat()[:10],
+        self.dates['end_date'].isoformat()[:10])
+
+    def release_stays(self):
+      for stay_filter, stays in self.stay_segments:
+        if stays.is_cached:
+          stays.unpersist()
+      self.stay_segments = []
+
+    # prep:
+    # - create timestamp lead with max value set to end of sample period
+    # - calculate the gap to the next observation
+    # - flag observations in another region than the one before (stay start)
+    # - number stays per user with a running count of stay starts. Stay 0
+    #   holds observations continuing a stay from before the time filter
+
+    # result:
+    # - group by user and stay
+    # - keep region, lag region, time variables and gap of the first
+    #   observation, lead region, lead timestamp and gap of the last one
+    # - count observations
+
+    def stay_segments_of(self, time_filter):
+
+      stay_window = user_window\
+        .rowsBetween(Window.unboundedPreceding, Window.currentRow)
+
+      prep = self.filter_df(time_filter)\
+        .withColumn('call_datetime_lead',
+            F.when(F.col('call_datetime_lead').isNull(),
+            self.dates['end_date'] + dt.timedelta(1)).otherwise(F.col('call_datetime_lead')))\
+        .withColumn('gap', (F.col('call_datetime_lead').cast('long') - \
+            F.col('call_datetime').cast('long')))\
+        .withColumn('stay', F.sum((F.col('region_lag') != F.col('region'))\
+            .cast('int')).over(stay_window))
+
+      # structs compare field by field, so min and max pick the first and
+      # last observation of a stay
+      result = prep\
+        .groupby('msisdn', 'stay')\
+        .agg(F.min(F.struct('call_datetime', 'region', 'region_lag', 'hour',
+                            'day', 'week', 'month', 'gap')).alias('first'),
+             F.max(F.struct('call_datetime', 'region_lead',
+                            'call_datetime_lead', 'gap')).alias('last'),
+             F.count('*').alias('n_events'))\
+        .select('msisdn', 'stay', 'first.region', 'first.region_lag',
+                F.col('first.call_datetime').alias('call_datetime'),
+                'first.hour', 'first.day', 'first.week', 'first.month',
+                F.col('last.call_datetime').alias('last_call_datetime'),
+                F.col('last.call_datetime_lead').alias('end_datetime'),
+                'last.region_lead',
+                F.col('first.gap').alias('first_gap'),
+                F.col('last.gap').alias('last_gap'),
+                'n_events')
+
+      return result
+
+    # Indicator 10 takes the duration of a stay from the observations at the
+    # region changes only: the gap after the first observation of a stay,
+    # plus the gap after its last one when there is more than one. Gaps longer
+    # than cutoff_days count as long_gap_duration. A stay running on past the
+    # time filter has no duration. The duration of the stay before a change
+    # is the gap after its last observation
+
+    def stay_change_durations(self, time_filter, long_gap_duration = 0):
 
+      def capped(gap):
+        return F.when(F.col(gap) <= (self.cutoff_days * 24 * 60 * 60),
+          F.col(gap)).otherwise(long_gap_duration)
+
+      result = self.stays(time_filter)\
+        .withColumn('duration_change_only',
+            F.when(F.col('region_lead') == F.col('region'), None)\
+            .when(F.col('n_events') > 1, capped('first_gap') + capped('last_gap'))\
+            .otherwise(capped('first_gap')))\
+        .withColumn('duration_last', capped('last_gap'))
+
+      return result
 
     ######## Priority Indicators ########
 
@@ -388,7 +1205,7 @@ class priority_aggregator(aggregator):
 
     def transactions(self, time_filter, frequency):
 
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .groupby(frequency, 'region')\
         .count()\
         .where(F.col('count') > self.privacy_filter)
@@ -407,10 +1224,15 @@ class priority_aggregator(aggregator):
 
     def unique_subscribers(self, time_filter, frequency):
 
-      result = self.df.where(time_filter)\
-        .groupby(frequency, 'region')\
-        .agg(F.countDistinct('msisdn').alias('count'))\
-        .where(F.col('count') > self.privacy_filter)
+      if self.approx_distinct:
+        result = self.approx_distinct_subscribers(time_filter,
+                                                  [frequency, 'region'])
+      else:
+        result = self.filter_df(time_filter)\
+          .groupby(frequency, 'region')\
+          .agg(F.countDistinct('msisdn').alias('count'))
+
+      result = result.where(F.col('count') > self.privacy_filter)
 
       return result
 
@@ -426,10 +1248,14 @@ class priority_aggregator(aggregator):
 
     def unique_subscribers_country(self, time_filter, frequency):
 
-      result = self.df.where(time_filter)\
-        .groupby(frequency)\
-        .agg(F.countDistinct('msisdn').alias('count'))\
-        .where(F.col('count') > self.privacy_filter)
+      if self.approx_distinct:
+        result = self.approx_distinct_subscribers(time_filter, [frequency])
+      else:
+        result = self.filter_df(time_filter)\
+          .groupby(frequency)\
+          .agg(F.countDistinct('msisdn').alias('count'))
+
+      result = result.where(F.col('count') > self.privacy_filter)
 
       return result
 
@@ -447,10 +1273,14 @@ class priority_aggregator(aggregator):
 
     def percent_of_all_subscribers_active(self, time_filter, frequency):
 
-      prep = self.df.where(time_filter)\
-        .select('msisdn')\
-        .distinct()\
-        .count()
+      if self.approx_distinct:
+        prep = self.approx_distinct_subscribers(time_filter, [])\
+          .collect()[0][0]
+      else:
+        prep = self.filter_df(time_filter)\
+          .select('msisdn')\
+          .distinct()\
+          .count()
 
       result = self.unique_subscribers_country(
         time_filter, frequency).withColumn('percent_active',
@@ -486,9 +1316,9 @@ class priority_aggregator(aggregator):
 
       assert frequency == 'day', 'This indicator is only defined for daily frequency'
 
-      result = self.spark.sql(self.sql_code['directed_regional_pair_connections_per_day'])
+      result = self.sql_table('directed_regional_pair_connections_per_day')
 
-      prep = self.df.where(time_filter)\
+      prep = self.filter_df(time_filter)\
         .withColumn('call_datetime_lag', F.lag('call_datetime').over(user_window))\
         .withColumn('day_lag',
           F.when((F.col('call_datetime').cast('long') - \
@@ -540,7 +1370,7 @@ class priority_aggregator(aggregator):
         .orderBy(F.desc_nulls_last('last_region_count'))\
         .partitionBy('msisdn', frequency)
 
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .na.fill({'region' : self.missing_value_code })\
         .withColumn('last_timestamp',
             F.first('call_datetime').over(user_day))\
@@ -587,15 +1417,16 @@ class priority_aggregator(aggregator):
     # - create time and location lags
 
     # result:
-    # - join prep with distances matrix
+    # - look up distances from tower centroids, or join prep with distances
+    #   matrix
     # - group by user, frequency and home region
     # - sum distances
     # - group by frequency and home region
     # - get mean and standard deviation of distance
 
-    def mean_distance(self, time_filter, frequency):
+    def distance_prep(self, time_filter):
 
-      prep = self.df.where(time_filter)\
+      prep = self.filter_df(time_filter)\
         .withColumn('location_id_lag', F.lag('location_id').over(user_window))\
         .withColumn('call_datetime_lag', F.lag('call_datetime').over(user_window))\
         .withColumn('location_id_lag',
@@ -604,10 +1435,13 @@ class priority_aggregator(aggregator):
           F.lag('location_id').over(user_window))\
           .otherwise(None))
 
-      result = prep.join(self.distances_df,
-             (prep.location_id==self.distances_df.destination) &\
-             (prep.location_id_lag==self.distances_df.origin),
-             'left')\
+      return prep
+
+    def mean_distance(self, time_filter, frequency):
+
+      prep = self.distance_prep(time_filter)
+
+      result = self.join_distances(prep)\
         .groupby('msisdn', 'home_region', frequency)\
         .agg(F.sum('distance').alias('distance'))\
         .groupby('home_region', frequency)\
@@ -639,18 +1473,24 @@ class priority_aggregator(aggregator):
     # - caclulate mean, standard deviation of duration and count sims
     # - apply privacy filter
 
-    def home_vs_day_location(self, time_filter, frequency, home_location_frequency = 'week', **kwargs):
-
-      home_locations = self.assign_home_locations(time_filter, home_location_frequency)
+    def stay_durations(self, time_filter):
 
-      prep = self.df.where(time_filter)\
+      prep = self.filter_df(time_filter)\
         .withColumn('call_datetime_lead',
             F.when(F.col('call_datetime_lead').isNull(),
             self.dates['end_date'] + dt.timedelta(1)).otherwise(F.col('call_datetime_lead')))\
         .withColumn('duration', (F.col('call_datetime_lead').cast('long') - \
             F.col('call_datetime').cast('long')))\
         .withColumn('duration', F.when(F.col('duration') <= \
-            (self.cutoff_days * 24 * 60 * 60), F.col('duration')).otherwise(0))\
+            (self.cutoff_days * 24 * 60 * 60), F.col('duration')).otherwise(0))
+
+      return prep
+
+    def home_vs_day_location(self, time_filter, frequency, home_location_frequency = 'week', **kwargs):
+
+      home_locations = self.assign_home_locations(time_filter, home_location_frequency)
+
+      prep = self.stay_durations(time_filter)\
         .groupby('msisdn', 'region', frequency, home_location_frequency)\
         .agg(F.sum('duration').alias('total_duration'))\
         .orderBy('msisdn', frequency, 'total_duration')\
@@ -692,9 +1532,14 @@ class priority_aggregator(aggregator):
 
     def origin_destination_matrix_time(self, time_filter, frequency):
 
+      if self.window_engine == 'stays':
+        return self.origin_destination_matrix_time_stays(time_filter, frequency)
+      elif self.window_engine == 'pandas':
+        return self.origin_destination_matrix_time_pandas(time_filter, frequency)
+
       user_frequency_window = Window.partitionBy('msisdn').orderBy('call_datetime')
 
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .where((F.col('region_lag') != F.col('region')) | \
             (F.col('region_lead') != F.col('region')) | \
             (F.col('call_datetime_lead').isNull()))\
@@ -727,3 +1572,82 @@ class priority_aggregator(aggregator):
            F.stddev_pop('duration_change_only_lag').alias('stddev_duration_origin'))
 
       return result
+
+    # result (from a kernel per subscriber):
+    # - apply sample period filter
+    # - cast timestamps to seconds, replacing a missing lead with the end of
+    #   the sample period
+    # - get durations at region changes with one sort per subscriber (see
+    #   origin_destination_time_kernel)
+    # - group by frequency and origin (lag) and destination (lead)
+    # - calculate avg, std, sums and counts of o and d durations
+
+    def origin_destination_matrix_time_pandas(self, time_filter, frequency):
+
+      prep = self.filter_df(time_filter)\
+        .select('msisdn', frequency, 'region', 'region_lag', 'region_lead',
+            F.col('call_datetime').cast('long').alias('call_datetime_long'),
+            F.coalesce(F.col('call_datetime_lead'),
+              F.lit(self.dates['end_date'] + dt.timedelta(1)))\
+              .cast('long').alias('call_datetime_lead_long'),
+            F.col('call_datetime_lead').isNull().alias('last_observation'))
+
+      schema = StructType([prep.schema[frequency], prep.schema['region'],
+        prep.schema['region_lag'],
+        StructField('duration_change_only', LongType()),
+        StructField('duration_change_only_lag', LongType())])
+      cutoff_seconds = self.cutoff_days * 24 * 60 * 60
+      max_duration_seconds = self.max_duration * 24 * 60 * 60
+
+      def kernel(pdf):
+        return origin_destination_time_kernel(pdf, frequency, cutoff_seconds,
+          max_duration_seconds)
+
+      result = prep\
+        .groupby('msisdn')\
+        .applyInPandas(kernel, schema)\
+        .groupby(frequency, 'region', 'region_lag')\
+        .agg(F.sum('duration_change_only').alias('total_duration_destination'),
+           F.avg('duration_change_only').alias('avg_duration_destination'),
+           F.count('duration_change_only').alias('count_destination'),
+           F.stddev_pop('duration_change_only').alias('stddev_duration_destination'),
+           F.sum('duration_change_only_lag').alias('total_duration_origin'),
+           F.avg('duration_change_only_lag').alias('avg_duration_origin'),
+           F.count('duration_change_only_lag').alias('count_origin'),
+           F.stddev_pop('duration_change_only_lag').alias('stddev_duration_origin'))
+
+      return result
+
+    # result (from stay segments):
+    # - get the durations of stays at region changes
+    # - set max duration to 21 days
+    # - get the duration of the stay before from the last observation
+    # - drop stays not starting with a region change
+    # - group by frequency and origin (lag) and destination
+    # - calculate avg, std, sums and counts of o and d durations
+
+    def origin_destination_matrix_time_stays(self, time_filter, frequency):
+
+      stay_window = Window.partitionBy('msisdn').orderBy('stay')
+
+      def max_duration(col):
+        return F.when(F.col(col) > (self.max_duration * 24 * 60 * 60),
+          (self.max_duration * 24 * 60 * 60)).otherwise(F.col(col))
+
+      result = self.stay_change_durations(time_filter)\
+        .withColumn('duration_change_only', max_duration('duration_change_only'))\
+        .withColumn('duration_last', max_duration('duration_last'))\
+        .withColumn('duration_change_only_lag',
+            F.lag('duration_last').over(stay_window))\
+        .where(F.col('region_lag') != F.col('region'))\
+        .groupby(frequency, 'region', 'region_lag')\
+        .agg(F.sum('duration_change_only').alias('total_duration_destination'),
+           F.avg('duration_change_only').alias('avg_duration_destination'),
+           F.count('duration_change_only').alias('count_destination'),
+           F.stddev_pop('duration_change_only').alias('stddev_duration_destination'),
+           F.sum('duration_change_only_lag').alias('total_duration_origin'),
+           F.avg('duration_change_only_lag').alias('avg_duration_origin'),
+           F.count('duration_change_only_lag').alias('count_origin'),
+           F.stddev_pop('duration_change_only_lag').alias('stddev_duration_origin'))
+
+      return result
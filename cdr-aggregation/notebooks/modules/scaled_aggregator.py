@@ -24,6 +24,15 @@ class scaled_aggregator(priority_aggregator):
     -------
     [check inherited methods described in aggregator class]
 
+    distinct_weighted_count(df, groups)
+        counts distinct subscribers per group and sums their weights
+
+    observed_scale(result, count = 'count',
+                   weight = 'weighted_count_population_scale',
+                   observed = 'weighted_count_observed_scale')
+        rescales weighted counts so that they sum to the observed counts,
+            computed in the same job as the result
+
     This class takes over all methods from the priority_aggregator, but scales
         some of the results using the weight attribute
     """
@@ -31,86 +40,72 @@ class scaled_aggregator(priority_aggregator):
                  result_stub,
                  datasource,
                  regions,
-                 re_create_vars = False):
+                 re_create_vars = False,
+                 append_vars = False):
 
-        super().__init__(result_stub,datasource,regions,re_create_vars)
+        super().__init__(result_stub,datasource,regions,re_create_vars,
+            append_vars)
 
 
         self.weight = getattr(datasource, self.level + '_weight')\
             .withColumnRenamed('region', 'weight_region')
-        self.df = self.df\
-            .join(self.weight.select('weight_region', 'weight'),
-                                    on = (self.df.home_region == \
-                                    self.weight.weight_region),
-                                    how = 'left')\
+        self.dimension_tables.append(self.level + '_weight')
+        self.df = join_dimension(self.df,
+            self.weight.select('weight_region', 'weight'),
+            'home_region', 'weight_region', name = 'weight')\
             .drop('weight_region')
 
+    # Number of distinct subscribers per group and the sum of their weights.
+    # The weight of a subscriber is the same on all of their rows, so we keep
+    # one row per group and subscriber and sum over those
+    def distinct_weighted_count(self, df, groups):
+      return df.select(*groups, 'msisdn', 'weight')\
+        .dropDuplicates(groups + ['msisdn'])\
+        .groupby(*groups)\
+        .agg(F.count('msisdn').alias('count'),
+             F.sum('weight').alias('weighted_count_population_scale'))
+
+    # Weighted counts rescaled to the total observed count. The totals are sums
+    # over a window spanning the whole result, rather than separate actions
+    # that would each re-run the plan of the result
+    def observed_scale(self,
+                       result,
+                       count = 'count',
+                       weight = 'weighted_count_population_scale',
+                       observed = 'weighted_count_observed_scale'):
+      return result.withColumn(observed,
+        F.col(weight) / F.sum(weight).over(global_window) * \
+        F.sum(count).over(global_window))
+
     ## Indicator 1
     def transactions(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .groupby(frequency, 'region')\
         .agg(F.sum('constant').alias('count'),
              F.sum('weight').alias('weighted_count_population_scale'))\
         .where(F.col('count') > self.privacy_filter)
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
 
     ## Indicator 2 + 3
     def unique_subscribers(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
-        .withColumn('array', F.array('msisdn', 'weight'))\
-        .groupby(frequency, 'region')\
-        .agg(F.collect_set('array').alias('array'))\
-        .select(frequency, 'region', F.explode('array').alias('array'))\
-        .withColumn('msisdn', F.col('array').getItem(0).cast('int'))\
-        .withColumn('weight', F.col('array').getItem(1))\
-        .drop('array')\
-        .groupby(frequency, 'region')\
-        .agg(F.count('msisdn').alias('count'),
-             F.sum('weight').alias('weighted_count_population_scale'))\
+      result = self.distinct_weighted_count(self.filter_df(time_filter),
+                                            [frequency, 'region'])\
         .where(F.col('count') > self.privacy_filter)
-      sum_of_counts = result.select('count').groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
 
     ## Indicator 3
     def unique_subscribers_country(self, time_filter, frequency):
-      result = self.df.where(time_filter)\
-        .withColumn('array', F.array('msisdn', 'weight'))\
-        .groupby(frequency)\
-        .agg(F.collect_set('array').alias('array'))\
-        .select(frequency, F.explode('array').alias('array'))\
-        .withColumn('msisdn', F.col('array').getItem(0).cast('int'))\
-        .withColumn('weight', F.col('array').getItem(1))\
-        .drop('array')\
-        .groupby(frequency)\
-        .agg(F.count('msisdn').alias('count'),
-             F.sum('weight').alias('weighted_count_population_scale'))\
+      result = self.distinct_weighted_count(self.filter_df(time_filter),
+                                            [frequency])\
         .where(F.col('count') > self.privacy_filter)
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby().agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
 
     ## Indicator 4
     def percent_of_all_subscribers_active(self, time_filter, frequency):
-      prep = self.df.where(time_filter)\
+      prep = self.filter_df(time_filter)\
         .select('msisdn')\
         .distinct()\
         .count()
@@ -120,7 +115,7 @@ class scaled_aggregator(priority_aggregator):
 
     ## Indicator 5
     def directed_regional_pair_connections(self, time_filter, frequency):
-      left_side = self.df.where(time_filter)\
+      left_side = self.filter_df(time_filter)\
         .groupby('msisdn', frequency, 'region')\
         .agg(F.min('call_datetime').alias('earliest_visit'),
              F.max('call_datetime').alias('latest_visit'),
@@ -142,33 +137,22 @@ class scaled_aggregator(priority_aggregator):
         .groupby(frequency, 'region_to','region_from')\
         .agg(F.sum('constant').alias('count'),
              F.sum('weight').alias('weighted_count_population_scale'))
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)\
+      result = self.observed_scale(result)\
         .withColumnRenamed(frequency, 'connection_frequency')
       return result
 
     def origin_destination_connection_matrix(self, time_filter, frequency):
       left_side = self.directed_regional_pair_connections(time_filter, frequency)
-      right_side = self.df.where(time_filter)\
+      right_side = self.filter_df(time_filter)\
         .withColumn('day_lag', F.lag('day').over(user_window))\
         .where((F.col('region_lag') != F.col('region')) & \
             ((F.col('day') > F.col('day_lag'))))\
         .groupby(frequency, 'region', 'region_lag')\
         .agg(F.sum('constant').alias('od_count'),
              F.sum('weight').alias('weighted_od_count_population_scale'))
-      sum_of_counts = right_side.select('od_count').groupby()\
-        .agg(F.sum('od_count')).collect()[0][0]
-      sum_of_weights = right_side.select('weighted_od_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_od_count_population_scale')).collect()[0][0]
-      right_side = right_side.withColumn('weighted_od_count_observed_scale',
-        F.col('weighted_od_count_population_scale') / sum_of_weights * sum_of_counts)
+      right_side = self.observed_scale(right_side, 'od_count',
+        'weighted_od_count_population_scale',
+        'weighted_od_count_observed_scale')
       result = left_side.join(right_side,
                              (left_side.region_to == right_side.region)\
                            & (left_side.region_from == right_side.region_lag)\
@@ -208,7 +192,7 @@ class scaled_aggregator(priority_aggregator):
       user_frequency = Window\
         .orderBy(F.desc_nulls_last('last_region_count'))\
         .partitionBy('msisdn', frequency)
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .na.fill({'region' : self.missing_value_code })\
         .withColumn('last_timestamp',
             F.first('call_datetime').over(user_day))\
@@ -237,24 +221,14 @@ class scaled_aggregator(priority_aggregator):
         .agg(F.sum('constant').alias('count'),
              F.sum('weight').alias('weighted_count_population_scale'))\
         .where(F.col('count') > self.privacy_filter)
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
 
     ## Indicator 7 + 8
     def mean_distance(self, time_filter, frequency):
-      prep = self.df.where(time_filter)\
+      prep = self.filter_df(time_filter)\
         .withColumn('location_id_lag', F.lag('location_id').over(user_window))
-      result = prep.join(self.distances_df,
-             (prep.location_id==self.distances_df.destination) &\
-             (prep.location_id_lag==self.distances_df.origin),
-             'left')\
+      result = self.join_distances(prep)\
         .groupby('msisdn', 'home_region', frequency)\
         .agg(F.sum('distance').alias('distance'),
              F.last('weight').alias('weight'),
@@ -264,14 +238,7 @@ class scaled_aggregator(priority_aggregator):
              F.stddev_pop('distance').alias('stdev_distance'),
              F.sum('constant').alias('count'),
              F.sum('weight').alias('weighted_count_population_scale'))
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
 
    ## Indicator 9
@@ -282,7 +249,7 @@ class scaled_aggregator(priority_aggregator):
                              **kwargs):
       home_locations = self.assign_home_locations(time_filter,
                                                   home_location_frequency)
-      prep = self.df.where(time_filter)\
+      prep = self.filter_df(time_filter)\
         .withColumn('call_datetime_lead',
             F.when(F.col('call_datetime_lead').isNull(),
             self.dates['end_date']).otherwise(F.col('call_datetime_lead')))\
@@ -309,20 +276,13 @@ class scaled_aggregator(priority_aggregator):
              F.sum('constant').alias('count'),
              F.sum('weight').alias('weighted_count_population_scale'))\
         # .where(F.col('count') > self.privacy_filter)
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-        F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
 
     ## Indicator10
     def origin_destination_matrix_time(self, time_filter, frequency):
       user_frequency_window = Window.partitionBy('msisdn').orderBy('call_datetime')
-      result = self.df.where(time_filter)\
+      result = self.filter_df(time_filter)\
         .where((F.col('region_lag') != F.col('region')) | \
             (F.col('region_lead') != F.col('region')) | \
             (F.col('call_datetime_lead').isNull()))\
@@ -364,12 +324,5 @@ class scaled_aggregator(priority_aggregator):
             .alias('count'),
            F.sum('weight')\
             .alias('weighted_count_population_scale'))
-      sum_of_counts = result.select('count')\
-        .groupby()\
-        .agg(F.sum('count')).collect()[0][0]
-      sum_of_weights = result.select('weighted_count_population_scale')\
-        .groupby()\
-        .agg(F.sum('weighted_count_population_scale')).collect()[0][0]
-      result = result.withColumn('weighted_count_observed_scale',
-      F.col('weighted_count_population_scale') / sum_of_weights * sum_of_counts)
+      result = self.observed_scale(result)
       return result
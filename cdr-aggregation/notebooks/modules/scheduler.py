@@ -0,0 +1,130 @@
+# Load modules depending whether we are on docker or on databricks
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+if os.environ['HOME'] != '/root':
+    from modules.import_packages import *
+    databricks = False
+else:
+    databricks = True
+
+class indicator_scheduler:
+    """Class to run indicators concurrently from a pool of driver threads.
+
+    Each indicator runs in its own spark FAIR scheduler pool, so that small
+    jobs and csv renames of one indicator overlap with the jobs of others
+    instead of leaving the cluster idle. An indicator only starts once the
+    indicators it depends on have finished, and is skipped if one of them
+    failed. Pools are only shared fairly if spark runs with
+    spark.scheduler.mode set to FAIR, otherwise jobs still queue FIFO.
+
+
+    Attributes
+    ----------
+    spark : an initialised spark connection
+    max_workers : an integer. Maximum number of indicators running at once
+    tasks : a dictionary. Function and dependencies per indicator, in the
+        order they were added
+    timings : a list. Status, start and wall time per indicator
+
+    Methods
+    -------
+    add(name, function, depends_on = [])
+        adds an indicator, function takes no arguments
+
+    run()
+        runs all indicators, respecting dependencies, and reports timings.
+        Raises a RuntimeError naming the indicators that failed or were
+        skipped, once all others have run
+
+    run_task(name)
+        runs one indicator in its scheduler pool and times it
+
+    report()
+        prints the status and wall time of every indicator
+
+    """
+
+    def __init__(self, spark, max_workers = 4):
+        """
+        Parameters
+        ----------
+        spark : spark connection to submit jobs to
+        max_workers : maximum number of indicators running at once
+        """
+        self.spark = spark
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.timings = []
+
+    def add(self, name, function, depends_on = []):
+      self.tasks[name] = (function, list(depends_on))
+
+    def run(self):
+      self.start = time.time()
+      status = {}
+      running = {}
+      with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+        while len(status) < len(self.tasks):
+          changed = False
+          # submit indicators whose dependencies are done, in the order added
+          for name, (function, depends_on) in self.tasks.items():
+            if name in status or name in running.values():
+              continue
+            # dependencies we don't know about are assumed to exist already
+            states = [status.get(d, 'running' if d in running.values() else
+                      'waiting') for d in depends_on if d in self.tasks]
+            if any(s in ['failed', 'skipped'] for s in states):
+              print('Skipped: ' + name + ', a dependency failed')
+              status[name] = 'skipped'
+              self.timings.append({'name' : name, 'status' : 'skipped'})
+              changed = True
+            elif all(s == 'done' for s in states):
+              running[executor.submit(self.run_task, name)] = name
+              changed = True
+          if not running:
+            if changed:
+              continue
+            # nothing can start, the remaining indicators depend on each other
+            for name in self.tasks:
+              if name not in status:
+                print('Skipped: ' + name + ', circular dependency')
+                status[name] = 'skipped'
+                self.timings.append({'name' : name, 'status' : 'skipped'})
+            break
+          finished, pending = wait(list(running), return_when = FIRST_COMPLETED)
+          for future in finished:
+            status[running.pop(future)] = future.result()
+      self.report()
+      # a failed indicator must not pass as a completed run
+      failed = [t['name'] for t in self.timings if t['status'] != 'done']
+      if failed:
+        raise RuntimeError('Indicators failed or skipped: ' + ', '.join(failed))
+      return self.timings
+
+    def run_task(self, name):
+      # local properties are per thread, so this only affects this indicator
+      self.spark.sparkContext.setLocalProperty('spark.scheduler.pool', name)
+      start = time.time()
+      try:
+        self.tasks[name][0]()
+        result = 'done'
+      except Exception as e:
+        print('Failed: ' + name)
+        print(e)
+        result = 'failed'
+      finally:
+        self.spark.sparkContext.setLocalProperty('spark.scheduler.pool', None)
+      self.timings.append({'name' : name, 'status' : result,
+                           'start' : start - self.start,
+                           'seconds' : time.time() - start})
+      return result
+
+    def report(self):
+      print('Indicator timings:')
+      for timing in self.timings:
+        if timing['status'] == 'skipped':
+          print('  {:<60} skipped'.format(timing['name']))
+        else:
+          print('  {:<60} {:>8.1f}s  {}'.format(timing['name'],
+            timing['seconds'], timing['status']))
+      print('  {:<60} {:>8.1f}s'.format('total', time.time() - self.start))
@@ -3,6 +3,10 @@
 from modules.import_packages import *
 from modules.DataSource import *
 from modules.utilities import *
+from modules.distances import *
+from modules.sketches import *
+from modules.scheduler import *
+from modules.kernels import *
 from modules.aggregator import *
 from modules.flowminder_aggregator import *
 from modules.priority_aggregator import *
@@ -0,0 +1,70 @@
+# Load modules depending whether we are on docker or on databricks
+import os
+import math
+if os.environ['HOME'] != '/root':
+    from modules.import_packages import *
+    databricks = False
+else:
+    databricks = True
+
+############# HyperLogLog sketches for approximate distinct counts
+
+# A sketch of a group is kept in long form, as one row per filled register
+# with the highest rank seen in that register. Sketches of groups are merged
+# by taking the max rank per register, so counts for coarser groups (days
+# from hours, country from regions) come from merging stored sketches
+# instead of scanning the calls again. An empty register has no row.
+
+def hll_precision(relative_error):
+    """Number of index bits needed for a relative standard error of the
+    estimate, which is about 1.04 / sqrt(2 ** precision)."""
+    precision = math.ceil(math.log2((1.04 / relative_error) ** 2))
+    return min(max(precision, 4), 18)
+
+def hll_sketch(df, groups, precision, id_col = 'msisdn'):
+    """Sketch the distinct values of id_col per group. The lowest precision
+    bits of a 64 bit hash pick the register, the rank is one more than the
+    number of trailing zeros of the remaining bits."""
+    hashed = F.xxhash64(F.col(id_col))
+    rest = F.shiftRightUnsigned(hashed, precision)
+    # rest & -rest keeps the lowest set bit, its log2 is exact in a double
+    rank = F.when(rest == 0, 64 - precision + 1)\
+      .otherwise(F.log2(rest.bitwiseAND(-rest)).cast('int') + 1)
+    return df\
+      .select(*groups,
+              hashed.bitwiseAND((1 << precision) - 1).cast('int')\
+                .alias('register'),
+              rank.cast('byte').alias('rank'))\
+      .groupby(*groups, 'register')\
+      .agg(F.max('rank').alias('rank'))
+
+def hll_merge(sketches, groups):
+    """Merge sketches into coarser groups."""
+    return sketches\
+      .groupby(*groups, 'register')\
+      .agg(F.max('rank').alias('rank'))
+
+def hll_estimate(sketches, groups, precision, alias = 'count'):
+    """Estimate the number of distinct values per group, merging the
+    sketches of each group. Uses linear counting on the empty registers
+    for small counts."""
+    m = 2 ** precision
+    if m == 16:
+      alpha = 0.673
+    elif m == 32:
+      alpha = 0.697
+    elif m == 64:
+      alpha = 0.709
+    else:
+      alpha = 0.7213 / (1 + 1.079 / m)
+    merged = hll_merge(sketches, groups)\
+      .groupby(*groups)\
+      .agg(F.sum(F.pow(F.lit(2.0), -F.col('rank'))).alias('harmonic'),
+           F.count('register').alias('filled'))
+    # empty registers each add 2 ** 0 to the harmonic sum
+    raw = alpha * m * m / (F.col('harmonic') + m - F.col('filled'))
+    linear = m * F.log(F.lit(float(m)) / (m - F.col('filled')))
+    estimate = F.when((raw <= 2.5 * m) & (F.col('filled') < m), linear)\
+      .otherwise(raw)
+    return merged\
+      .select(*groups, F.round(estimate).cast('long').alias(alias))
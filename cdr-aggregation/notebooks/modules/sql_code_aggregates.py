@@ -6,18 +6,40 @@ def write_sql_code(calls = 'calls',
                    end_date_weeks = "\'2020-03-29\'"):
 
   sql_code = {
-    # Aggregate 1 (April 1 version)
-    'count_unique_subscribers_per_region_per_day' :
+    # Intermediate Result - Subscriber locations
+    # One row per subscriber, day and region visited, distributed by msisdn so
+    # that queries per subscriber and day read it without another shuffle.
+    # Only the days the queries read are kept: the daily queries read from the
+    # start date on, the full weeks lie within these days
+    'subscriber_locations' :
     """
       SELECT * FROM (
-          SELECT calls.call_date AS visit_date,
-              cells.region AS region,
-              count(DISTINCT msisdn) AS subscriber_count
+          SELECT calls.msisdn,
+              calls.call_date,
+              cells.region,
+              min(calls.call_datetime) AS earliest_visit,
+              max(calls.call_datetime) AS latest_visit,
+              count(*) AS total_calls
           FROM calls
           INNER JOIN cells
               ON calls.location_id = cells.cell_id
-          WHERE calls.call_date >= {}
+          WHERE calls.call_date >= least({}, {})
               AND calls.call_date <= CURRENT_DATE
+          GROUP BY 1, 2, 3
+      ) AS grouped
+      DISTRIBUTE BY msisdn
+      """.format(start_date, start_date_weeks),
+
+    # Aggregate 1 (April 1 version)
+    'count_unique_subscribers_per_region_per_day' :
+    """
+      SELECT * FROM (
+          SELECT call_date AS visit_date,
+              region,
+              count(msisdn) AS subscriber_count  -- one row per subscriber
+          FROM subscriber_locations
+          WHERE call_date >= {}
+              AND call_date <= CURRENT_DATE
           GROUP BY 1, 2
       ) AS grouped
       WHERE grouped.subscriber_count >= 15
@@ -68,15 +90,13 @@ def write_sql_code(calls = 'calls',
     'count_unique_active_residents_per_region_per_day' :
     """
       SELECT * FROM (
-          SELECT calls.call_date AS visit_date,
-              cells.region AS region,
-              count(DISTINCT calls.msisdn) AS subscriber_count
-          FROM calls
-          INNER JOIN cells
-              ON calls.location_id = cells.cell_id
+          SELECT locations.call_date AS visit_date,
+              locations.region AS region,
+              count(DISTINCT locations.msisdn) AS subscriber_count
+          FROM subscriber_locations locations
           INNER JOIN home_locations homes     -- See intermediate_queries.sql for code to create the home_locations table
-              ON calls.msisdn = homes.msisdn
-              AND cells.region = homes.region
+              ON locations.msisdn = homes.msisdn
+              AND locations.region = homes.region
           GROUP BY 1, 2
       ) AS grouped
       WHERE grouped.subscriber_count >= 15""",
@@ -98,14 +118,12 @@ def write_sql_code(calls = 'calls',
     'count_unique_subscribers_per_region_per_week' :
     """
       SELECT * FROM (
-          SELECT extract(WEEK FROM calls.call_date) AS visit_week,
-              cells.region AS region,
-              count(DISTINCT calls.msisdn) AS subscriber_count
-          FROM calls
-          INNER JOIN cells
-              ON calls.location_id = cells.cell_id
-          WHERE calls.call_date >= {}
-              AND calls.call_date <= {}
+          SELECT extract(WEEK FROM call_date) AS visit_week,
+              region,
+              count(DISTINCT msisdn) AS subscriber_count
+          FROM subscriber_locations
+          WHERE call_date >= {}
+              AND call_date <= {}
           GROUP BY 1, 2
       ) AS grouped
       WHERE grouped.subscriber_count >= 15
@@ -115,17 +133,15 @@ def write_sql_code(calls = 'calls',
     'count_unique_active_residents_per_region_per_week' :
     """
     SELECT * FROM (
-          SELECT extract(WEEK FROM calls.call_date) AS visit_week,
-              cells.region AS region,
-              count(DISTINCT calls.msisdn) AS subscriber_count
-          FROM calls
-          INNER JOIN cells
-              ON calls.location_id = cells.cell_id
+          SELECT extract(WEEK FROM locations.call_date) AS visit_week,
+              locations.region AS region,
+              count(DISTINCT locations.msisdn) AS subscriber_count
+          FROM subscriber_locations locations
           INNER JOIN home_locations homes     -- See intermediate_queries.sql for code to create the home_locations table
-              ON calls.msisdn = homes.msisdn
-              AND cells.region = homes.region
-          WHERE calls.call_date >= {}
-              AND calls.call_date <= {}
+              ON locations.msisdn = homes.msisdn
+              AND locations.region = homes.region
+          WHERE locations.call_date >= {}
+              AND locations.call_date <= {}
           GROUP BY 1, 2
       ) AS grouped
       WHERE grouped.subscriber_count >= 15
@@ -154,60 +170,34 @@ def write_sql_code(calls = 'calls',
               count(*) AS subscriber_count
           FROM (
 
-              SELECT t1.call_date AS connection_date,
-                  t1.msisdn AS msisdn,
-                  t1.region AS region1,
-                  t2.region AS region2
+              -- pairs of the regions a subscriber visited on a day, instead
+              -- of joining the visits with themselves
+              SELECT visits.call_date AS connection_date,
+                  visits.msisdn AS msisdn,
+                  region1,
+                  region2
               FROM (
-                  SELECT DISTINCT calls.msisdn,
-                      calls.call_date,
-                      cells.region
-                  FROM calls
-                  INNER JOIN cells
-                      ON calls.location_id = cells.cell_id
-                  WHERE calls.call_date >= {}
-                      AND calls.call_date <= CURRENT_DATE
-                  ) t1
-
-                  FULL OUTER JOIN
-
-                  (
-                  SELECT DISTINCT calls.msisdn,
-                      calls.call_date,
-                      cells.region
-                  FROM calls
-                  INNER JOIN cells
-                      ON calls.location_id = cells.cell_id
-                  WHERE calls.call_date >= {}
-                      AND calls.call_date <= CURRENT_DATE
-                  ) t2
-
-                  ON t1.msisdn = t2.msisdn
-                  AND t1.call_date = t2.call_date
-              WHERE t1.region < t2.region
+                  SELECT msisdn,
+                      call_date,
+                      collect_list(region) AS regions
+                  FROM subscriber_locations
+                  WHERE call_date >= {}
+                      AND call_date <= CURRENT_DATE
+                  GROUP BY msisdn, call_date
+                  ) visits
+              LATERAL VIEW explode(visits.regions) t1 AS region1
+              LATERAL VIEW explode(visits.regions) t2 AS region2
+              WHERE region1 < region2
 
           ) AS pair_connections
           GROUP BY 1, 2, 3
       ) AS grouped
       WHERE grouped.subscriber_count >= 15
-      """.format(start_date, start_date),
+      """.format(start_date),
 
     # Aggregate 6 (April 2 version)
     'directed_regional_pair_connections_per_day' :
     """
-      WITH subscriber_locations AS (
-          SELECT calls.msisdn,
-              calls.call_date,
-              cells.region,
-              min(calls.call_datetime) AS earliest_visit,
-              max(calls.call_datetime) AS latest_visit
-          FROM calls
-          INNER JOIN cells
-              ON calls.location_id = cells.cell_id
-          WHERE calls.call_date >= {}
-              AND calls.call_date <= CURRENT_DATE
-          GROUP BY msisdn, call_date, region
-      )
       SELECT * FROM (
           SELECT connection_date,
               region_from,
@@ -215,16 +205,28 @@ def write_sql_code(calls = 'calls',
               count(*) AS subscriber_count
           FROM (
 
-              SELECT t1.call_date AS connection_date,
-                  t1.msisdn AS msisdn,
-                  t1.region AS region_from,
-                  t2.region AS region_to
-              FROM subscriber_locations t1
-              FULL OUTER JOIN subscriber_locations t2
-              ON t1.msisdn = t2.msisdn
-                  AND t1.call_date = t2.call_date
-              WHERE t1.region <> t2.region
-                  AND t1.earliest_visit < t2.latest_visit
+              -- pairs of the regions a subscriber visited on a day, instead
+              -- of joining the visits with themselves
+              SELECT visits.call_date AS connection_date,
+                  visits.msisdn AS msisdn,
+                  t1.visit.region AS region_from,
+                  t2.visit.region AS region_to
+              FROM (
+                  SELECT msisdn,
+                      call_date,
+                      collect_list(named_struct(
+                          'region', region,
+                          'earliest_visit', earliest_visit,
+                          'latest_visit', latest_visit)) AS visited
+                  FROM subscriber_locations
+                  WHERE call_date >= {}
+                      AND call_date <= CURRENT_DATE
+                  GROUP BY msisdn, call_date
+                  ) visits
+              LATERAL VIEW explode(visits.visited) t1 AS visit
+              LATERAL VIEW explode(visits.visited) t2 AS visit
+              WHERE t1.visit.region <> t2.visit.region
+                  AND t1.visit.earliest_visit < t2.visit.latest_visit
 
           ) AS pair_connections
           GROUP BY 1, 2, 3
@@ -240,15 +242,13 @@ def write_sql_code(calls = 'calls',
           region,
           total_calls
       FROM (
-          SELECT calls.call_date AS call_date,
-              cells.region AS region,
-              count(DISTINCT msisdn) AS subscriber_count,
-              count(*) AS total_calls
-          FROM calls
-          INNER JOIN cells
-              ON calls.location_id = cells.cell_id
-          WHERE calls.call_date >= {}
-              AND calls.call_date <= CURRENT_DATE
+          SELECT call_date,
+              region,
+              count(msisdn) AS subscriber_count,  -- one row per subscriber
+              sum(total_calls) AS total_calls
+          FROM subscriber_locations
+          WHERE call_date >= {}
+              AND call_date <= CURRENT_DATE
           GROUP BY 1, 2
       ) AS grouped
       WHERE grouped.subscriber_count >= 15
@@ -264,3 +264,29 @@ def write_sql_code(calls = 'calls',
       ) AS home_counts
       WHERE home_counts.subscriber_count >= 15"""}
   return sql_code
+
+# Tables and views each query of write_sql_code reads. Queries run once the
+# queries they read have run, and a query result read by other queries is
+# kept cached until the last of them has run
+def write_sql_inputs():
+
+  sql_inputs = {
+    'subscriber_locations' : ['calls', 'cells'],
+    'count_unique_subscribers_per_region_per_day' : ['subscriber_locations'],
+    'home_locations' : ['calls', 'cells'],
+    'count_unique_active_residents_per_region_per_day' :
+      ['subscriber_locations', 'home_locations'],
+    'count_unique_visitors_per_region_per_day' :
+      ['count_unique_subscribers_per_region_per_day',
+       'count_unique_active_residents_per_region_per_day'],
+    'count_unique_subscribers_per_region_per_week' : ['subscriber_locations'],
+    'count_unique_active_residents_per_region_per_week' :
+      ['subscriber_locations', 'home_locations'],
+    'count_unique_visitors_per_region_per_week' :
+      ['count_unique_subscribers_per_region_per_week',
+       'count_unique_active_residents_per_region_per_week'],
+    'regional_pair_connections_per_day' : ['subscriber_locations'],
+    'directed_regional_pair_connections_per_day' : ['subscriber_locations'],
+    'total_calls_per_region_per_day' : ['subscriber_locations'],
+    'home_location_counts_per_region' : ['home_locations']}
+  return sql_inputs
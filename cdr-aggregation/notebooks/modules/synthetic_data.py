@@ -0,0 +1,245 @@
+# Load modules depending whether we are on docker or on databricks
+import os
+if os.environ['HOME'] != '/root':
+    from modules.import_packages import *
+    databricks = False
+else:
+    databricks = True
+from scipy.spatial import cKDTree
+
+class synthetic_cdr:
+    """Class to generate synthetic cdr data, with a tower map, distances and
+    weights, to benchmark the aggregation without operator data.
+
+    Towers are scattered around a number of cities of different sizes, plus
+    some rural towers. Admin2 and admin3 regions are a regular grid over the
+    bounding box, with admin3 cells nested in admin2 cells. Each subscriber
+    has a home tower, a work tower and a few other frequent towers near home,
+    a daily activity rate and a small chance of trips to any tower. Calls
+    follow a daily cycle and are made from home at night.
+
+
+    Attributes
+    ----------
+    spark : an initialised spark connection
+    n_subscribers : an integer. Number of subscribers
+    n_towers : an integer. Number of towers
+    n_cities : an integer. Number of cities towers are clustered around
+    start_date : a datetime. First day of calls
+    end_date : a datetime. Last day of calls
+    bbox : a tuple. Min longitude, min latitude, max longitude, max latitude
+    admin2_grid : a tuple. Number of admin2 columns and rows
+    admin3_grid : a tuple. Number of admin3 columns and rows in each admin2
+    calls_per_day : a float. Median number of calls per subscriber per day
+    trip_probability : a float. Chance that a call is made from any tower
+    rng : a numpy random generator, seeded for reproducible data
+    towers : a pandas dataframe. Tower ids, coordinates and regions
+    subscribers : a pandas dataframe. Subscriber activity rate and frequent
+        towers
+
+    Methods
+    -------
+    make_towers()
+        places towers and assigns them to admin2 and admin3 regions
+
+    make_subscribers()
+        draws activity rates and frequent towers of subscribers
+
+    calls_on(date)
+        pandas dataframe with the calls of one day
+
+    calls()
+        pyspark dataframe with all calls, in the standardized schema
+
+    tower_map(level)
+        pyspark dataframe mapping towers to regions of a level
+
+    tower_centroids()
+        pyspark dataframe with tower coordinates, as used by distance_service
+
+    distances()
+        pyspark dataframe with the long form distance matrix
+
+    weights(level)
+        pyspark dataframe with a weight per region of a level
+
+    attach(datasource)
+        sets calls, tower maps, distances and weights on a datasource
+
+    """
+
+    def __init__(self,
+                 spark,
+                 n_subscribers = 10000,
+                 n_towers = 500,
+                 n_cities = 5,
+                 start_date = dt.datetime(2020,2,1),
+                 end_date = dt.datetime(2020,3,31),
+                 bbox = (25.2, -22.4, 33.1, -15.6),
+                 admin2_grid = (6, 5),
+                 admin3_grid = (3, 3),
+                 calls_per_day = 4,
+                 trip_probability = 0.02,
+                 seed = 510):
+        """
+        Parameters
+        ----------
+        spark : spark connection to create dataframes with
+        n_subscribers : number of subscribers
+        n_towers : number of towers
+        n_cities : number of cities
+        start_date : first day of calls
+        end_date : last day of calls
+        bbox : min longitude, min latitude, max longitude, max latitude
+        admin2_grid : number of admin2 columns and rows
+        admin3_grid : number of admin3 columns and rows in each admin2 region
+        calls_per_day : median number of calls per subscriber per day
+        trip_probability : chance that a call is made from any tower
+        seed : seed for the random generator
+        """
+        self.spark = spark
+        self.n_subscribers = n_subscribers
+        self.n_towers = n_towers
+        self.n_cities = n_cities
+        self.start_date = start_date
+        self.end_date = end_date
+        self.bbox = bbox
+        self.admin2_grid = admin2_grid
+        self.admin3_grid = admin3_grid
+        self.calls_per_day = calls_per_day
+        self.trip_probability = trip_probability
+        self.rng = np.random.default_rng(seed)
+        self.make_towers()
+        self.make_subscribers()
+
+    def make_towers(self):
+      lng_min, lat_min, lng_max, lat_max = self.bbox
+      # city sizes follow a power law, most towers are in the largest cities
+      cities = np.column_stack([self.rng.uniform(lng_min, lng_max, self.n_cities),
+                                self.rng.uniform(lat_min, lat_max, self.n_cities)])
+      city_size = 1 / np.arange(1, self.n_cities + 1)
+      n_rural = self.n_towers // 5
+      city = self.rng.choice(self.n_cities, self.n_towers - n_rural,
+                             p = city_size / city_size.sum())
+      coordinates = np.concatenate([
+        cities[city] + self.rng.normal(0, 0.1, (len(city), 2)),
+        np.column_stack([self.rng.uniform(lng_min, lng_max, n_rural),
+                         self.rng.uniform(lat_min, lat_max, n_rural)])])
+      coordinates[:, 0] = coordinates[:, 0].clip(lng_min, lng_max)
+      coordinates[:, 1] = coordinates[:, 1].clip(lat_min, lat_max)
+      # admin3 cells subdivide admin2 cells, so admin3 regions are nested
+      columns = np.minimum(((coordinates[:, 0] - lng_min) / (lng_max - lng_min) * \
+        self.admin2_grid[0] * self.admin3_grid[0]).astype(int),
+        self.admin2_grid[0] * self.admin3_grid[0] - 1)
+      rows = np.minimum(((coordinates[:, 1] - lat_min) / (lat_max - lat_min) * \
+        self.admin2_grid[1] * self.admin3_grid[1]).astype(int),
+        self.admin2_grid[1] * self.admin3_grid[1] - 1)
+      admin2 = (rows // self.admin3_grid[1]) * self.admin2_grid[0] + \
+        columns // self.admin3_grid[0]
+      admin3 = rows * self.admin2_grid[0] * self.admin3_grid[0] + columns
+      # the popularity of a tower decides how many subscribers live nearby
+      popularity = np.where(np.arange(self.n_towers) < len(city), 1.0, 0.2)
+      self.towers = pd.DataFrame({
+        'cell_id' : ['T' + str(i).zfill(5) for i in range(self.n_towers)],
+        'LNG' : coordinates[:, 0],
+        'LAT' : coordinates[:, 1],
+        'admin2' : ['ADM2_' + str(r) for r in admin2],
+        'admin3' : ['ADM3_' + str(r) for r in admin3],
+        'popularity' : popularity / popularity.sum()})
+
+    def make_subscribers(self):
+      coordinates = self.towers[['LNG', 'LAT']].to_numpy()
+      tree = cKDTree(coordinates)
+      home = self.rng.choice(self.n_towers, self.n_subscribers,
+                             p = self.towers.popularity.to_numpy())
+      # radius of gyration in degrees, most subscribers stay close to home
+      gyration = self.rng.lognormal(np.log(0.05), 1, self.n_subscribers)
+      # work and two other frequent places are snapped to the nearest tower
+      places = coordinates[home][:, None, :] + \
+        self.rng.normal(0, 1, (self.n_subscribers, 3, 2)) * gyration[:, None, None]
+      frequent = tree.query(places)[1]
+      self.subscribers = pd.DataFrame({
+        'msisdn' : self.rng.choice(np.arange(1, 10 * self.n_subscribers),
+                                   self.n_subscribers, replace = False),
+        'rate' : self.rng.lognormal(np.log(self.calls_per_day), 0.8,
+                                    self.n_subscribers),
+        'home' : home,
+        'work' : frequent[:, 0],
+        'other_1' : frequent[:, 1],
+        'other_2' : frequent[:, 2]})
+
+    def calls_on(self, date):
+      subscribers = self.subscribers
+      # fewer calls on weekends
+      rate = subscribers.rate.to_numpy() * (0.8 if date.weekday() >= 5 else 1)
+      n_calls = self.rng.poisson(rate)
+      caller = np.repeat(np.arange(len(subscribers)), n_calls)
+      n = len(caller)
+      # daily cycle, with most calls during the day
+      hour_weight = np.array([1, 1, 1, 1, 1, 2, 4, 6, 8, 8, 8, 8,
+                              8, 8, 8, 8, 8, 8, 8, 7, 6, 4, 3, 2], dtype = float)
+      hour = self.rng.choice(24, n, p = hour_weight / hour_weight.sum())
+      seconds = hour * 3600 + self.rng.integers(0, 3600, n)
+      # at night calls are from home, during the day from any frequent place
+      night = (hour < 6) | (hour >= 20)
+      place = np.where(night, 0, self.rng.choice(4, n, p = [0.5, 0.3, 0.1, 0.1]))
+      frequent = subscribers[['home', 'work', 'other_1', 'other_2']].to_numpy()
+      tower = frequent[caller, place]
+      trip = self.rng.random(n) < self.trip_probability
+      tower[trip] = self.rng.choice(self.n_towers, trip.sum(),
+                                    p = self.towers.popularity.to_numpy())
+      return pd.DataFrame({
+        'msisdn' : subscribers.msisdn.to_numpy()[caller].astype('int32'),
+        'call_datetime' : pd.Timestamp(date) + pd.to_timedelta(seconds, unit = 's'),
+        'location_id' : self.towers.cell_id.to_numpy()[tower]})
+
+    def calls(self):
+      # generate and convert one day at a time to keep driver memory bounded
+      days = pd.date_range(self.start_date, self.end_date, freq = 'D')
+      df = None
+      for date in days:
+        day = self.spark.createDataFrame(self.calls_on(date))
+        df = day if df is None else df.unionByName(day)
+      return df\
+        .withColumn('msisdn', F.col('msisdn').cast('int'))\
+        .withColumn('call_date', F.col('call_datetime').cast('date'))
+
+    def tower_map(self, level):
+      return self.spark.createDataFrame(
+        self.towers[['cell_id', level]].rename(columns = {level : 'region'}))
+
+    def tower_centroids(self):
+      return self.spark.createDataFrame(
+        self.towers[['cell_id', 'LAT', 'LNG']]\
+          .rename(columns = {'LAT' : 'centroid_LAT', 'LNG' : 'centroid_LNG'}))
+
+    def distances(self):
+      # haversine distance in km between all pairs of towers
+      coordinates = np.radians(self.towers[['LAT', 'LNG']].to_numpy())
+      lat, lng = coordinates[:, 0], coordinates[:, 1]
+      a = np.sin((lat[None, :] - lat[:, None]) / 2) ** 2 + \
+          np.cos(lat[:, None]) * np.cos(lat[None, :]) * \
+          np.sin((lng[None, :] - lng[:, None]) / 2) ** 2
+      distance = 2 * 6373 * np.arcsin(np.sqrt(a))
+      ids = self.towers.cell_id.to_numpy()
+      return self.spark.createDataFrame(pd.DataFrame({
+        'distance' : distance.ravel(),
+        'destination' : np.tile(ids, len(ids)),
+        'origin' : np.repeat(ids, len(ids))}))
+
+    def weights(self, level):
+      # weights scale the subscribers living in a region to a population
+      homes = self.towers[level].to_numpy()[self.subscribers.home.to_numpy()]
+      residents = pd.Series(homes).value_counts()
+      population = self.rng.uniform(50, 150, len(residents)) * residents.to_numpy()
+      return self.spark.createDataFrame(pd.DataFrame({
+        'region' : residents.index,
+        'weight' : population / residents.to_numpy()}))
+
+    def attach(self, datasource):
+      datasource.parquet_df = self.calls()
+      for level in ['admin2', 'admin3']:
+        setattr(datasource, level + '_tower_map', self.tower_map(level))
+        setattr(datasource, level + '_weight', self.weights(level))
+      datasource.distances = self.distances()
+      return datasource
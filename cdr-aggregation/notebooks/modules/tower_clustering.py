@@ -2,8 +2,10 @@
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from shapely.geometry import Polygon, LineString
-from sklearn.neighbors import DistanceMetric
+from shapely.geometry import MultiPoint
+from sklearn.neighbors import DistanceMetric, BallTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.spatial.distance import squareform
 from scipy.cluster.hierarchy import linkage
 from scipy.cluster.hierarchy import fcluster
@@ -33,15 +35,31 @@ class tower_clusterer:
     result_path : a string. Where to save results.
     filename : a string. Name for result file.
     dist : a string. Metric to use to calculate distances.
+    cluster_distance : a float. Distance threshold in km for ward clustering.
+    max_component_size : an integer. Largest group of towers clustered at once
+        by the radius_graph method.
     sites :  a pyspark dataframe. Code, Lat, Lng for all tower_sites
     sites_with_clusters : a pyspark dataframe. Clustered sites (once methods have run)
+    distances_pd_long : a pandas dataframe. Distances between all clusters
+        in long form, in both directions (once methods have run, None for
+        method 'radius_graph')
+    distance_pairs_pd_long : a pandas dataframe. Distances up to max_distance
+        or in one direction only, if requested (once methods have run)
 
 
 
     Methods
     -------
-    cluster_towers()
-        runs clustering algorithm
+    cluster_towers(max_distance = None, upper_triangle = False, method = 'ward')
+        runs clustering algorithm. Method 'ward' clusters all towers at once
+        and computes the distances between all clusters, in both directions,
+        as used by the distance indicators. With max_distance or
+        upper_triangle, the pairs up to max_distance or in one direction are
+        also saved separately as distance pairs. Method 'radius_graph'
+        clusters groups of nearby towers separately and computes no distance
+        matrix, so memory stays bounded: distance indicators then use the
+        tower centroids (tower_map_all_vars) as ds.tower_centroids, and only
+        the pairs up to max_distance are saved, if given
 
     get_centroids()
         computes centroids of clusters
@@ -75,6 +93,8 @@ class tower_clusterer:
         self.filename = shape
         self.region_var = region_var
         self.dist = DistanceMetric.get_metric('haversine')
+        self.cluster_distance = 1
+        self.max_component_size = 5000
         sites_df = getattr(datasource, sites + '_pd')
         if (sites_df.columns == ['cell_id', 'LAT', 'LNG']).all():
           self.sites = sites_df[sites_df.LAT.notna()]
@@ -83,18 +103,27 @@ class tower_clusterer:
           raise 'The sites dataframe does not have the correct columns / \
             column order. Should be cell_id, LAT, LNG'
 
-    def cluster_towers(self):
+    def cluster_towers(self, max_distance = None, upper_triangle = False,
+                       method = 'ward'):
         ## deepcopy sites since we will need it later on
         self.radians = deepcopy(self.sites)
         # convert degrees to radians
         self.radians['LAT'] = np.radians(self.sites['LAT'])
         self.radians['LNG'] = np.radians(self.sites['LNG'])
         # run clustering algorithm
-        self.clusters = fcluster(
-            linkage(
-            squareform(
-            self.dist.pairwise(self.radians[['LAT','LNG']]\
-            .to_numpy())*6373), method='ward'), t = 1, criterion = 'distance')
+        if method == 'ward':
+            self.clusters = fcluster(
+                linkage(
+                squareform(
+                self.dist.pairwise(self.radians[['LAT','LNG']]\
+                .to_numpy())*6373), method='ward'), t = self.cluster_distance,
+                criterion = 'distance')
+        elif method == 'radius_graph':
+            self.clusters = radius_graph_clusters(
+                self.radians[['LAT','LNG']].to_numpy(), self.cluster_distance,
+                self.max_component_size)
+        else:
+            raise ValueError("method should be 'ward' or 'radius_graph'")
         self.sites_with_clusters = self.radians
         self.sites_with_clusters['cluster'] = self.clusters
         # compute centroids of clusters
@@ -111,54 +140,70 @@ class tower_clusterer:
                                           self.sites_with_clusters.centroid_LNG,
                                           self.sites_with_clusters.centroid_LAT),
                                           crs = 'epsg:4326')
-        # compute distances between cluters
-        self.distances_pd = pd.DataFrame(
-            self.dist.pairwise(
-            np.radians(
-            self.sites_with_clusters[['centroid_LAT','centroid_LNG']])\
-                .to_numpy())*6373, columns=self.sites_with_clusters.cell_id.unique(),
-                                    index=self.sites_with_clusters.cell_id.unique())
-        # create long form of distance matrix
-        distances = []
-        origin = []
-        destination = []
-        for a in self.distances_pd.index:
-          for b in self.distances_pd.index:
-            distances.append(self.distances_pd.loc[a,b])
-            origin.append(a)
-            destination.append(b)
-        self.distances_pd_long = pd.DataFrame(list(zip(distances, origin, destination)),
-            columns =['distance', 'origin', 'destination'])
+        if method == 'radius_graph':
+            # a dense matrix would make the run quadratic in the number of
+            # towers again. Distance indicators compute distances from the
+            # tower centroids instead (see distance_service), so we only look
+            # up the pairs up to max_distance, if given
+            self.distances_pd = None
+            self.distances_pd_long = None
+            if max_distance is not None:
+                self.distance_pairs_pd_long = distance_pairs_within(
+                    self.sites_with_clusters.cell_id.to_numpy(),
+                    np.radians(self.sites_with_clusters[['centroid_LAT','centroid_LNG']]\
+                    .to_numpy()), max_distance, upper_triangle = upper_triangle)
+            else:
+                self.distance_pairs_pd_long = None
+        else:
+            # compute distances between cluters
+            self.distances_pd = pd.DataFrame(
+                self.dist.pairwise(
+                np.radians(
+                self.sites_with_clusters[['centroid_LAT','centroid_LNG']])\
+                    .to_numpy())*6373, columns=self.sites_with_clusters.cell_id.unique(),
+                                        index=self.sites_with_clusters.cell_id.unique())
+            # create long form of distance matrix. The mean distance indicators
+            # look up every move (origin, destination) in it, so it keeps all
+            # pairs in both directions
+            self.distances_pd_long = distance_matrix_long(
+                self.distances_pd.index.to_numpy(), self.distances_pd.to_numpy())
+            # pairs within max_distance, or one direction of each pair, are kept
+            # separately, since moves missing from them would get no distance
+            if max_distance is not None or upper_triangle:
+                self.distance_pairs_pd_long = distance_matrix_long(
+                    self.distances_pd.index.to_numpy(), self.distances_pd.to_numpy(),
+                    max_distance = max_distance, upper_triangle = upper_triangle)
+            else:
+                self.distance_pairs_pd_long = None
         # map clusters to regions
         self.map_to_regions()
         return self.save_results()
 
     def get_centroids(self):
-      # loop through clusters to compute centroids
-      for cluster_num in self.sites_with_clusters.cluster.unique():
-        subset = self.sites_with_clusters[self.sites_with_clusters.cluster == cluster_num]
-        # use line method if we have only two towers in cluster
-        if len(subset) == 2:
-            line = LineString(subset.loc[:,['LNG', 'LAT']].to_numpy())
-            self.sites_with_clusters.loc[self.sites_with_clusters.cluster == \
-                cluster_num, 'centroid_LNG'] = line.interpolate(0.5, normalized = True).x
-            self.sites_with_clusters.loc[self.sites_with_clusters.cluster == \
-                cluster_num, 'centroid_LAT'] = line.interpolate(0.5, normalized = True).y
-        # use polygon method if we have more than two towers in cluster
-        if len(subset) > 2:
-            self.sites_with_clusters.loc[self.sites_with_clusters.cluster == \
-                cluster_num, 'centroid_LNG'] = \
-                Polygon(subset.loc[:,['LNG', 'LAT']].to_numpy()).convex_hull.centroid.x
-            self.sites_with_clusters.loc[self.sites_with_clusters.cluster == \
-                cluster_num, 'centroid_LAT'] = \
-                Polygon(subset.loc[:,['LNG', 'LAT']].to_numpy()).convex_hull.centroid.y
-      # replace NAs
-      self.sites_with_clusters.loc[self.sites_with_clusters.centroid_LAT.isna(),
-        'centroid_LNG'] = \
-        self.sites_with_clusters.loc[self.sites_with_clusters.centroid_LAT.isna(), 'LNG']
-      self.sites_with_clusters.loc[self.sites_with_clusters.centroid_LAT.isna(),
-        'centroid_LAT'] = \
-        self.sites_with_clusters.loc[self.sites_with_clusters.centroid_LAT.isna(), 'LAT']
+      # number of towers in the cluster of each tower
+      sites = self.sites_with_clusters
+      size = sites.groupby('cluster').cluster.transform('size').to_numpy()
+      # singletons keep their own location
+      centroids = sites[['LNG', 'LAT']].to_numpy(dtype = float, copy = True)
+      # use line method if we have only two towers in cluster: the midpoint
+      pairs = size == 2
+      centroids[pairs] = sites[pairs].groupby('cluster')[['LNG', 'LAT']]\
+        .transform('mean').to_numpy()
+      # use polygon method if we have more than two towers in cluster: the
+      # centroid of the convex hull, computed once per cluster on the towers
+      # sorted by cluster
+      many = size > 2
+      if many.any():
+        subset = sites[many].sort_values('cluster', kind = 'stable')
+        clusters, starts = np.unique(subset.cluster.to_numpy(), return_index = True)
+        hull_centroids = pd.DataFrame(
+          [hull_centroid(points) for points in
+            np.split(subset[['LNG', 'LAT']].to_numpy(dtype = float), starts[1:])],
+          index = clusters, columns = ['LNG', 'LAT'])
+        centroids[many] = hull_centroids.loc[sites.cluster[many]].to_numpy()
+      # assign all centroids at once
+      self.sites_with_clusters['centroid_LNG'] = centroids[:, 0]
+      self.sites_with_clusters['centroid_LAT'] = centroids[:, 1]
 
     def map_to_regions(self):
       # spatial join clusteres with shapefile
@@ -183,12 +228,180 @@ class tower_clusterer:
       save_csv(self.towers_regions_clusters,
         self.result_path,
         self.datasource.country_code + '_' + self.filename + '_tower_map')
-      # save distance matrix in long form
-      self.distances_df_long  = \
-        self.spark.createDataFrame(self.distances_pd_long)
-      save_csv(self.distances_df_long,
-        self.result_path, self.datasource.country_code + '_distances_pd_long')
+      # save distance matrix in long form, if we computed it
+      if self.distances_pd_long is not None:
+        self.distances_df_long  = \
+          self.spark.createDataFrame(self.distances_pd_long)
+        save_csv(self.distances_df_long,
+          self.result_path, self.datasource.country_code + '_distances_pd_long')
+      else:
+        self.distances_df_long = None
+      # save the filtered pairs, if any
+      if self.distance_pairs_pd_long is not None:
+        self.distance_pairs_df_long = \
+          self.spark.createDataFrame(self.distance_pairs_pd_long)
+        save_csv(self.distance_pairs_df_long, self.result_path,
+          self.datasource.country_code + '_distance_pairs_pd_long')
       # save shapefile used, for dashboarding
       save_csv(self.shape_df, self.result_path,
         self.datasource.country_code + '_' + self.filename  + '_shapefile')
       return self.towers_regions_clusters, self.distances_df_long
+
+
+def distance_matrix_long(ids, distances, max_distance = None, upper_triangle = False):
+    """Long form of a square distance matrix, with one row per pair of towers.
+
+    Rows are ordered by origin, then destination, like the rows of the matrix.
+
+    Parameters
+    ----------
+    ids : a numpy array. Ids for the rows and columns of the matrix
+    distances : a numpy array. Square matrix of distances
+    max_distance : a float. Only keep pairs up to this distance, if given
+    upper_triangle : a boolean. Only keep pairs with origin before destination
+        (and pairs with themselves), for symmetric distances
+
+    Returns
+    -------
+    a pandas dataframe with columns distance, origin and destination
+    """
+    ids = np.asarray(ids)
+    # without filters, we can lay out the pairs without any index arrays
+    if max_distance is None and not upper_triangle:
+        return pd.DataFrame({'distance' : distances.ravel(),
+                             'origin' : np.repeat(ids, len(ids)),
+                             'destination' : np.tile(ids, len(ids))})
+    if max_distance is None:
+        keep = np.ones(distances.shape, dtype = bool)
+    else:
+        keep = distances <= max_distance
+    if upper_triangle:
+        keep = np.triu(keep)
+    origin, destination = np.nonzero(keep)
+    return pd.DataFrame({'distance' : distances[origin, destination],
+                         'origin' : ids[origin],
+                         'destination' : ids[destination]})
+
+
+def radius_neighbours(coordinates, radius, chunk_size = 10000):
+    """Pairs of points within a radius of each other, found with a ball tree.
+
+    Points are queried in chunks, so memory grows with the number of
+    neighbours rather than the square of the number of points.
+
+    Parameters
+    ----------
+    coordinates : a numpy array. Latitude and longitude in radians
+    radius : a float. Maximum distance in km
+    chunk_size : an integer. Number of points to query at once
+
+    Returns
+    -------
+    origin and destination indices, and the distances between them in km,
+    ordered by origin and then destination
+    """
+    tree = BallTree(coordinates, metric = 'haversine')
+    origins, destinations, distances = [], [], []
+    for start in range(0, len(coordinates), chunk_size):
+        neighbours, neighbour_distances = tree.query_radius(
+            coordinates[start:start + chunk_size], r = radius / 6373,
+            return_distance = True)
+        for i, (index, distance) in enumerate(zip(neighbours, neighbour_distances)):
+            order = np.argsort(index)
+            origins.append(np.full(len(index), start + i))
+            destinations.append(index[order])
+            distances.append(distance[order] * 6373)
+    return np.concatenate(origins), np.concatenate(destinations), \
+        np.concatenate(distances)
+
+
+def distance_pairs_within(ids, coordinates, max_distance, upper_triangle = False):
+    """Long form of the distances up to max_distance, without a full matrix.
+
+    Same output as distance_matrix_long with a max_distance.
+
+    Parameters
+    ----------
+    ids : a numpy array. Ids of the points
+    coordinates : a numpy array. Latitude and longitude in radians
+    max_distance : a float. Only keep pairs up to this distance in km
+    upper_triangle : a boolean. Only keep pairs with origin before destination
+        (and pairs with themselves)
+    """
+    ids = np.asarray(ids)
+    origin, destination, distance = radius_neighbours(coordinates, max_distance)
+    if upper_triangle:
+        keep = origin <= destination
+        origin, destination, distance = \
+            origin[keep], destination[keep], distance[keep]
+    return pd.DataFrame({'distance' : distance,
+                         'origin' : ids[origin],
+                         'destination' : ids[destination]})
+
+
+def radius_graph_clusters(coordinates, cluster_distance, max_component_size = 5000):
+    """Ward clusters of towers, computed separately for groups of nearby towers.
+
+    Towers are linked to all towers within cluster_distance, and each
+    connected group of towers is clustered with ward linkage on its own. Towers
+    further apart than the distance threshold can only end up in the same
+    ward cluster in contrived layouts, so for groups up to max_component_size
+    this gives the clusters of running ward on all towers at once, with
+    memory bounded by the largest group.
+
+    Groups larger than max_component_size are split in two at the median of
+    their longest side, until they fit. Towers on either side of a split are
+    never clustered together, so the clusters of split groups can differ from
+    those of 'ward' on all towers.
+
+    Parameters
+    ----------
+    coordinates : a numpy array. Latitude and longitude in radians
+    cluster_distance : a float. Distance threshold in km
+    max_component_size : an integer. Largest group to cluster at once
+
+    Returns
+    -------
+    a numpy array of cluster numbers, starting at 1
+    """
+    n = len(coordinates)
+    dist = DistanceMetric.get_metric('haversine')
+    origin, destination, _ = radius_neighbours(coordinates, cluster_distance)
+    graph = csr_matrix((np.ones(len(origin), dtype = bool), (origin, destination)),
+                       shape = (n, n))
+    _, components = connected_components(graph, directed = False)
+
+    # split towers into groups of connected components
+    order = np.argsort(components, kind = 'stable')
+    splits = np.flatnonzero(np.diff(components[order])) + 1
+    groups = np.split(order, splits)
+
+    clusters = np.zeros(n, dtype = int)
+    next_cluster = 1
+    while groups:
+        group = groups.pop()
+        if len(group) == 1:
+            clusters[group] = next_cluster
+            next_cluster += 1
+            continue
+        # split large groups at the median of their longest side
+        if len(group) > max_component_size:
+            points = coordinates[group]
+            axis = np.argmax(points.max(axis = 0) - points.min(axis = 0))
+            by_axis = group[np.argsort(points[:, axis], kind = 'stable')]
+            groups.extend([by_axis[:len(group) // 2], by_axis[len(group) // 2:]])
+            continue
+        group_clusters = fcluster(
+            linkage(
+            squareform(
+            dist.pairwise(coordinates[group])*6373, checks = False), method='ward'),
+            t = cluster_distance, criterion = 'distance')
+        clusters[group] = group_clusters + next_cluster - 1
+        next_cluster += group_clusters.max()
+    return clusters
+
+
+def hull_centroid(points):
+    """Centroid of the convex hull of a set of points, as x and y."""
+    centroid = MultiPoint(points).convex_hull.centroid
+    return centroid.x, centroid.y
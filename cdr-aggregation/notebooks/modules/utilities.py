@@ -16,21 +16,106 @@ def save_and_load_parquet(df, filename, ds):
     return df
 
 def save_csv(matrix, path, filename):
-    # write to csv
-    matrix.repartition(1).write.mode('overwrite').format('com.databricks.spark.csv') \
+    # write to csv, one part per partition so that all tasks write in parallel
+    matrix.write.mode('overwrite').format('com.databricks.spark.csv') \
         .save(os.path.join(path, filename), header = 'true')
-    # move one folder up and rename to human-legible .csv name
+    # merge parts into a human-legible .csv one folder up
+    merge_csv_parts(path + '/' + filename, path + '/' + filename + '.csv')
+    # remove the old folder
     if databricks:
-        dbutils.fs.mv(dbutils.fs.ls(path + '/' + filename)[-1].path,
-                  path + '/' + filename + '.csv')
-        # remove the old folder
         dbutils.fs.rm(path + '/' + filename + '/', recurse = True)
-
     else:
-        os.rename(glob.glob(os.path.join(path, filename + '/*.csv'))[0],
-                  os.path.join(path, filename + '.csv'))
         shutil.rmtree(os.path.join(path, filename))
 
+# Map the regions of a fine tower map to the regions of a coarse tower map, if
+# both map the same towers and every fine region lies within one coarse region.
+# Returns None if the tower maps don't nest
+def nested_regions(fine, coarse):
+    fine = fine.select('cell_id', F.col('region').alias('fine_region'))
+    coarse = coarse.select('cell_id', 'region')
+    if fine.join(coarse, 'cell_id', 'full').where(
+        F.col('fine_region').isNull() | F.col('region').isNull())\
+        .limit(1).count() > 0:
+        return None
+    mapping = fine.join(coarse, 'cell_id').select('fine_region', 'region')\
+        .distinct()
+    if mapping.groupby('fine_region').count().where(F.col('count') > 1)\
+        .limit(1).count() > 0:
+        return None
+    return mapping
+
+# Size of a dataframe in bytes as estimated by the optimizer, None if spark
+# can't tell. File sources are estimated by the size of their files
+def estimated_size(df):
+    try:
+        return int(df._jdf.queryExecution().optimizedPlan().stats()\
+            .sizeInBytes().toString())
+    except Exception:
+        return None
+
+# Join a small dimension table (tower map, weights, incidence) to the calls.
+# Keys are column names, joined by name as in df.join(dimension, left_on) if
+# right_on is None, else pairwise as left_on == right_on keeping both columns.
+# Dimensions the optimizer estimates below broadcast_limit bytes are broadcast
+# to every task. Larger ones are joined on the keys plus a salt, with the
+# dimension copied once per salt value, so that calls on one busy tower or
+# region are spread over several tasks instead of one
+def join_dimension(df, dimension, left_on, right_on = None, how = 'left',
+                   broadcast_limit = 64 * 1024 * 1024, salts = 16,
+                   name = 'dimension'):
+    left_on = [left_on] if isinstance(left_on, str) else list(left_on)
+    if right_on is not None:
+        right_on = [right_on] if isinstance(right_on, str) else list(right_on)
+    size = estimated_size(dimension)
+    if size is not None and size <= broadcast_limit:
+        print('Joining {}: broadcast ({:,} bytes estimated)'.format(name, size))
+        dimension = F.broadcast(dimension)
+        salt = []
+    else:
+        print('Joining {}: salted over {} tasks ({} bytes estimated)'.format(
+            name, salts, 'unknown' if size is None else '{:,}'.format(size)))
+        # rows of one key are spread by the time of the call, or subscriber
+        spread = [c for c in ['call_datetime', 'msisdn'] if c in df.columns][:1]
+        if spread:
+            salt_value = F.pmod(F.xxhash64(*left_on, *spread), salts)
+        else:
+            salt_value = F.floor(F.rand(510) * salts)
+        df = df.withColumn('join_salt', salt_value.cast('int'))
+        dimension = dimension.withColumn('join_salt',
+            F.explode(F.sequence(F.lit(0), F.lit(salts - 1))))
+        salt = ['join_salt']
+    if right_on is None:
+        result = df.join(dimension, left_on + salt, how)
+    else:
+        condition = [df[l] == dimension[r] for l, r in zip(left_on, right_on)]
+        condition += [df[s] == dimension[s] for s in salt]
+        result = df.join(dimension, condition, how)
+    return result.drop(*salt) if salt else result
+
+# On databricks, go through the dbfs mount to use normal file operations
+def local_path(path):
+    if databricks and not path.startswith('/dbfs/'):
+        return '/dbfs' + path.replace('dbfs:', '', 1)
+    return path
+
+# Concatenate the csv parts spark wrote to a folder into one csv file, in
+# partition order. Parts are streamed to the target file, so the result is
+# never held in memory. Every part repeats the header, we keep the first one.
+# Parts of empty partitions can be empty files without a header, we skip them
+def merge_csv_parts(folder, target):
+    parts = sorted(glob.glob(os.path.join(local_path(folder), 'part-*.csv')))
+    header_written = False
+    with open(local_path(target), 'wb') as merged:
+        for part in parts:
+            with open(part, 'rb') as f:
+                header = f.readline()
+                if not header:
+                    continue
+                if not header_written:
+                    merged.write(header)
+                    header_written = True
+                shutil.copyfileobj(f, merged, 16 * 1024 * 1024)
+
 ############# Windows for window functions
 
 # window by cardnumber
@@ -49,6 +134,9 @@ user_date_window = Window\
 user_date_window_rev = Window\
     .partitionBy('msisdn', 'call_date').orderBy(F.desc('call_datetime'))
 
+# window over all rows, for totals of small aggregated results
+global_window = Window.partitionBy()
+
 
 ############# Plotting
 
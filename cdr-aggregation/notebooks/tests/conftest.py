@@ -0,0 +1,80 @@
+# Fixtures for the tests of the aggregation modules. The tests run on a small
+# synthetic_cdr dataset with a local spark session, from the notebooks folder
+# like the notebooks do, e.g. in the docker container:
+#
+#   cd notebooks && python -m pytest tests
+#
+# Tests of spark code are skipped when pyspark is not installed
+import os
+import sys
+import datetime as dt
+import pytest
+
+notebooks = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, notebooks)
+# python workers of pandas udfs import the kernels from modules as well
+os.environ['PYTHONPATH'] = os.pathsep.join(
+    [notebooks] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+
+start_date = dt.datetime(2020,2,1)
+end_date = dt.datetime(2020,2,21)
+
+@pytest.fixture(scope = 'session')
+def datasource(tmp_path_factory):
+    pytest.importorskip('pyspark')
+    from modules.DataSource import DataSource
+    from pyspark.sql.types import StructType, StructField, IntegerType, \
+        StringType
+    ds = DataSource({
+        'base_path' : str(tmp_path_factory.mktemp('data')),
+        'spark_master' : 'local[2]',
+        'country_code' : 'synthetic',
+        'telecom_alias' : 'test',
+        'schema' : StructType([
+            StructField('msisdn', IntegerType(), True),
+            StructField('call_datetime', StringType(), True),
+            StructField('location_id', StringType(), True)]),
+        'filestub' : 'synthetic',
+        'shapefiles' : [],
+        'dates' : {'start_date' : start_date, 'end_date' : end_date}})
+    ds.spark.conf.set('spark.sql.session.timeZone', 'UTC')
+    ds.spark.conf.set('spark.sql.shuffle.partitions', '4')
+    for folder in ds.required_folders():
+        os.makedirs(folder, exist_ok = True)
+    # the modules build windows when imported, so spark has to be running
+    from modules.synthetic_data import synthetic_cdr
+    synthetic = synthetic_cdr(ds.spark,
+                              n_subscribers = 200,
+                              n_towers = 40,
+                              start_date = start_date,
+                              end_date = end_date)
+    synthetic.attach(ds)
+    ds.raw_df = ds.parquet_df
+    ds.save_as_parquet()
+    # incidence per region, for the custom aggregator
+    rng = synthetic.rng
+    for level, name, key in [
+        ('admin2', 'admin2_incidence', 'region'),
+        ('admin2', 'admin3_cholera_incidence_total', 'ward')]:
+        regions = sorted(synthetic.towers[level].unique())
+        setattr(ds, name, ds.spark.createDataFrame(
+            [(region, float(rng.uniform(0, 100))) for region in regions],
+            [key, 'incidence']))
+    ds.synthetic = synthetic
+    return ds
+
+@pytest.fixture(scope = 'session')
+def priority(datasource):
+    from modules.priority_aggregator import priority_aggregator
+    return priority_aggregator(result_stub = '/priority',
+                               datasource = datasource,
+                               regions = 'admin2_tower_map',
+                               re_create_vars = True)
+
+@pytest.fixture(scope = 'session')
+def custom(datasource, priority):
+    from modules.custom_aggregator import custom_aggregator
+    # reads the vars parquet the priority aggregator created
+    return custom_aggregator(result_stub = '/custom',
+                             datasource = datasource,
+                             regions = 'admin2_tower_map')
@@ -0,0 +1,46 @@
+# Appending new dates to the vars parquet compared with creating it from the
+# full calls history
+import copy
+import datetime as dt
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyspark')
+
+def test_append_vars(datasource):
+    import pyspark.sql.functions as F
+    from modules.priority_aggregator import priority_aggregator
+    # a vars parquet of its own, next to the one of the other tests
+    ds = copy.copy(datasource)
+    ds.parquetfile_vars = 'synthetic_append_vars_'
+    calls = datasource.parquet_df
+
+    def aggregator(last_date, **kwargs):
+        ds.parquet_df = calls.where(F.col('call_date') <= last_date)
+        return priority_aggregator(result_stub = '/append', datasource = ds,
+                                   regions = 'admin3_tower_map', **kwargs)
+
+    aggregator(dt.date(2020,2,10), re_create_vars = True)
+    aggregator(dt.date(2020,2,15), append_vars = True)
+    appended = aggregator(dt.date(2020,2,21), append_vars = True)
+    result = appended.df.toPandas()
+    state = appended.load_vars_state(appended.df).toPandas()
+
+    created = aggregator(dt.date(2020,2,21), re_create_vars = True)
+    expected = created.df.toPandas()
+    expected_state = created.vars_state(created.df).toPandas()
+
+    # subscribers keep the home region of the dates they were first seen in,
+    # instead of the one of all dates
+    columns = [c for c in expected.columns if c != 'home_region']
+    keys = ['msisdn', 'call_datetime', 'location_id']
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(
+        result[columns].sort_values(keys).reset_index(drop = True),
+        expected[columns].sort_values(keys).reset_index(drop = True),
+        check_dtype = False)
+    columns = ['msisdn', 'call_datetime', 'call_date']
+    pd.testing.assert_frame_equal(
+        state[columns].sort_values('msisdn').reset_index(drop = True),
+        expected_state[columns].sort_values('msisdn').reset_index(drop = True),
+        check_dtype = False)
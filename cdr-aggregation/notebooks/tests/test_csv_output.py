@@ -0,0 +1,36 @@
+# csv results written by all tasks in parallel and merged into one csv,
+# compared with the csv of a single task
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyspark')
+
+# the datasource starts spark, which utilities needs when imported
+def test_merge_csv_parts(datasource, tmp_path):
+    from modules.utilities import merge_csv_parts
+    folder = tmp_path / 'table'
+    folder.mkdir()
+    # parts of empty partitions can be empty files without a header
+    (folder / 'part-00000.csv').write_text('')
+    (folder / 'part-00001.csv').write_text('region,count\nA,1\nB,2\n')
+    (folder / 'part-00002.csv').write_text('')
+    (folder / 'part-00003.csv').write_text('region,count\nC,3\n')
+    merge_csv_parts(str(folder), str(tmp_path / 'table.csv'))
+    assert (tmp_path / 'table.csv').read_text() == \
+        'region,count\nA,1\nB,2\nC,3\n'
+
+def test_save_csv(datasource, priority, tmp_path):
+    from modules.utilities import save_csv
+    result = priority.unique_subscribers(priority.period_filter, 'day')
+    # more partitions than rows of some regions leaves empty partitions
+    save_csv(result.repartition(64), str(tmp_path), 'parallel')
+    result.repartition(1).write.csv(str(tmp_path / 'single'), header = True)
+    parallel = pd.read_csv(tmp_path / 'parallel.csv')
+    single = pd.concat([pd.read_csv(part) for part in
+                        (tmp_path / 'single').glob('part-*.csv')])
+    keys = ['day', 'region']
+    assert len(parallel) > 0
+    assert not (tmp_path / 'parallel').exists()
+    pd.testing.assert_frame_equal(
+        parallel.sort_values(keys).reset_index(drop = True),
+        single.sort_values(keys).reset_index(drop = True))
@@ -0,0 +1,56 @@
+# Approximate distinct counts from HyperLogLog sketches compared with exact
+# distinct counts of the synthetic subscribers
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyspark')
+
+def test_hll_estimate(datasource):
+    import pyspark.sql.functions as F
+    from modules.sketches import hll_sketch, hll_estimate, hll_precision
+    precision = hll_precision(0.02)
+    calls = datasource.parquet_df
+    for groups in [['call_date'], []]:
+        exact = calls.groupby(*groups)\
+            .agg(F.countDistinct('msisdn').alias('exact'))
+        estimate = hll_estimate(hll_sketch(calls, groups, precision), groups,
+                                precision)
+        counts = exact.join(estimate, groups).toPandas() if groups \
+            else pd.concat([exact.toPandas(), estimate.toPandas()], axis = 1)
+        assert len(counts) > 0
+        assert ((counts['count'] - counts['exact']).abs() <= \
+            0.06 * counts['exact']).all()
+
+# merging the sketches of hours gives the sketch of the day
+def test_hll_merge(datasource):
+    import pyspark.sql.functions as F
+    from modules.sketches import hll_sketch, hll_merge
+    calls = datasource.parquet_df\
+        .withColumn('hour', F.date_trunc('hour', 'call_datetime'))
+    hourly = hll_sketch(calls, ['call_date', 'hour'], 10)
+    merged = hll_merge(hourly, ['call_date']).toPandas()
+    daily = hll_sketch(calls, ['call_date'], 10).toPandas()
+    keys = ['call_date', 'register']
+    pd.testing.assert_frame_equal(
+        merged.sort_values(keys).reset_index(drop = True),
+        daily[merged.columns].sort_values(keys).reset_index(drop = True))
+
+@pytest.mark.parametrize('indicator', ['unique_subscribers',
+                                       'unique_subscribers_country'])
+def test_approx_distinct(priority, indicator):
+    frequency = 'day'
+    keys = [frequency, 'region'] if indicator == 'unique_subscribers' \
+        else [frequency]
+    exact = getattr(priority, indicator)(priority.period_filter, frequency)\
+        .toPandas()
+    priority.approx_distinct = True
+    try:
+        approx = getattr(priority, indicator)(priority.period_filter,
+                                              frequency).toPandas()
+    finally:
+        priority.approx_distinct = False
+    counts = exact.merge(approx, on = keys, suffixes = ('', '_approx'))
+    # counts near the privacy filter can fall on either side of it
+    assert len(counts) >= 0.9 * len(exact)
+    assert ((counts['count_approx'] - counts['count']).abs() <= \
+        0.06 * counts['count']).all()
@@ -0,0 +1,66 @@
+# spread_over_days compared with spreading every stay over the calendar days
+# it overlaps one by one, on stays of the synthetic subscribers
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyspark')
+
+def synthetic_stays(priority, max_days, incidence = None):
+    import pyspark.sql.functions as F
+    seconds = (max_days - 1) * 24 * 60 * 60
+    stays = priority.filter_df(priority.period_filter)\
+        .where(F.col('call_datetime_lead').isNotNull())\
+        .select('day', 'region',
+            F.col('call_datetime').cast('long').alias('call_datetime_long'),
+            F.least(F.col('call_datetime_lead').cast('long') - \
+                F.col('call_datetime').cast('long'), F.lit(seconds))\
+                .alias('duration_change_only'))\
+        .toPandas()
+    rng = np.random.default_rng(510)
+    for k in range(10):
+        stays['imported_incidence_' + str(k)] = rng.uniform(0, 1, len(stays)) \
+            if incidence is None else incidence
+    return stays
+
+def spread_one_by_one(stays, max_days):
+    spread = {}
+    for stay in stays.itertuples():
+        start = stay.call_datetime_long
+        end = start + stay.duration_change_only
+        first_day = pd.Timestamp(stay.day).normalize()
+        for k in range(max_days):
+            day = first_day + pd.Timedelta(days = k)
+            overlap = min(end, (day + pd.Timedelta(days = 1)).timestamp()) - \
+                max(start, day.timestamp())
+            if overlap > 0:
+                incidence = getattr(stay, 'imported_incidence_' + str(k)) \
+                    if k < 10 else 0
+                key = (day.date(), stay.region)
+                spread[key] = spread.get(key, 0) + incidence * overlap
+    return pd.DataFrame([(day, region, value) for (day, region), value
+                         in spread.items()],
+                        columns = ['day', 'region', 'imported_incidence'])
+
+def test_spread_over_days(custom):
+    max_days = 2 * custom.cutoff_days + 1
+    stays = synthetic_stays(custom, max_days)
+    assert (stays['duration_change_only'] > 24 * 60 * 60).any()
+    result = custom.spread_over_days(custom.spark.createDataFrame(stays),
+                                     max_days).toPandas()
+    expected = spread_one_by_one(stays, max_days)
+    keys = ['day', 'region']
+    pd.testing.assert_frame_equal(
+        result.sort_values(keys).reset_index(drop = True),
+        expected.sort_values(keys).reset_index(drop = True),
+        check_dtype = False, rtol = 1e-9)
+
+# With the same incidence on every day, spreading keeps the incidence the
+# stays import in total, as importing it on the first day does
+def test_spread_over_days_keeps_total(custom):
+    max_days = 10
+    stays = synthetic_stays(custom, max_days, incidence = 0.5)
+    result = custom.spread_over_days(custom.spark.createDataFrame(stays),
+                                     max_days).toPandas()
+    assert result['imported_incidence'].sum() == \
+        pytest.approx((0.5 * stays['duration_change_only']).sum(), rel = 1e-12)
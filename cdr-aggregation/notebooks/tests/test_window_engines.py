@@ -0,0 +1,60 @@
+# The 'stays' and 'pandas' window engines compared with the window functions
+# of the default 'spark' engine, on synthetic data
+import datetime as dt
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyspark')
+
+def with_engine(aggregator, engine, indicator, *args, **kwargs):
+    aggregator.window_engine = engine
+    try:
+        return getattr(aggregator, indicator)(*args, **kwargs).toPandas()
+    finally:
+        aggregator.window_engine = 'spark'
+        aggregator.release_stays()
+
+@pytest.mark.parametrize('engine', ['stays', 'pandas'])
+@pytest.mark.parametrize('frequency', ['day', 'week'])
+def test_origin_destination_matrix_time(priority, engine, frequency):
+    time_filter = priority.period_filter if frequency == 'day' \
+        else priority.weeks_filter
+    keys = [frequency, 'region', 'region_lag']
+    expected = with_engine(priority, 'spark', 'origin_destination_matrix_time',
+                           time_filter, frequency)
+    result = with_engine(priority, engine, 'origin_destination_matrix_time',
+                         time_filter, frequency)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(
+        result.sort_values(keys).reset_index(drop = True)[expected.columns],
+        expected.sort_values(keys).reset_index(drop = True),
+        check_dtype = False)
+
+def test_accumulated_incidence_imported_only(custom):
+    kwargs = {'incubation_period_start' : dt.datetime(2020,2,3),
+              'incubation_period_end' : dt.datetime(2020,2,18)}
+    expected = with_engine(custom, 'spark',
+        'accumulated_incidence_imported_only', custom.period_filter, **kwargs)
+    result = with_engine(custom, 'pandas',
+        'accumulated_incidence_imported_only', custom.period_filter, **kwargs)
+    assert expected['imported_incidence'].sum() > 0
+    pd.testing.assert_frame_equal(
+        result.sort_values('region').reset_index(drop = True),
+        expected.sort_values('region').reset_index(drop = True),
+        check_dtype = False, rtol = 1e-9)
+
+@pytest.mark.parametrize('engine', ['stays', 'pandas'])
+@pytest.mark.parametrize('import_in_one_day', [True, False])
+def test_accumulated_cholera_incidence_imported_only(custom, engine,
+                                                     import_in_one_day):
+    args = (custom.period_filter, 'day', 'total')
+    kwargs = {'import_in_one_day' : import_in_one_day}
+    expected = with_engine(custom, 'spark',
+        'accumulated_cholera_incidence_imported_only', *args, **kwargs)
+    result = with_engine(custom, engine,
+        'accumulated_cholera_incidence_imported_only', *args, **kwargs)
+    assert expected['imported_incidence'].sum() > 0
+    pd.testing.assert_frame_equal(
+        result.sort_values(['day', 'region']).reset_index(drop = True),
+        expected.sort_values(['day', 'region']).reset_index(drop = True),
+        check_dtype = False, rtol = 1e-9)